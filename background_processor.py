@@ -1,340 +1,360 @@
 import os
+import asyncio
 import logging
-import threading
-import tempfile
 import json
-from typing import Dict, Any, Optional, List
-from collections import deque
-from PIL import Image
-from io import BytesIO
+from typing import Dict, Any, Optional, List, Tuple
+import httpx
 import requests
+import fal_client
+from langchain_core.exceptions import ModelError
 from graph.tools import State
-from graph.graph import agent
-from whatsapp import Whatsapp
+from graph.graph import get_agent, thread_config
+from graph.images import ImageRef, image_store
+from imaging import aencode_for_whatsapp, aencode_preview
+from graph.uploads import fal_upload_cache
+from graph.router import router_stats
+from graph.context import compact_history, context_stats
+from graph.llm_cache import response_cache
+from graph.result_cache import result_cache
+from graph.scheduler import fal_scheduler
+from whatsapp import AsyncWhatsapp, WhatsappAPIError, PRIORITY_PROGRESS
+from debounce import coalescing_stats
+from media_fetcher import MediaFetcher, MediaTooLargeError
+from session_store import create_session_store
+import metrics
+import tracing
 from langchain.messages import HumanMessage, SystemMessage
 
-wp = Whatsapp()
+wp = AsyncWhatsapp()
+media_fetcher = MediaFetcher(wp)
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Sesiones compartidas (importadas desde webhook o gestionadas aquí)
-# Por ahora, las gestionaremos aquí para evitar dependencias circulares
-sessions: Dict[str, State] = {}
-session_lock = threading.Lock()
+# Sesiones por número de teléfono (checkpointer del graph, memoria o SQLite, según SESSION_STORE)
+session_store = create_session_store(agent_factory=get_agent)
+metrics.register("sessions", session_store.stats)
+metrics.register("image_store", image_store.stats)
+metrics.register("fal_uploads", fal_upload_cache.stats)
+metrics.register("router", router_stats.stats)
+metrics.register("context", context_stats.stats)
+metrics.register("llm_cache", response_cache.stats)
+metrics.register("result_cache", result_cache.stats)
+metrics.register("fal_scheduler", fal_scheduler.stats)
+metrics.register("whatsapp_sends", wp.send_stats)
+metrics.register("media_downloads", media_fetcher.stats)
+metrics.register("coalescing", lambda: coalescing_stats.stats(llm_calls=context_stats.calls))
+metrics.register("tracing", tracing.tracer.stats)
 
-# Cola de mensajes pendientes por número de teléfono
-pending_messages: Dict[str, deque] = {}
-# Flags de procesamiento activo por número
-processing_flags: Dict[str, bool] = {}
-# Lock para las colas y flags
-queue_lock = threading.Lock()
+# Subir a fal.ai las imágenes entrantes apenas llegan (especulativo: puede que no se editen)
+FAL_PREFETCH = os.getenv("FAL_PREFETCH", "1") == "1"
 
-def get_or_create_session(phone_number: str) -> State:
-    """Obtiene o crea una sesión de forma thread-safe"""
-    with session_lock:
-        if phone_number not in sessions:
-            sessions[phone_number] = {
-                "messages": [],
-                "current_node": "triage",
-                "awaiting": None,
-                "back": False,
-                "user_last_prompt": None,
-                "generated_image": None,
-                "user_images": [],
-            }
-        return sessions[phone_number]
+def new_session() -> State:
+    """Estado inicial de una conversación"""
+    return {
+        "messages": [],
+        "current_node": "triage",
+        "awaiting": None,
+        "back": False,
+        "user_last_prompt": None,
+        "generated_image": None,
+        "user_images": [],
+        "last_output": None,
+        "summary": None,
+        "last_variants": [],
+    }
 
-async def process_message_background(message: Dict[str, Any], metadata: Dict[str, Any]) -> None:
+async def get_or_create_session(phone_number: str) -> State:
+    """Obtiene o crea una sesión a través del session store"""
+    return await session_store.get_or_create(phone_number, new_session)
+
+async def process_message_batch(
+    phone_number: str,
+    entries: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+    attempt: int = 1,
+    last_attempt: bool = True,
+) -> None:
     """
-    Procesa un mensaje completo en background.
-    
-    Esta función maneja todo el procesamiento del bot (texto, imágenes, etc.)
-    de forma asíncrona para no bloquear el webhook.
+    Procesa un lote de mensajes de un mismo número que ya viene ordenado y serializado
+    por la cola de ingesta durable (ver worker.py).
     
-    Los mensajes del mismo número se acumulan y se procesan juntos en una sola
-    llamada al graph para evitar race conditions.
+    La cola ya descartó las reentregas (dedupe en el webhook), aplicó la ventana de
+    coalescencia y garantiza que nunca hay dos lotes del mismo número en vuelo.
     
     Args:
-        message: Diccionario con el mensaje de WhatsApp
-        metadata: Metadata del mensaje (phone_number_id, etc.)
+        phone_number: Número de teléfono del usuario
+        entries: Lista de tuplas (message, metadata) en orden de llegada
+        attempt: Intento de la cola para este lote (1 = primera vez)
+        last_attempt: Si falla, la cola ya no lo reintenta (pasa a dead-letter)
+    
+    Raises:
+        Los errores transitorios (ver _is_transient), para que la cola reintente el lote
     """
-    try:
+    messages_to_process: List[Dict[str, Any]] = []
+    for message, metadata in entries:
         message_id = message.get("id")
-        from_number = message.get("from")
-        message_type = message.get("type")
-        
-        if not from_number:
-            logger.warning("Message without from number, skipping")
-            return
-        
-        logger.info(f"Received message {message_id} from {from_number}, type: {message_type}")
-        
-        # Marcar mensaje como leído inmediatamente
         if message_id:
             try:
-                wp.mark_read(message_id)
+                await wp.mark_read(message_id)
             except Exception as e:
                 logger.warning(f"Could not mark message as read: {e}")
-        
-        # Agregar mensaje a la cola o procesar directamente
-        should_process = False
-        with queue_lock:
-            # Inicializar cola si no existe
-            if from_number not in pending_messages:
-                pending_messages[from_number] = deque()
-            
-            # Agregar mensaje a la cola
-            pending_messages[from_number].append({
-                "message": message,
-                "metadata": metadata,
-                "type": message_type
-            })
-            
-            # Si ya hay un procesamiento activo, solo agregar a la cola y salir
-            if processing_flags.get(from_number, False):
-                logger.info(f"Processing active for {from_number}, message added to queue. Queue size: {len(pending_messages[from_number])}")
-                return
-            
-            # Marcar como procesando DENTRO del lock para evitar race conditions
-            processing_flags[from_number] = True
-            should_process = True
-        
-        # Procesar todos los mensajes acumulados (solo si somos el que inició el procesamiento)
-        if should_process:
-            await process_all_pending_messages(from_number)
+        messages_to_process.append({
+            "message": message,
+            "metadata": metadata,
+            "type": message.get("type")
+        })
     
-    except Exception as e:
-        logger.error(f"Error processing message: {str(e)}", exc_info=True)
-        from_number = message.get("from")
-        if from_number:
-            try:
-                wp.send_text(from_number, "❌ Ocurrió un error procesando tu mensaje. Intenta de nuevo.")
-            except:
-                pass
+    logger.info(f"Processing {len(messages_to_process)} queued message(s) for {phone_number}")
+    with _batch_span(phone_number, messages_to_process):
+        await _process_batch(phone_number, messages_to_process, attempt, last_attempt)
 
-async def process_all_pending_messages(phone_number: str) -> None:
+def _batch_span(phone_number: str, messages_to_process: List[Dict[str, Any]]):
+    """Span del lote en el trace de su primer mensaje (los demás quedan como links)"""
+    message_ids = [m["message"]["id"] for m in messages_to_process if m["message"].get("id")]
+    return tracing.message_span(
+        "process_batch", message_ids, phone=phone_number,
+        message_types=[m["type"] for m in messages_to_process],
+    )
+
+def _is_transient(error: BaseException) -> bool:
+    """Caídas de la Graph API, fal.ai o Gemini: reintentar el mismo lote más tarde puede funcionar"""
+    if isinstance(error, ModelError):
+        return bool(error.is_retryable)
+    if isinstance(error, fal_client.FalClientHTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    if isinstance(error, (httpx.TransportError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, WhatsappAPIError):
+        return error.status_code == 429 or error.status_code >= 500
+    # Incluye fal_client.FalClientTimeoutError y asyncio.TimeoutError
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+async def _process_batch(
+    phone_number: str, messages_to_process: List[Dict[str, Any]], attempt: int = 1, last_attempt: bool = True
+) -> None:
     """
-    Procesa todos los mensajes pendientes de un número de teléfono.
-    Agrega todos los mensajes a la sesión y llama al graph una sola vez.
+    Agrega un lote de mensajes a la sesión y ejecuta el graph una sola vez.
+    
+    Los errores se notifican al usuario. Los transitorios además se propagan para que
+    la cola durable reintente el lote; por eso cada mensaje entra al estado con el ID
+    de WhatsApp y un reintento no vuelve a agregar lo que el checkpointer ya guardó.
     """
-    while True:
-        # Obtener todos los mensajes pendientes de forma thread-safe
-        messages_to_process: List[Dict[str, Any]] = []
-        with queue_lock:
-            if phone_number in pending_messages:
-                while pending_messages[phone_number]:
-                    messages_to_process.append(pending_messages[phone_number].popleft())
+    try:
+        # Obtener sesión (los lotes de un mismo número nunca se procesan en paralelo)
+        with tracing.span("session.load"):
+            state = await get_or_create_session(phone_number)
         
-        # Si no hay mensajes pendientes, salir del loop
-        if not messages_to_process:
-            break
+        # Contar mensajes antes de agregar nuevos
+        messages_before = len(state.get("messages", []))
+        # Mensajes de un intento anterior que ya quedaron en el estado
+        applied_ids = {m.id for m in state.get("messages", []) if m.id}
+        replayed = False
         
-        logger.info(f"Processing {len(messages_to_process)} message(s) for {phone_number}")
+        # Descargar a la vez todas las fotos del lote (las URLs de media de WhatsApp expiran
+        # rápido): una ráfaga de imágenes tarda lo que la descarga más lenta. Las que ya
+        # quedaron en el estado en un intento anterior no se vuelven a bajar
+        downloads = await media_fetcher.fetch_many([
+            (msg_data["message"]["image"]["id"], msg_data["message"]["image"].get("mime_type"))
+            for msg_data in messages_to_process
+            if msg_data["type"] == "image" and msg_data["message"].get("image", {}).get("id")
+            and msg_data["message"].get("id") not in applied_ids
+        ])
         
-        try:
-            # Obtener sesión de forma thread-safe
-            # get_or_create_session ya maneja el lock internamente, no necesitamos otro lock aquí
-            state = get_or_create_session(phone_number)
+        # Agregar todos los mensajes a la sesión
+        for msg_data in messages_to_process:
+            message = msg_data["message"]
+            message_type = msg_data["type"]
+            message_id = message.get("id")
             
-            # Contar mensajes antes de agregar nuevos
-            messages_before = len(state.get("messages", []))
+            if message_id and message_id in applied_ids:
+                logger.info(f"Message {message_id} already in session from a previous attempt")
+                replayed = True
+                continue
             
-            # Agregar todos los mensajes a la sesión
-            for msg_data in messages_to_process:
-                message = msg_data["message"]
-                message_type = msg_data["type"]
+            # Procesar según el tipo de mensaje
+            if message_type == "text":
+                text_body = message.get("text", {}).get("body", "")
+                state["messages"].append(HumanMessage(content=text_body, id=message_id))
+                logger.info(f"Added text message to session: {text_body[:50]}...")
+            
+            elif message_type == "image":
+                # Obtener información de la imagen
+                image_data = message.get("image", {})
+                image_id = image_data.get("id")
+                caption = image_data.get("caption")
                 
-                # Procesar según el tipo de mensaje
-                if message_type == "text":
-                    text_body = message.get("text", {}).get("body", "")
-                    state["messages"].append(HumanMessage(content=text_body))
-                    logger.info(f"Added text message to session: {text_body[:50]}...")
+                logger.info(f"Processing image message - image_id: {image_id}, caption: {caption if caption else 'None'}")
                 
-                elif message_type == "image":
-                    # Obtener información de la imagen
-                    image_data = message.get("image", {})
-                    image_id = image_data.get("id")
-                    caption = image_data.get("caption")
-                    
-                    logger.info(f"Processing image message - image_id: {image_id}, caption: {caption if caption else 'None'}")
+                if not image_id:
+                    logger.warning(f"No image_id found in message")
+                    await wp.send_text(phone_number, "⚠️ No se pudo obtener la información de la imagen.")
+                    msg_data["type"] = "image_failed"
+                    continue
+                
+                try:
+                    # Ya descargada (en streaming), normalizada (EXIF, tamaño máximo útil, re-encode)
+                    # y guardada en el ImageStore; en la sesión solo queda la referencia
+                    image_ref = downloads[image_id]
+                    if isinstance(image_ref, Exception):
+                        raise image_ref
+                    state["user_images"].append(image_ref)
+                    if FAL_PREFETCH:
+                        # La subida a fal.ai corre mientras el graph decide; edit_image la encuentra hecha
+                        fal_upload_cache.prefetch(image_ref)
                     
-                    if not image_id:
-                        logger.warning(f"No image_id found in message")
-                        wp.send_text(phone_number, "⚠️ No se pudo obtener la información de la imagen.")
-                        msg_data["type"] = "image_failed"
-                        continue
+                    # Ahora sí notificar al usuario que se recibió y procesó
+                    await wp.send_text(phone_number, "📸 Recibí tu imagen, procesándola...", priority=PRIORITY_PROGRESS)
                     
-                    try:
-                        # Descargar la imagen de WhatsApp PRIMERO (sin notificar todavía)
-                        # Las URLs de media de WhatsApp expiran rápidamente, así que descargamos inmediatamente
-                        logger.info(f"Downloading image {image_id} for {phone_number}")
-                        image_bytes = download_image_from_whatsapp(image_id)
-                        
-                        # Convertir a PIL Image
-                        image = Image.open(BytesIO(image_bytes))
-                        
-                        # Guardar imagen en el estado
-                        state["user_images"].append(image)
-                        
-                        # Ahora sí notificar al usuario que se recibió y procesó
-                        wp.send_text(phone_number, "📸 Recibí tu imagen, procesándola...")
-                        
-                        state["messages"].append(SystemMessage(content=f"{len(state['user_images'])} {'Image' if len(state['user_images']) == 1 else 'Images'} added to chat"))
+                    state["messages"].append(SystemMessage(content=f"{len(state['user_images'])} {'Image' if len(state['user_images']) == 1 else 'Images'} added to chat", id=message_id))
 
-                        # Si hay caption, procesarlo como HumanMessage
-                        if caption:
-                            state["messages"].append(HumanMessage(content=f"Last image caption: {caption}"))
-                        
-                        # Cambiar al nodo de img_to_img
-                        state["current_node"] = "img_to_img"
-                        state["awaiting"] = None
-                        
-                        logger.info(f"Added image message to session successfully, total images: {len(state['user_images'])}")
-                    except requests.exceptions.HTTPError as e:
-                        # Si la imagen expiró o hay un error de descarga
-                        error_msg = str(e)
-                        if "400" in error_msg or "404" in error_msg:
-                            logger.error(f"Error downloading image {image_id}: {e} - Media may have expired")
-                            wp.send_text(phone_number, "⚠️ Lo siento, no pude descargar tu imagen. Es posible que haya expirado. Por favor, envía la imagen nuevamente.")
-                        else:
-                            logger.error(f"HTTP error downloading image {image_id}: {e}")
-                            wp.send_text(phone_number, "⚠️ Ocurrió un error al descargar tu imagen. Por favor, intenta de nuevo.")
-                        # Si hay caption, procesarlo como texto
-                        if caption:
-                            state["messages"].append(HumanMessage(content=caption))
-                        # Marcar este mensaje como no procesable para el graph
-                        msg_data["type"] = "image_failed"
-                        continue
-                    except Exception as e:
-                        # Otros errores al procesar la imagen
-                        logger.error(f"Error processing image: {e}", exc_info=True)
-                        wp.send_text(phone_number, "❌ Ocurrió un error al procesar tu imagen. Por favor, intenta de nuevo.")
-                        # Si hay caption, procesarlo como texto
-                        if caption:
-                            state["messages"].append(HumanMessage(content=caption))
-                        # Marcar este mensaje como no procesable para el graph
-                        msg_data["type"] = "image_failed"
-                        continue
-                
-                elif message_type == "document":
-                    logger.info("Document message received")
-                    wp.send_text(phone_number, "Por ahora solo soportamos imágenes, no documentos 😅")
+                    # Si hay caption, procesarlo como HumanMessage
+                    if caption:
+                        state["messages"].append(HumanMessage(content=f"Last image caption: {caption}", id=f"{message_id}:caption" if message_id else None))
+                    
+                    # Cambiar al nodo de img_to_img
+                    state["current_node"] = "img_to_img"
+                    state["awaiting"] = None
+                    
+                    logger.info(f"Added image message to session successfully, total images: {len(state['user_images'])}")
+                except requests.exceptions.HTTPError as e:
+                    # Si la imagen expiró o hay un error de descarga
+                    error_msg = str(e)
+                    if "400" in error_msg or "404" in error_msg:
+                        logger.error(f"Error downloading image {image_id}: {e} - Media may have expired")
+                        await wp.send_text(phone_number, "⚠️ Lo siento, no pude descargar tu imagen. Es posible que haya expirado. Por favor, envía la imagen nuevamente.")
+                    else:
+                        logger.error(f"HTTP error downloading image {image_id}: {e}")
+                        await wp.send_text(phone_number, "⚠️ Ocurrió un error al descargar tu imagen. Por favor, intenta de nuevo.")
+                    # Si hay caption, procesarlo como texto
+                    if caption:
+                        state["messages"].append(HumanMessage(content=caption, id=message_id))
+                    # Marcar este mensaje como no procesable para el graph
+                    msg_data["type"] = "image_failed"
                     continue
-                
-                elif message_type == "audio" or message_type == "voice":
-                    logger.info("Audio/Voice message received")
-                    wp.send_text(phone_number, "Por ahora solo soportamos texto e imágenes 📝🖼️")
+                except MediaTooLargeError as e:
+                    logger.warning(f"Image {image_id} rejected: {e}")
+                    await wp.send_text(phone_number, "⚠️ Tu imagen es demasiado grande. Por favor, envía una imagen más liviana.")
+                    if caption:
+                        state["messages"].append(HumanMessage(content=caption, id=message_id))
+                    msg_data["type"] = "image_failed"
                     continue
-                
-                else:
-                    logger.info(f"Unsupported message type: {message_type}")
-                    wp.send_text(phone_number, f"Tipo de mensaje '{message_type}' no soportado aún 🤔")
+                except Exception as e:
+                    # Otros errores al procesar la imagen
+                    logger.error(f"Error processing image: {e}", exc_info=True)
+                    await wp.send_text(phone_number, "❌ Ocurrió un error al procesar tu imagen. Por favor, intenta de nuevo.")
+                    # Si hay caption, procesarlo como texto
+                    if caption:
+                        state["messages"].append(HumanMessage(content=caption, id=message_id))
+                    # Marcar este mensaje como no procesable para el graph
+                    msg_data["type"] = "image_failed"
                     continue
             
-            # Verificar si se agregaron mensajes nuevos al estado en este batch
-            messages_after = len(state.get("messages", []))
-            messages_added = messages_after > messages_before
+            elif message_type == "document":
+                logger.info("Document message received")
+                await wp.send_text(phone_number, "Por ahora solo soportamos imágenes, no documentos 😅")
+                continue
             
-            # Solo ejecutar el graph si hay mensajes procesables (text o image)
-            processable_messages = [m for m in messages_to_process if m["type"] in ["text", "image"]]
+            elif message_type == "audio" or message_type == "voice":
+                logger.info("Audio/Voice message received")
+                await wp.send_text(phone_number, "Por ahora solo soportamos texto e imágenes 📝🖼️")
+                continue
             
-            # Ejecutar graph si hay mensajes procesables Y se agregaron mensajes al estado
-            if processable_messages and messages_added:
-                # Guardar estado actualizado después de agregar todos los mensajes/imágenes
-                # antes de ejecutar el graph
-                with session_lock:
-                    sessions[phone_number] = state
-                
-                last_messages_count = len(state["messages"])
-                state = agent.invoke(state)
-                
-                # Guardar estado actualizado de forma thread-safe
-                with session_lock:
-                    sessions[phone_number] = state
-                
-                # Enviar respuesta del asistente si hay mensajes nuevos
-                new_messages_count = len(state["messages"]) - last_messages_count
-                send_assistant_responses(state, phone_number, new_messages_count)
+            else:
+                logger.info(f"Unsupported message type: {message_type}")
+                await wp.send_text(phone_number, f"Tipo de mensaje '{message_type}' no soportado aún 🤔")
+                continue
         
-        except Exception as e:
-            logger.error(f"Error processing messages for {phone_number}: {str(e)}", exc_info=True)
-            try:
-                wp.send_text(phone_number, "❌ Ocurrió un error procesando tu mensaje. Intenta de nuevo.")
-            except:
-                pass
-        finally:
-            # Verificar si hay más mensajes pendientes antes de marcar como no procesando
-            with queue_lock:
-                if phone_number in pending_messages and len(pending_messages[phone_number]) > 0:
-                    # Hay más mensajes, continuar procesando
-                    logger.info(f"More messages pending for {phone_number}, continuing processing")
-                else:
-                    # No hay más mensajes, marcar como no procesando
-                    processing_flags[phone_number] = False
-                    logger.info(f"Finished processing all messages for {phone_number}")
-                    break
+        # Verificar si se agregaron mensajes nuevos al estado en este batch
+        messages_after = len(state.get("messages", []))
+        messages_added = messages_after > messages_before
+        
+        # Solo ejecutar el graph si hay mensajes procesables (text o image)
+        processable_messages = [m for m in messages_to_process if m["type"] in ["text", "image"]]
+        
+        # Ejecutar graph si hay mensajes procesables Y se agregaron mensajes al estado
+        # (o ya estaban de un intento que se cayó antes de responder)
+        if processable_messages and (messages_added or replayed):
+            # El checkpointer persiste el estado de entrada (con los mensajes/imágenes
+            # recién agregados) en cuanto arranca el graph
+            last_messages_count = len(state["messages"])
+            with tracing.span("graph.run", messages=len(processable_messages)):
+                state = await run_agent(state, phone_number)
+            coalescing_stats.record_run(len(processable_messages))
+            
+            # Enviar respuesta del asistente si hay mensajes nuevos
+            new_messages_count = len(state["messages"]) - last_messages_count
+            with tracing.span("send_responses", messages=new_messages_count):
+                await send_assistant_responses(state, phone_number, new_messages_count)
+            
+            # Con la respuesta ya enviada, compactar la historia vieja en el resumen
+            with tracing.span("context.compact"):
+                state = await compact_history(state)
+            
+            # Guardar en el estado las URLs de fal.ai de las imágenes ya subidas
+            state["user_images"] = [fal_upload_cache.with_hosted_url(ref) for ref in state["user_images"]]
+            
+            # Guardar estado actualizado (send_assistant_responses resetea generated_image)
+            with tracing.span("session.save"):
+                await session_store.save(phone_number, state)
+        
+        elif messages_added:
+            # Ej.: caption de una imagen que no se pudo descargar
+            await session_store.save(phone_number, state)
+    
+    except Exception as e:
+        transient = _is_transient(e)
+        logger.error(f"Error processing messages for {phone_number} (attempt {attempt}, transient={transient}): {str(e)}", exc_info=True)
+        try:
+            if transient and not last_attempt:
+                # Un solo aviso aunque la cola reintente varias veces
+                if attempt == 1:
+                    await wp.send_text(phone_number, "⏳ Tuvimos un problema temporal, vuelvo a intentarlo en unos segundos.")
+            else:
+                await wp.send_text(phone_number, "❌ Ocurrió un error procesando tu mensaje. Intenta de nuevo.")
+        except:
+            pass
+        if transient:
+            raise
 
 
-def download_image_from_whatsapp(media_id: str) -> bytes:
+async def run_agent(state: State, phone_number: str) -> State:
     """
-    Descarga una imagen de WhatsApp usando el media ID.
-    
-    Para Cloud API, la descarga es en dos pasos:
-    1. GET https://graph.facebook.com/v20.0/{MEDIA_ID} (sin phone_number_id)
-    2. Descargar desde la URL que viene en la respuesta
-    
-    Las URLs de media de WhatsApp expiran rápidamente (típicamente después de 5 minutos),
-    así que esta función debe llamarse lo antes posible después de recibir el mensaje.
-    
-    Args:
-        media_id: ID del media en WhatsApp
-    
-    Returns:
-        bytes: Contenido de la imagen
+    Ejecuta el graph en modo stream y devuelve el estado final.
     
-    Raises:
-        requests.exceptions.HTTPError: Si hay un error HTTP (400, 404, etc.)
-        ValueError: Si no se puede obtener la URL del media
+    Las variantes que emite txt_to_img (stream "custom") se envían en paralelo apenas
+    llegan, sin esperar a que termine el resto: el usuario ve la primera opción en el
+    tiempo de una sola imagen.
     """
-    # Paso 1: Obtener la URL privada del medio
-    # Para Cloud API, NO se usa phone_number_id en el path
-    url = f"{wp.base_url}/{media_id}"
-    headers = {"Authorization": f"Bearer {wp.token}"}
-    
-    logger.info(f"Downloading image {media_id}")
-    
-    # Obtener la URL temporal del media con timeout corto
-    # Las URLs expiran rápido, así que descargamos inmediatamente
-    response = requests.get(url, headers=headers, timeout=10)
-    
-    if response.status_code != 200:
-        logger.error(f"Media API error (status {response.status_code}): {response.text}")
-    
-    response.raise_for_status()
-    
-    media_info = response.json()
-    media_url = media_info.get("url")
-    mime_type = media_info.get("mime_type")
-    
-    if not media_url:
-        error_detail = media_info.get("error", {}).get("message", "Unknown error")
-        logger.error(f"No media URL in response: {error_detail}")
-        raise ValueError(f"No se pudo obtener la URL del media: {error_detail}")
-    
-    logger.info(f"Obtained media URL (mime_type: {mime_type}), downloading...")
-    
-    # Paso 2: Descargar el binario usando esa URL
-    # La URL expira; siempre pedirla y descargar enseguida
-    image_response = requests.get(media_url, headers=headers, stream=True, timeout=30)
-    image_response.raise_for_status()
-    
-    logger.info(f"Image downloaded, size: {len(image_response.content)} bytes")
-    
-    return image_response.content
+    agent = await get_agent()
+    sends: List[asyncio.Task] = []
+    final_state = state
+    notified_progress = False
+    async for mode, chunk in agent.astream(state, thread_config(phone_number), stream_mode=["custom", "values"]):
+        if mode == "values":
+            final_state = chunk
+        elif mode == "custom" and "variant" in chunk:
+            caption = f"Opción {chunk['index']}/{chunk['total']}"
+            sends.append(asyncio.create_task(send_image_ref(phone_number, chunk["variant"], caption=caption)))
+        elif mode == "custom" and chunk.get("status") == "in_progress" and not notified_progress:
+            # Un solo aviso por turno, aunque haya varios jobs (variantes)
+            notified_progress = True
+            sends.append(asyncio.create_task(
+                wp.send_text(phone_number, "🎨 Generando tu imagen...", priority=PRIORITY_PROGRESS)
+            ))
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Error sending streamed update to {phone_number}: {result}")
+    return final_state
+
+async def notify_queue_position(phone_number: str, position: int) -> None:
+    """Hook del scheduler de fal.ai: avisa al usuario que su imagen está en la fila"""
+    if phone_number:
+        await wp.send_text(phone_number, f"⏳ Hay mucha demanda en este momento: estás #{position} en la fila. ¡Ya casi!", priority=PRIORITY_PROGRESS)
+
+fal_scheduler.on_queued = notify_queue_position
 
-def send_assistant_responses(state: State, phone_number: str, count: int = 0) -> None:
+async def send_assistant_responses(state: State, phone_number: str, count: int = 0) -> None:
     """
     Envía las respuestas del asistente basadas en los mensajes AI en el estado.
     
@@ -361,33 +381,75 @@ def send_assistant_responses(state: State, phone_number: str, count: int = 0) ->
         for message in reversed(last_ai_messages):
             if message and message.content:
                 # Enviar el mensaje del asistente
-                wp.send_text(phone_number, message.content)
+                await wp.send_text(phone_number, message.content)
         
         # Si hay una imagen generada, enviarla también (una sola vez)
         if state.get("generated_image"):
             try:
-                # Guardar la imagen en un archivo temporal
-                pil_image: Image.Image = state["generated_image"]
-                tmp_file = None
-                try:
-                    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-                    pil_image.save(tmp_file.name, format='PNG')
-                    tmp_file.close()  # Cerrar explícitamente antes de subir
-                    
-                    # Subir y enviar la imagen
-                    media_id = wp.upload_media(tmp_file.name, mime_type='image/png')
-                    wp.send_image(phone_number, media_id=media_id)
-                    logger.info(f"Image sent successfully to {phone_number}")
-                finally:
-                    # Limpiar el archivo temporal
-                    if tmp_file:
-                        os.unlink(tmp_file.name)
-                    # Resetear generated_image después de enviarla
-                    state["generated_image"] = None
+                await send_image_ref(phone_number, state["generated_image"], progressive=PROGRESSIVE_DELIVERY)
+                logger.info(f"Image sent successfully to {phone_number}")
             except Exception as e:
                 logger.error(f"Error sending image: {str(e)}", exc_info=True)
-                # Asegurarse de resetear even si hay error
+            finally:
+                # Resetear generated_image después de enviarla (o si hubo error)
                 state["generated_image"] = None
         
     except Exception as e:
         logger.error(f"Error sending assistant responses: {str(e)}", exc_info=True)
+
+# Formatos y tamaño máximo que WhatsApp acepta para mensajes de tipo imagen
+WHATSAPP_IMAGE_MIME_TYPES = {"image/jpeg", "image/png"}
+WHATSAPP_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+
+# Entrega progresiva: primero una vista previa liviana, después la imagen completa
+PROGRESSIVE_DELIVERY = os.getenv("PROGRESSIVE_DELIVERY", "0") == "1"
+# Imágenes que WhatsApp trae por URL y pesan menos que esto llegan tan rápido como una vista previa
+PREVIEW_MIN_BYTES = int(os.getenv("PREVIEW_MIN_BYTES", str(512 * 1024)))
+
+def _is_url_deliverable(image_ref: ImageRef) -> bool:
+    """True si WhatsApp puede traer la imagen directo desde su URL"""
+    if not image_ref.url_valid or not image_ref.url.startswith("https://"):
+        return False
+    if image_ref.mime_type not in WHATSAPP_IMAGE_MIME_TYPES:
+        return False
+    # size 0 = desconocido: se intenta igual y, si falla, se cae a la subida
+    return image_ref.size <= WHATSAPP_IMAGE_MAX_BYTES
+
+async def send_image_ref(
+    phone_number: str, image_ref: ImageRef, caption: Optional[str] = None, progressive: bool = False
+) -> None:
+    """
+    Envía una imagen por WhatsApp con la menor cantidad de transferencias posible.
+    
+    Si la imagen tiene una URL pública apta (resultado de fal.ai), se envía por link:
+    WhatsApp la descarga directo de fal.ai y nosotros no movemos ni un byte.
+    Si no, se descarga (si hace falta) y se sube desde memoria, re-codificada según OUTPUT_FORMAT.
+    
+    Con `progressive`, antes se envía una vista previa JPEG chica: el usuario ve el
+    resultado mientras viaja la versión completa.
+    """
+    data: Optional[bytes] = None
+    if progressive and (not _is_url_deliverable(image_ref) or not image_ref.size or image_ref.size > PREVIEW_MIN_BYTES):
+        try:
+            data = await image_ref.aread_bytes()
+            preview, mime_type = await aencode_preview(data)
+            media_id = await wp.upload_media(preview, mime_type=mime_type)
+            await wp.send_image(
+                phone_number, media_id=media_id, caption="⚡ Vista previa, ya llega en alta calidad", priority=PRIORITY_PROGRESS
+            )
+        except Exception as e:
+            logger.warning(f"Could not send preview to {phone_number}: {e}")
+    
+    if _is_url_deliverable(image_ref):
+        try:
+            await wp.send_image(phone_number, image_url=image_ref.url, caption=caption)
+            return
+        except Exception as e:
+            logger.warning(f"Sending image by URL failed, falling back to upload: {e}")
+    
+    # Se sube desde memoria, re-codificada (JPEG por defecto) y dentro del límite de WhatsApp
+    if data is None:
+        data = await image_ref.aread_bytes()
+    data, mime_type = await aencode_for_whatsapp(data, image_ref.mime_type)
+    media_id = await wp.upload_media(data, mime_type=mime_type)
+    await wp.send_image(phone_number, media_id=media_id, caption=caption)
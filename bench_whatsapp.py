@@ -0,0 +1,103 @@
+"""
+Compara Whatsapp (requests, una conexión nueva por llamada) con AsyncWhatsapp (pool
+compartido con keep-alive) enviando textos contra mock_graph_api.py.
+
+    uvicorn mock_graph_api:app --port 9000
+    python bench_whatsapp.py --url http://127.0.0.1:9000 --messages 500 --concurrency 20
+
+Para cada cliente informa la latencia por envío (p50/p95), el CPU del proceso
+(time.process_time, incluye los handshakes) y las conexiones TCP nuevas que vio el
+mock. Contra graph.facebook.com cada conexión nueva suma además el handshake TLS.
+"""
+import os
+import time
+import asyncio
+import argparse
+from typing import Any, Callable, Dict, List
+
+import requests
+
+BENCH_TOKEN = "bench-token"
+BENCH_PHONE_NUMBER_ID = "1234567890"
+BENCH_RECIPIENT = "5491100000000"
+
+
+def _connections(url: str) -> int:
+    return requests.get(f"{url}/_mock/stats", timeout=5).json()["connections"]
+
+
+def _summary(name: str, latencies: List[float], cpu: float, wall: float, connections: int) -> Dict[str, Any]:
+    ordered = sorted(latencies)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "client": name,
+        "messages": len(ordered),
+        "p50_ms": round(pick(0.5) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "cpu_seconds": round(cpu, 3),
+        "wall_seconds": round(wall, 3),
+        "new_connections": connections,
+    }
+
+
+def _measure(url: str, name: str, run: Callable[[List[float]], None]) -> Dict[str, Any]:
+    latencies: List[float] = []
+    connections_before = _connections(url)
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    run(latencies)
+    cpu, wall = time.process_time() - cpu_started, time.perf_counter() - wall_started
+    return _summary(name, latencies, cpu, wall, _connections(url) - connections_before)
+
+
+def bench_sync(messages: int) -> Callable[[List[float]], None]:
+    from whatsapp import Whatsapp
+
+    def run(latencies: List[float]) -> None:
+        client = Whatsapp(BENCH_TOKEN, BENCH_PHONE_NUMBER_ID)
+        for i in range(messages):
+            started = time.perf_counter()
+            client.send_text(BENCH_RECIPIENT, f"bench sync {i}")
+            latencies.append(time.perf_counter() - started)
+
+    return run
+
+
+def bench_async(messages: int, concurrency: int) -> Callable[[List[float]], None]:
+    from whatsapp import AsyncWhatsapp
+
+    async def main(latencies: List[float]) -> None:
+        client = AsyncWhatsapp(BENCH_TOKEN, BENCH_PHONE_NUMBER_ID)
+        # Sin pacing: se mide el transporte, no el límite de throughput de Meta
+        client.send_rate = 0
+        limit = asyncio.Semaphore(concurrency)
+
+        async def send(i: int) -> None:
+            async with limit:
+                started = time.perf_counter()
+                await client.send_text(BENCH_RECIPIENT, f"bench async {i}")
+                latencies.append(time.perf_counter() - started)
+
+        try:
+            await asyncio.gather(*(send(i) for i in range(messages)))
+        finally:
+            await AsyncWhatsapp.aclose()
+
+    return lambda latencies: asyncio.run(main(latencies))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=os.getenv("WHATSAPP_API_BASE_URL", "http://127.0.0.1:9000"))
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ["WHATSAPP_API_BASE_URL"] = args.url
+    results = [
+        _measure(args.url, "Whatsapp", bench_sync(args.messages)),
+        _measure(args.url, "AsyncWhatsapp", bench_async(args.messages, args.concurrency)),
+    ]
+    columns = list(results[0])
+    print("  ".join(f"{column:>15}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>15}" for column in columns))
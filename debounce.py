@@ -0,0 +1,55 @@
+"""
+Ventana de coalescencia por número antes de correr el graph.
+
+Un usuario que manda tres fotos y un caption seguidos disparaba varias corridas del
+graph (cada una con sus llamadas a Gemini y respuestas parciales del tipo "¿ya
+mandaste todas las imágenes?"). Ahora los mensajes de un número se juntan hasta que
+pasan DEBOUNCE_QUIET_MS sin mensajes nuevos, con un tope de DEBOUNCE_MAX_MS desde
+el primero, y la ráfaga entra en una sola corrida.
+
+La ventana se aplica en IngestQueue.claim: un número no se reclama hasta que cierra.
+"""
+import os
+import threading
+from typing import Any, Dict
+
+# 0 desactiva la ventana
+DEBOUNCE_QUIET_MS = int(os.getenv("DEBOUNCE_QUIET_MS", "1200"))
+DEBOUNCE_MAX_MS = int(os.getenv("DEBOUNCE_MAX_MS", "5000"))
+
+
+class CoalescingStats:
+    """Corridas del graph y llamadas al LLM que se ahorraron al juntar mensajes"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.messages = 0
+        self.max_batch = 0
+
+    def record_run(self, messages: int) -> None:
+        """Una corrida del graph que consumió `messages` mensajes procesables"""
+        with self._lock:
+            self.runs += 1
+            self.messages += messages
+            self.max_batch = max(self.max_batch, messages)
+
+    def stats(self, llm_calls: int = 0) -> Dict[str, Any]:
+        """`llm_calls`: llamadas al LLM hechas por el graph en total (context_stats.calls)"""
+        with self._lock:
+            # Sin la ventana cada mensaje habría sido su propia corrida
+            runs_saved = self.messages - self.runs
+            calls_per_run = llm_calls / self.runs if self.runs else 0.0
+            return {
+                "quiet_ms": DEBOUNCE_QUIET_MS,
+                "max_ms": DEBOUNCE_MAX_MS,
+                "graph_runs": self.runs,
+                "messages": self.messages,
+                "max_batch": self.max_batch,
+                "graph_runs_saved": runs_saved,
+                "avg_llm_calls_per_run": round(calls_per_run, 2),
+                "estimated_llm_calls_saved": round(runs_saved * calls_per_run),
+            }
+
+
+coalescing_stats = CoalescingStats()
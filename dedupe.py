@@ -0,0 +1,73 @@
+"""
+Índice de deduplicación de mensajes de WhatsApp por `id`.
+
+Meta reenvía las notificaciones del webhook cuando tardamos en responder; sin este
+índice cada reentrega dispara otra llamada a Gemini y otra generación paga en fal.ai.
+
+La fuente de verdad es la tabla `seen_messages` de la cola de ingesta: el id se marca
+en la misma transacción que encola el mensaje (IngestQueue.append), así sobrevive
+reinicios, se comparte entre procesos y un crash entre "visto" y "encolado" no puede
+perder el mensaje. Este módulo es solo un LRU en memoria con TTL delante de esa tabla,
+que ahorra la escritura en SQLite para las reentregas más frecuentes; un id entra al
+LRU recién cuando quedó encolado.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "100000"))
+DEFAULT_TTL = float(os.getenv("DEDUPE_TTL_SECONDS", str(24 * 3600)))
+
+
+class MessageDeduplicator:
+    """LRU + TTL en memoria de ids de mensaje ya encolados"""
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self.ttl = ttl or DEFAULT_TTL
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def seen(self, message_id: str) -> bool:
+        """True si el id ya se encoló dentro del TTL (es una reentrega)"""
+        now = time.time()
+        with self._lock:
+            seen_at = self._seen.get(message_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen.move_to_end(message_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def mark(self, message_id: str) -> None:
+        """Recuerda un id que ya quedó persistido (o que la cola reportó como duplicado)"""
+        with self._lock:
+            self._seen[message_id] = time.time()
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._seen),
+            }
+
+
+# Instancia compartida por el webhook
+message_dedupe = MessageDeduplicator()
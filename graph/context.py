@@ -0,0 +1,144 @@
+import os
+import time
+import logging
+from typing import Any, Dict, List
+from langchain.messages import AnyMessage, HumanMessage, SystemMessage
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+from langchain_core.runnables import ensure_config
+from langchain_core.runnables.config import merge_configs
+from .tools import State, gemini
+from .llm_cache import CachedAgent
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto de tokens para la historia que se manda en cada llamada al LLM
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+# Mensajes recientes que siempre se conservan textuales al compactar
+CONTEXT_KEEP_MESSAGES = int(os.getenv("CONTEXT_KEEP_MESSAGES", "12"))
+
+
+def estimate_tokens(messages: List[AnyMessage]) -> int:
+    """Estimación barata de tokens (~4 caracteres por token), sin tokenizer"""
+    return sum(len(str(message.content)) for message in messages) // 4
+
+
+class ContextStats:
+    """Tokens de prompt y latencia por llamada, y trabajo de compactación"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.max_prompt_tokens = 0
+        self.trimmed_tokens = 0
+        self.llm_seconds = 0.0
+        self.summaries = 0
+        self.summary_seconds = 0.0
+        self.compacted_messages = 0
+
+    def record_call(self, node: str, tokens: int, trimmed: int, elapsed: float) -> None:
+        self.calls += 1
+        self.prompt_tokens += tokens
+        self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+        self.trimmed_tokens += trimmed
+        self.llm_seconds += elapsed
+        logger.info(f"llm {node}: ~{tokens} prompt tokens ({trimmed} trimmed) in {elapsed:.2f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "avg_prompt_tokens": self.prompt_tokens // self.calls if self.calls else 0,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "trimmed_tokens": self.trimmed_tokens,
+            "avg_llm_seconds": round(self.llm_seconds / self.calls, 3) if self.calls else 0.0,
+            "summaries": self.summaries,
+            "avg_summary_seconds": round(self.summary_seconds / self.summaries, 3) if self.summaries else 0.0,
+            "compacted_messages": self.compacted_messages,
+        }
+
+
+context_stats = ContextStats()
+
+
+def build_prompt(system: SystemMessage, state: State, max_tokens: int = CONTEXT_MAX_TOKENS) -> List[AnyMessage]:
+    """
+    Arma el prompt de una llamada: system + resumen + los mensajes más recientes
+    que entren en el presupuesto. El último mensaje siempre va, aunque no entre.
+    """
+    prefix: List[AnyMessage] = [system]
+    if state.get("summary"):
+        prefix.append(SystemMessage(content=f"Summary of the earlier conversation:\n{state['summary']}"))
+
+    budget = max_tokens - estimate_tokens(prefix)
+    window: List[AnyMessage] = []
+    for message in reversed(state["messages"]):
+        cost = estimate_tokens([message])
+        if window and cost > budget:
+            break
+        window.append(message)
+        budget -= cost
+    window.reverse()
+    return prefix + window
+
+
+async def invoke_with_context(runnable: Any, node: str, system: SystemMessage, state: State) -> Any:
+    """ainvoke con la ventana de contexto acotada, midiendo tokens y latencia"""
+    prompt = build_prompt(system, state)
+    tokens = estimate_tokens(prompt)
+    kept = len(prompt) - (2 if state.get("summary") else 1)
+    trimmed = estimate_tokens(state["messages"][:len(state["messages"]) - kept])
+    started = time.perf_counter()
+    # El callback junta los tokens reales que reporta Gemini (el structured output no los devuelve)
+    usage = UsageMetadataCallbackHandler()
+    with tracing.span(f"llm.{node}", prompt_tokens_estimate=tokens, trimmed_tokens=trimmed) as llm_span:
+        config = merge_configs(ensure_config(), {"callbacks": [usage]})
+        # Los agentes cacheados arman la clave con el último turno y el estado del nodo
+        if isinstance(runnable, CachedAgent):
+            response = await runnable.ainvoke(prompt, config, state=state)
+        else:
+            response = await runnable.ainvoke(prompt, config)
+        for model, model_usage in usage.usage_metadata.items():
+            llm_span.set_attributes(
+                model=model, input_tokens=model_usage.get("input_tokens"), output_tokens=model_usage.get("output_tokens")
+            )
+    context_stats.record_call(node, tokens, trimmed, time.perf_counter() - started)
+    return response
+
+
+async def compact_history(state: State) -> State:
+    """
+    Si la historia supera el presupuesto, resume los mensajes viejos en
+    state["summary"] (actualizándolo de forma incremental) y los saca del estado.
+    Se llama después de responder, así el resumen no suma latencia al usuario.
+    """
+    messages = state["messages"]
+    if len(messages) <= CONTEXT_KEEP_MESSAGES or estimate_tokens(messages) <= CONTEXT_MAX_TOKENS:
+        return state
+
+    old, recent = messages[:-CONTEXT_KEEP_MESSAGES], messages[-CONTEXT_KEEP_MESSAGES:]
+    transcript = "\n".join(f"{message.type}: {message.content}" for message in old)
+    started = time.perf_counter()
+    try:
+        with tracing.span("llm.summary", compacted_messages=len(old)) as summary_span:
+            response = await gemini.ainvoke([
+                SystemMessage(content="""
+            You keep the running summary of a WhatsApp chat between a user and an image generation/editing agent.
+            Update the summary with the new messages. Keep what matters to continue the conversation: what the user wants,
+            prompts used, images sent (how many and what they show) and pending questions. Be brief, max 150 words.
+            """),
+                HumanMessage(content=f"Current summary:\n{state.get('summary') or '(empty)'}\n\nNew messages:\n{transcript}"),
+            ])
+            usage = getattr(response, "usage_metadata", None) or {}
+            summary_span.set_attributes(input_tokens=usage.get("input_tokens"), output_tokens=usage.get("output_tokens"))
+    except Exception as e:
+        # Sin resumen se sigue con la historia completa; build_prompt igual la recorta
+        logger.error(f"Error summarizing conversation: {e}")
+        return state
+
+    context_stats.summaries += 1
+    context_stats.summary_seconds += time.perf_counter() - started
+    context_stats.compacted_messages += len(old)
+    state["summary"] = response.content
+    state["messages"] = recent
+    logger.info(f"compacted {len(old)} messages into the summary")
+    return state
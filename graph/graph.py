@@ -1,7 +1,14 @@
+import os
+import asyncio
+import aiosqlite
 from graph.nodes import triage, txt_to_img, img_to_img
 from graph.tools import State
-from typing import Literal
+from typing import Literal, Optional
 from langgraph.graph import StateGraph, START, END
+from langgraph.graph.state import CompiledStateGraph
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from session_store import SESSION_STORE
 
 graph = StateGraph(State)
 
@@ -39,4 +46,49 @@ graph.add_conditional_edges(
     ["triage", END]
 )
 
-agent = graph.compile()
\ No newline at end of file
+# Graph sin persistencia (útil para pruebas interactivas, ver test_graph.ipynb)
+agent = graph.compile()
+
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "data/checkpoints.sqlite")
+
+_checkpointed_agent: Optional[CompiledStateGraph] = None
+_agent_lock = asyncio.Lock()
+
+async def get_agent() -> CompiledStateGraph:
+    """
+    Devuelve el graph compilado con un checkpointer SQLite compartido.
+    
+    El estado de cada conversación se guarda con thread_id = número de teléfono,
+    así cualquier proceso worker puede retomar cualquier conversación. Se compila
+    de forma diferida porque AsyncSqliteSaver necesita un event loop corriendo.
+    
+    Con SESSION_STORE=memory o sqlite las sesiones viven en ese almacén: se devuelve
+    el graph sin checkpointer, así no se abre ni se llena checkpoints.sqlite.
+    """
+    global _checkpointed_agent
+    if SESSION_STORE != "checkpoint":
+        return agent
+    async with _agent_lock:
+        if _checkpointed_agent is None:
+            directory = os.path.dirname(CHECKPOINT_DB_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            checkpointer = AsyncSqliteSaver(
+                aiosqlite.connect(CHECKPOINT_DB_PATH),
+                # Las imágenes viajan como ImageRef: se permite explícitamente su deserialización
+                serde=JsonPlusSerializer(allowed_msgpack_modules=[("graph.images", "ImageRef")]),
+            )
+            _checkpointed_agent = graph.compile(checkpointer=checkpointer)
+        return _checkpointed_agent
+
+async def close_agent() -> None:
+    """Cierra la conexión del checkpointer (su thread impide que el proceso termine)"""
+    global _checkpointed_agent
+    async with _agent_lock:
+        if _checkpointed_agent is not None:
+            await _checkpointed_agent.checkpointer.conn.close()
+            _checkpointed_agent = None
+
+def thread_config(phone_number: str) -> dict:
+    """Config de LangGraph para la conversación de un número"""
+    return {"configurable": {"thread_id": phone_number}}
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import mmap
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import uuid
+import httpx
+from dataclasses import dataclass, replace
+from io import BytesIO
+from typing import Any, AsyncIterator, Dict, Optional
+from PIL import Image
+import tracing
+from imaging import anormalize_image
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOB_DIR = os.getenv("IMAGE_STORE_PATH", "data/blobs")
+
+
+# Cliente HTTP compartido para traer imágenes remotas (resultados de fal.ai) con keep-alive
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+    return _http_client
+
+async def close_http_client() -> None:
+    """Cierra el pool de descargas (llamar al apagar, junto con close_agent)"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+@dataclass(frozen=True)
+class ImageRef:
+    """
+    Handle liviano a una imagen comprimida.
+    
+    Es lo único que viaja en el estado del graph: los bytes se leen con
+    read_bytes()/aread_bytes() solo cuando realmente hacen falta.
+    
+    Puede apuntar a bytes locales del ImageStore (digest), a una URL remota
+    (por ejemplo el resultado de fal.ai, sin descargarlo) o a ambos.
+    """
+    digest: str = ""
+    mime_type: str = "image/png"
+    size: int = 0
+    url: Optional[str] = None
+    # Vencimiento conocido de la URL (epoch); 0 = sin vencimiento conocido
+    expires_at: float = 0.0
+
+    @property
+    def url_valid(self) -> bool:
+        return bool(self.url) and (not self.expires_at or self.expires_at > time.time())
+
+    @property
+    def is_local(self) -> bool:
+        return bool(self.digest)
+
+    def read_bytes(self) -> bytes:
+        return image_store.read_bytes(self)
+
+    async def aread_bytes(self) -> bytes:
+        return await image_store.aread_bytes(self)
+
+
+def sniff_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """Detecta el formato leyendo solo el header (no decodifica los pixeles)"""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            return Image.MIME.get(image.format, default)
+    except Exception:
+        return default
+
+
+class ImageStore:
+    """
+    Blob store en disco direccionado por el SHA-256 del contenido.
+    
+    - Subidas idénticas se guardan una sola vez (dedupe por digest).
+    - Solo guarda bytes comprimidos (JPEG/PNG/WebP tal como llegan o salen de fal.ai).
+    - Las lecturas usan mmap, así el page cache del sistema se comparte entre procesos.
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = root or DEFAULT_BLOB_DIR
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.puts = 0
+        self.dedup_hits = 0
+        self.bytes_written = 0
+        self.remote_fetches = 0
+        self.normalized = 0
+        self.normalize_cache_hits = 0
+        self.normalize_bytes_in = 0
+        self.normalize_bytes_out = 0
+
+    def path(self, ref: ImageRef) -> str:
+        return self._path(ref.digest)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put_bytes(self, data: bytes, mime_type: Optional[str] = None) -> ImageRef:
+        """Guarda bytes ya codificados y devuelve su referencia"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        with self._lock:
+            self.puts += 1
+        if os.path.exists(path):
+            with self._lock:
+                self.dedup_hits += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Escritura atómica: otro proceso nunca ve un archivo a medio escribir
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.bytes_written += len(data)
+        return ImageRef(digest=digest, mime_type=mime_type or sniff_mime_type(data), size=len(data))
+
+    def _alias_path(self, raw_digest: str) -> str:
+        return os.path.join(self.root, "normalized", raw_digest[:2], raw_digest)
+
+    def _normalized_alias(self, raw_digest: str) -> Optional[ImageRef]:
+        """Versión normalizada ya guardada de unos bytes originales (compartida entre procesos)"""
+        try:
+            with open(self._alias_path(raw_digest)) as f:
+                digest, mime_type, size = f.read().split()
+        except (OSError, ValueError):
+            return None
+        ref = ImageRef(digest=digest, mime_type=mime_type, size=int(size))
+        return ref if self.exists(ref) else None
+
+    def _save_alias(self, raw_digest: str, ref: ImageRef) -> None:
+        path = self._alias_path(raw_digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{ref.digest} {ref.mime_type} {ref.size}")
+        os.replace(tmp_path, path)
+
+    def exists(self, ref: ImageRef) -> bool:
+        return ref.is_local and os.path.exists(self._path(ref.digest))
+
+    def _require_local(self, ref: ImageRef) -> None:
+        if not ref.is_local:
+            raise ValueError("Remote-only ImageRef: fetch it first with aensure_local()")
+
+    def read_bytes(self, ref: ImageRef) -> bytes:
+        self._require_local(ref)
+        with open(self._path(ref.digest), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+
+    # Versiones async: el I/O de disco va a un thread
+    async def aput_bytes(self, data: bytes, mime_type: Optional[str] = None) -> ImageRef:
+        return await asyncio.to_thread(self.put_bytes, data, mime_type)
+
+    async def aput_normalized(self, data: bytes, mime_type: Optional[str] = None) -> ImageRef:
+        """
+        Guarda una foto entrante ya normalizada (EXIF, tamaño máximo, re-encode).
+        
+        La normalización corre en el pool de procesos y se hace una sola vez por
+        contenido: la misma foto reenviada reutiliza la versión guardada.
+        """
+        raw_digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        cached = await self._acached_normalized(raw_digest)
+        if cached is not None:
+            return cached
+        return await self._astore_normalized(raw_digest, data, mime_type)
+
+    async def aput_normalized_stream(self, chunks: AsyncIterator[bytes], mime_type: Optional[str] = None) -> ImageRef:
+        """
+        Como aput_normalized, pero consumiendo una descarga en streaming.
+        
+        Los chunks van a un archivo temporal mientras se calcula el digest, así la foto
+        original nunca entra al store y, si ya estaba normalizada, ni se lee a memoria.
+        Si el iterador falla (por ejemplo por superar un límite de tamaño) no queda nada.
+        """
+        incoming = os.path.join(self.root, "incoming")
+        os.makedirs(incoming, exist_ok=True)
+        tmp_path = os.path.join(incoming, f"{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        hasher = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    hasher.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            raw_digest = hasher.hexdigest()
+            cached = await self._acached_normalized(raw_digest)
+            if cached is not None:
+                return cached
+            with open(tmp_path, "rb") as f:
+                data = await asyncio.to_thread(f.read)
+            return await self._astore_normalized(raw_digest, data, mime_type)
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    async def _acached_normalized(self, raw_digest: str) -> Optional[ImageRef]:
+        cached = await asyncio.to_thread(self._normalized_alias, raw_digest)
+        if cached is not None:
+            with self._lock:
+                self.normalize_cache_hits += 1
+        return cached
+
+    async def _astore_normalized(self, raw_digest: str, data: bytes, mime_type: Optional[str]) -> ImageRef:
+        normalized, normalized_mime = await anormalize_image(data, mime_type)
+        ref = await self.aput_bytes(normalized, normalized_mime)
+        await asyncio.to_thread(self._save_alias, raw_digest, ref)
+        with self._lock:
+            self.normalized += 1
+            self.normalize_bytes_in += len(data)
+            self.normalize_bytes_out += len(normalized)
+        return ref
+
+    async def aensure_local(self, ref: ImageRef) -> ImageRef:
+        """Descarga una imagen que solo existe como URL y la guarda (conserva la URL)"""
+        if ref.is_local:
+            return ref
+        if not ref.url:
+            raise ValueError("ImageRef has neither local bytes nor a URL")
+        with tracing.span("image.download", url_host=httpx.URL(ref.url).host) as download_span:
+            response = await get_http_client().get(ref.url)
+            response.raise_for_status()
+            download_span.set_attribute("bytes", len(response.content))
+        mime_type = response.headers.get("content-type", "").split(";")[0] or None
+        local = await self.aput_bytes(response.content, mime_type)
+        with self._lock:
+            self.remote_fetches += 1
+        return replace(local, url=ref.url, expires_at=ref.expires_at)
+
+    async def aread_bytes(self, ref: ImageRef) -> bytes:
+        ref = await self.aensure_local(ref)
+        return await asyncio.to_thread(self.read_bytes, ref)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "puts": self.puts,
+                "dedup_hits": self.dedup_hits,
+                "bytes_written": self.bytes_written,
+                "remote_fetches": self.remote_fetches,
+                "normalized": self.normalized,
+                "normalize_cache_hits": self.normalize_cache_hits,
+                "normalize_bytes_in": self.normalize_bytes_in,
+                "normalize_bytes_out": self.normalize_bytes_out,
+            }
+
+
+image_store = ImageStore()
@@ -0,0 +1,244 @@
+"""
+Cache de respuestas de los agentes de structured output (triage, prompt_reader, edit).
+
+Muchos intercambios son casi idénticos entre usuarios ("hola", "¿qué podés hacer?",
+"haceme una imagen"): la respuesta se reutiliza en microsegundos en lugar de otro
+round trip de 1-2 s a Gemini.
+
+La clave es el último turno, no toda la conversación (así no solo pegan los primeros
+mensajes): la última respuesta del asistente y lo que el usuario mandó después, más el
+system prompt y los campos del estado que lee el nodo (awaiting, user_last_prompt...).
+La respuesta del asistente va en la clave para que un "sí" o "dale" nunca reutilice la
+respuesta de otra conversación. Solo triage canonicaliza el texto (minúsculas, sin
+tildes ni puntuación): prompt_reader y edit devuelven un user_prompt copiado del
+mensaje, que con una clave canonicalizada le llegaría a otro usuario con las mayúsculas
+y tildes del primero. LRU + TTL en memoria y, opcionalmente, un segundo nivel en SQLite
+compartido entre procesos (LLM_CACHE_DB_PATH).
+"""
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel
+from langchain.messages import AIMessage, AnyMessage
+from tracing import set_attributes
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+DEFAULT_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+DEFAULT_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", "")
+
+
+def _canonical(text: str) -> str:
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def last_turn(messages: List[AnyMessage]) -> List[AnyMessage]:
+    """La última respuesta del asistente y todo lo que llegó después (texto e imágenes)"""
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], AIMessage):
+            return messages[index:]
+    return list(messages)
+
+
+def _state_value(value: Any) -> str:
+    """Los valores simples van tal cual; de listas e imágenes solo importa cuántas hay"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return f"len={len(value)}"
+    return "set"
+
+
+def cache_key(
+    name: str,
+    system: AnyMessage,
+    turn: List[AnyMessage],
+    state_fields: Dict[str, Any],
+    canonical: bool = False,
+) -> str:
+    """system prompt + campos del estado del nodo + último turno (canonicalizado solo si canonical)"""
+    text = _canonical if canonical else str
+    parts = [name, " ".join(str(system.content).split())]
+    parts += [f"{field}={_state_value(value)}" for field, value in sorted(state_fields.items())]
+    parts += [f"{message.type}:{text(message.content)}" for message in turn]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL de respuestas estructuradas, con respaldo opcional en SQLite"""
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL,
+        path: Optional[str] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[BaseModel, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self._miss_seconds = 0.0
+
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    @property
+    def persistent(self) -> bool:
+        return self._conn is not None
+
+    def get(self, key: str, schema: Type[BaseModel]) -> Optional[BaseModel]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, created_at = entry
+                if now - created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._record_hit()
+                    return response.model_copy(deep=True)
+                del self._entries[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_responses WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl),
+                ).fetchone()
+                if row is not None:
+                    response = schema.model_validate_json(row[0])
+                    self._remember(key, response, row[1])
+                    self.disk_hits += 1
+                    self._record_hit()
+                    return response.model_copy(deep=True)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: BaseModel, elapsed: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._miss_seconds += elapsed
+            self._remember(key, response.model_copy(deep=True), now)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_responses (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, response.model_dump_json(), now),
+                )
+                if self.misses % 1000 == 0:
+                    self._conn.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - self.ttl,))
+
+    def _record_hit(self) -> None:
+        self.hits += 1
+        # Cada hit se ahorra una llamada de duración promedio
+        if self.misses:
+            self.saved_seconds += self._miss_seconds / self.misses
+
+    def _remember(self, key: str, response: BaseModel, created_at: float) -> None:
+        self._entries[key] = (response, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "estimated_seconds_saved": round(self.saved_seconds, 1),
+                "persistent": self.persistent,
+            }
+
+
+response_cache = ResponseCache(path=DEFAULT_DB_PATH or None)
+
+
+class CachedAgent:
+    """
+    Envuelve un runnable de structured output; la interfaz ainvoke no cambia. Sin el
+    estado del graph (state=...) no hay forma de armar la clave y la llamada no se cachea.
+    """
+
+    def __init__(
+        self,
+        runnable: Any,
+        name: str,
+        schema: Type[BaseModel],
+        state_fields: Tuple[str, ...] = (),
+        canonical: bool = False,
+        cache: ResponseCache = response_cache,
+    ) -> None:
+        self.runnable = runnable
+        self.name = name
+        self.schema = schema
+        self.state_fields = state_fields
+        self.canonical = canonical
+        self.cache = cache
+
+    def key_for(self, messages: List[AnyMessage], state: Dict[str, Any]) -> str:
+        return cache_key(
+            self.name,
+            messages[0],
+            last_turn(state.get("messages") or messages[1:]),
+            {field: state.get(field) for field in self.state_fields},
+            canonical=self.canonical,
+        )
+
+    async def ainvoke(
+        self, messages: List[AnyMessage], *args: Any, state: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> Any:
+        if not LLM_CACHE_ENABLED or state is None:
+            return await self.runnable.ainvoke(messages, *args, **kwargs)
+
+        key = self.key_for(messages, state)
+        # La lectura puede tocar SQLite: fuera del event loop solo si hay disco
+        if self.cache.persistent:
+            cached = await asyncio.to_thread(self.cache.get, key, self.schema)
+        else:
+            cached = self.cache.get(key, self.schema)
+        if cached is not None:
+            logger.info(f"llm cache hit: {self.name}")
+            set_attributes(cache_hit=True)
+            return cached
+
+        started = time.perf_counter()
+        response = await self.runnable.ainvoke(messages, *args, **kwargs)
+        if isinstance(response, self.schema):
+            elapsed = time.perf_counter() - started
+            if self.cache.persistent:
+                await asyncio.to_thread(self.cache.put, key, response, elapsed)
+            else:
+                self.cache.put(key, response, elapsed)
+        return response
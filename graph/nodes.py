@@ -1,36 +1,97 @@
 import logging
+from langchain_core.runnables import RunnableConfig
+from langgraph.config import get_stream_writer
 from langchain.messages import AnyMessage, SystemMessage, AIMessage
-from typing import TypedDict, List, Optional, Literal
-from PIL import Image
-from .tools import State, triage_agent, edit_agent, prompt_reader_agent, nanoclient, gemini, TriageSO, PromptSO
+from typing import TypedDict, Dict, List, Optional, Literal
+from .tools import State, triage_agent, edit_agent, prompt_reader_agent, nanoclient, TriageSO, PromptSO, MAX_VARIANTS
+from .images import ImageRef
+from .router import conversation_language, route_message
+from .context import invoke_with_context
+from tracing import set_attributes, traced
 
 logger = logging.getLogger(__name__)
 
 
+# Respuestas fijas cuando el LLM no dejó completion_message, y para los errores:
+# así cada imagen cuesta una sola llamada a Gemini. Van en el idioma del usuario
+# (es / en / pt, ver router.conversation_language)
+GENERATED_REPLY = {
+    "es": "¡Listo! Acá está tu imagen 🎨✨ ¿Querés editarla o generar otra?",
+    "en": "Done! Here's your image 🎨✨ Want to edit it or create another one?",
+    "pt": "Pronto! Aqui está sua imagem 🎨✨ Quer editar ou gerar outra?",
+}
+EDITED_REPLY = {
+    "es": "¡Imagen editada! 😄 ¿Querés seguir ajustándola?",
+    "en": "Image edited! 😄 Want to keep tweaking it?",
+    "pt": "Imagem editada! 😄 Quer continuar ajustando?",
+}
+VARIANTS_REPLY = {
+    "es": "¡Listas tus opciones! 🎨 Decime el número de la que más te guste para seguir editándola.",
+    "en": "Your options are ready! 🎨 Tell me the number of your favorite to keep editing it.",
+    "pt": "Suas opções estão prontas! 🎨 Me diga o número da que mais gostou para continuar editando.",
+}
+GENERATION_ERROR_REPLY = {
+    "es": "Hubo un error generando la imagen 😓 ¿Probamos de nuevo?",
+    "en": "Something went wrong generating the image 😓 Shall we try again?",
+    "pt": "Houve um erro ao gerar a imagem 😓 Vamos tentar de novo?",
+}
+EDIT_ERROR_REPLY = {
+    "es": "Hubo un error editando la imagen 😓 ¿Probamos de nuevo?",
+    "en": "Something went wrong editing the image 😓 Shall we try again?",
+    "pt": "Houve um erro ao editar a imagem 😓 Vamos tentar de novo?",
+}
+
+
+def fixed_reply(state: State, replies: Dict[str, str]) -> str:
+    """La respuesta fija en el idioma en que viene escribiendo el usuario"""
+    return replies[conversation_language(state["messages"])]
+
+
+def thread_phone(config: Optional[RunnableConfig]) -> str:
+    """Número de teléfono de la conversación (thread_id del checkpointer)"""
+    return ((config or {}).get("configurable") or {}).get("thread_id") or ""
+
+
 def add_assistant_msg(state: State, content: str) -> List[dict[str: str]]:
     state["messages"] += [AIMessage(content=content)]
     return state
 
 
 #Triage Node
-def triage(state: State) -> State:
+@traced("node.triage")
+async def triage(state: State) -> State:
     """Routing/menu node"""
     logger.info("entrando a triage")
     if state["current_node"] != "triage":
         logger.info(f"yendo a {state['current_node']}")
         return state
 
+    # Pre-router determinístico: los casos obvios no necesitan una llamada a Gemini
+    decision = route_message(state)
+    set_attributes(router_fast_path=bool(decision.route or decision.reply), router_reason=decision.reason)
+    if decision.route:
+        state["current_node"] = decision.route
+        state["awaiting"] = None
+        logger.info(f"yendo a {state['current_node']}")
+        return state
+    if decision.reply:
+        state = add_assistant_msg(state, decision.reply)
+        state["awaiting"] = "feature"
+        return state
+
     if state["awaiting"] == "feature":
-        response: TriageSO = triage_agent.invoke(
-            [SystemMessage(content=""""
+        response: TriageSO = await invoke_with_context(
+            triage_agent, "triage",
+            SystemMessage(content=""""
             You are a fun AI Agent, expert in generating and editing images with nanobanana🍌. Your task is detect user intention.
             Explain what you can do 🎯 if user don't get it. 
             Actual features:
                 - generation of images from text
                 - editing images with natural language
                 - editing or generating images with more than one input image, example: generate an image of this person [image 1] happily showing this product [image 2].
-            """)]
-            + state["messages"]
+                - refining the last generated or edited image (e.g. "now make it darker"), that is img_to_img.
+            """),
+            state,
         )
         if response.interpreted_feature:
             state["current_node"] = response.interpreted_feature
@@ -40,16 +101,17 @@ def triage(state: State) -> State:
         state = add_assistant_msg(state, response.output)
         return state
 
-    response: TriageSO = triage_agent.invoke(
-        [SystemMessage(content=f""""
+    response: TriageSO = await invoke_with_context(
+        triage_agent, "triage",
+        SystemMessage(content=f""""
         You are a fun AI Agent, expert in generating and editing images with nanobanana🍌.
         Greet 👋 the user and explain what you can do 🎯. 
         Actual features:
             - generation of images from text
             - editing images with natural language
             - editing or generating images with more than one input image
-        """)]
-        + state["messages"]
+        """),
+        state,
     )
     if response.interpreted_feature:
         state["current_node"] = response.interpreted_feature
@@ -64,16 +126,20 @@ def triage(state: State) -> State:
     return state
 
 #txt_to_img Node
-def txt_to_img(state: State):
+@traced("node.txt_to_img")
+async def txt_to_img(state: State, config: RunnableConfig):
     """Process user request to generate an image with text only"""
     logger.info("estamos en a text to image")
 
-    response = prompt_reader_agent.invoke(
-        [SystemMessage(content="""
+    response = await invoke_with_context(
+        prompt_reader_agent, "txt_to_img",
+        SystemMessage(content="""
         You are a fun AI Agent, expert in generating and editing images with nanobanana🍌. Now in txt_to_img feature ✍ -> 📷.
         If user provide a prompt, rewrite it just correcting prossible typos, not modify anything else. Use 'output' to ask for a prompt, clarify the actual one or explain something to the user.
-        """)]
-        + state["messages"]
+        Together with user_prompt, fill out completion_message: the short message the user will receive with the image.
+        If the user asks for options or variants to choose from, set variants (up to 4).
+        """),
+        state,
     )
 
     if response.other_feature:
@@ -86,23 +152,21 @@ def txt_to_img(state: State):
         state["user_last_prompt"] = response.user_prompt
         state["awaiting"] = None
         try:
-            image = nanoclient.generate_image(state["user_last_prompt"])
-            response = gemini.invoke(
-                [SystemMessage(content="User image was generated")]
-                + state["messages"]
+            if (response.variants or 1) > 1:
+                return await _generate_variants(state, response, config)
+            image_ref = await nanoclient.generate_image(
+                state["user_last_prompt"], bypass_cache=bool(response.regenerate), user=thread_phone(config)
             )
-            state["messages"].append(response)
-            state["generated_image"] = image
+            state = add_assistant_msg(state, response.completion_message or fixed_reply(state, GENERATED_REPLY))
+            state["generated_image"] = image_ref
+            state["last_output"] = image_ref
+            state["last_variants"] = []
             state["current_node"] = "triage"
             state["awaiting"] = "feature"
             return state
         except Exception as e:
             logger.error(f"Error generating image: {e}")
-            response = gemini.invoke(
-                [SystemMessage(content="There was an error generating the image")]
-                + state["messages"]
-            )
-            state["messages"].append(response)
+            state = add_assistant_msg(state, fixed_reply(state, GENERATION_ERROR_REPLY))
             state["current_node"] = "triage"
             state["awaiting"] = "feature"
             return state
@@ -111,21 +175,53 @@ def txt_to_img(state: State):
     return state
 
 
+async def _generate_variants(state: State, response: PromptSO, config: RunnableConfig) -> State:
+    """
+    Genera varias opciones y emite cada una por el stream "custom" del graph apenas
+    termina: background_processor la envía en el momento, sin esperar a las demás.
+    """
+    writer = get_stream_writer()
+    # Mismo tope que generate_variants, para que el "Opción i/N" coincida con lo que se genera
+    total = max(1, min(response.variants, MAX_VARIANTS))
+    variants: List[ImageRef] = []
+    async for image_ref in nanoclient.generate_variants(state["user_last_prompt"], total, user=thread_phone(config)):
+        variants.append(image_ref)
+        writer({"variant": image_ref, "index": len(variants), "total": total})
+    if not variants:
+        # Ej.: modo batch y fal.ai respondió sin imágenes
+        logger.error("Variant generation returned no images")
+        state = add_assistant_msg(state, fixed_reply(state, GENERATION_ERROR_REPLY))
+        state["current_node"] = "triage"
+        state["awaiting"] = "feature"
+        return state
+    state = add_assistant_msg(state, response.completion_message or fixed_reply(state, VARIANTS_REPLY))
+    state["last_variants"] = variants
+    state["last_output"] = variants[0]
+    state["current_node"] = "triage"
+    state["awaiting"] = "feature"
+    return state
+
+
 #img_to_img Node
-def img_to_img(state: State):
+@traced("node.img_to_img")
+async def img_to_img(state: State, config: RunnableConfig):
     """Process user request to edit an image with a prompt"""
     logger.info(f"estamos en image to image")
 
-    response = edit_agent.invoke(
-        [SystemMessage(content=f"""
+    response = await invoke_with_context(
+        edit_agent, "img_to_img",
+        SystemMessage(content=f"""
         You are a fun AI Agent, expert in generating and editing images with nanobanana🍌. Now in img_to_img feature ✍ -> 📷.
         Use the 'output' to ask the user if they have already sent all their images or if the request is not understood, ALWAYS BEFORE filling out user_prompt or images_to_edit.
         DON'T FILL OUT user_prompt or images_to_edit IF THE USER HASN'T SENT ALL THEIR IMAGES and CONFIRM WHAT THEY WANT TO DO WITH THE IMAGES.
         Images count in chat: {len(state["user_images"])}. Tell to user that use up to 3 get better results.
         The image indices are ascending starting with 0 in the order in which the user sent them.
+        Last generated/edited image available: {"yes" if state.get("last_output") else "no"}. If the user wants to keep refining it (e.g. "now make it darker"), set use_last_output instead of asking for images again.
+        Generated options available: {len(state.get("last_variants") or [])}. If the user picks one of them (e.g. "I like the 2nd, make it blue"), set variant_to_edit with its number.
         Rewrite provided prompt just correcting prossible typos and translating to english for better results.
-        """)]
-        + state["messages"]
+        Together with user_prompt, fill out completion_message: the short message the user will receive with the edited image, in the user's language.
+        """),
+        state,
     )
 
     if response.other_feature:
@@ -134,35 +230,36 @@ def img_to_img(state: State):
         state["awaiting"] = "feature"
         return state
 
-    if response.user_prompt is not None and len(response.images_to_edit) > 0:
+    # El último resultado va primero: fal.ai lo recibe por su URL, sin descargarlo ni re-subirlo
+    images: List[ImageRef] = []
+    variants = state.get("last_variants") or []
+    if response.variant_to_edit and 1 <= response.variant_to_edit <= len(variants):
+        images.append(variants[response.variant_to_edit - 1])
+    elif response.use_last_output and state.get("last_output"):
+        images.append(state["last_output"])
+    images += [state["user_images"][i] for i in response.images_to_edit or [] if 0 <= i < len(state["user_images"])]
+
+    if response.user_prompt is not None and len(images) > 0:
         logger.info("llm lleno el prompt y las imagenes")
         state["user_last_prompt"] = response.user_prompt
         state["awaiting"] = None
 
         try:
-            images = []
-            for i in response.images_to_edit:
-                images.append(state["user_images"][i])
 
             # Editar la imagen
-            edited_image: Image.Image = nanoclient.edit_image(state["user_last_prompt"], images)
-            response = gemini.invoke(
-                [SystemMessage(content="User image was edited successfully 😄")]
-                + state["messages"]
+            edited_image: ImageRef = await nanoclient.edit_image(
+                state["user_last_prompt"], images, bypass_cache=bool(response.regenerate), user=thread_phone(config)
             )
-            state["messages"].append(response)
+            state = add_assistant_msg(state, response.completion_message or fixed_reply(state, EDITED_REPLY))
             state["generated_image"] = edited_image
+            state["last_output"] = edited_image
             state["current_node"] = "triage"
             state["awaiting"] = "feature"
             return state
 
         except Exception as e:
             logger.error(f"Error editing image: {e}", exc_info=True)
-            response = gemini.invoke(
-                [SystemMessage(content="There was an error editing the image 😓")]
-                + state["messages"]
-            )
-            state["messages"].append(response)
+            state = add_assistant_msg(state, fixed_reply(state, EDIT_ERROR_REPLY))
             state["current_node"] = "triage"
             state["awaiting"] = "feature"
             return state
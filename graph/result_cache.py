@@ -0,0 +1,196 @@
+"""
+Cache de resultados de generación/edición de fal.ai (opt-in, RESULT_CACHE_ENABLED=1).
+
+La clave es (modelo, prompt, imágenes de entrada, parámetros): las imágenes locales
+entran por su SHA-256 y las remotas por su URL. Un prompt viral o un usuario que
+reenvía el mismo pedido recibe el resultado anterior al instante y sin otro job pago.
+
+El resultado se guarda con sus bytes en el ImageStore aunque IMAGE_DELIVERY=url: la
+URL de fal.ai se conserva para enviarla por link mientras dure la retención de su
+storage (RESULT_CACHE_TTL, queda en expires_at) y después se sirve desde los bytes.
+La cache se acota por cantidad de entradas y por bytes (LRU), con un respaldo
+opcional en SQLite compartido entre procesos (RESULT_CACHE_DB_PATH). Desalojar una
+entrada no borra su blob: el ImageStore es direccionado por contenido y las sesiones
+(y la cache de otros procesos) pueden seguir apuntando al mismo digest.
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from .images import ImageRef, ImageStore, image_store
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "0") == "1"
+DEFAULT_TTL = float(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))
+DEFAULT_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+DEFAULT_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+DEFAULT_DB_PATH = os.getenv("RESULT_CACHE_DB_PATH", "data/results.sqlite")
+
+
+def result_key(model: str, prompt: str, images: List[ImageRef], params: Optional[Dict[str, Any]] = None) -> str:
+    """Clave estable de un job: el orden de las imágenes importa, el de los params no"""
+    inputs = [ref.digest or ref.url for ref in images]
+    payload = json.dumps([model, prompt.strip(), inputs, params or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """LRU acotado por entradas y bytes de clave de job -> ImageRef del resultado"""
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_TTL,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        path: Optional[str] = None,
+        store: ImageStore = image_store,
+    ) -> None:
+        self.ttl = ttl
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[ImageRef, float]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.inflight_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+                "mime_type TEXT NOT NULL, size INTEGER NOT NULL, url TEXT, created_at REAL NOT NULL)"
+            )
+
+    def _expired(self, ref: ImageRef, created_at: float, now: float) -> bool:
+        # Con los bytes en el ImageStore no depende de que fal.ai siga sirviendo la URL
+        # (solo filas viejas de antes de guardar siempre los bytes quedan sin digest)
+        return not ref.is_local and now - created_at >= self.ttl
+
+    def _with_expiry(self, ref: ImageRef, created_at: float) -> ImageRef:
+        """La URL de fal.ai vence con la retención de su storage, contada desde que se cacheó"""
+        if ref.url and not ref.expires_at:
+            return replace(ref, expires_at=created_at + self.ttl)
+        return ref
+
+    def get(self, key: str) -> Optional[ImageRef]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                ref, created_at = entry
+                if not self._expired(ref, created_at, now):
+                    self._entries.move_to_end(key)
+                    return ref
+                self._drop(key)
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT digest, mime_type, size, url, created_at FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    ref = self._with_expiry(ImageRef(digest=row[0], mime_type=row[1], size=row[2], url=row[3]), row[4])
+                    if not self._expired(ref, row[4], now):
+                        self._remember(key, ref, row[4])
+                        return ref
+                    self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+
+    def put(self, key: str, ref: ImageRef) -> ImageRef:
+        """Guarda el resultado (ya local) y lo devuelve con el vencimiento de su URL"""
+        now = time.time()
+        ref = self._with_expiry(ref, now)
+        with self._lock:
+            self._remember(key, ref, now)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (key, digest, mime_type, size, url, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, ref.digest, ref.mime_type, ref.size, ref.url, now),
+                )
+                self._conn.execute(
+                    "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        return ref
+
+    def _remember(self, key: str, ref: ImageRef, created_at: float) -> None:
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (ref, created_at)
+        self._bytes += ref.size
+        while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        ref, _ = self._entries.pop(key)
+        self._bytes -= ref.size
+
+    async def get_or_run(self, key: str, run: Callable[[], Awaitable[ImageRef]], bypass: bool = False) -> ImageRef:
+        """
+        Devuelve el resultado cacheado o ejecuta el job. Jobs idénticos concurrentes
+        se unifican en uno solo (single-flight). `bypass` fuerza un job nuevo
+        (ej. "otra versión") y reemplaza la entrada.
+        """
+        if bypass:
+            self.bypasses += 1
+        else:
+            cached = await asyncio.to_thread(self.get, key) if self._conn is not None else self.get(key)
+            if cached is not None:
+                self.hits += 1
+                logger.info(f"result cache hit {key[:12]}")
+                return cached
+            task = self._inflight.get(key)
+            if task is not None:
+                self.inflight_hits += 1
+                return await asyncio.shield(task)
+            self.misses += 1
+
+        task = asyncio.create_task(self._run_and_store(key, run))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _run_and_store(self, key: str, run: Callable[[], Awaitable[ImageRef]]) -> ImageRef:
+        # Los bytes se guardan ya: un hit no puede depender de que la URL de fal.ai siga viva
+        ref = await self.store.aensure_local(await run())
+        if self._conn is not None:
+            return await asyncio.to_thread(self.put, key, ref)
+        return self.put(key, ref)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.inflight_hits + self.misses
+            return {
+                "enabled": RESULT_CACHE_ENABLED,
+                "hits": self.hits,
+                "inflight_hits": self.inflight_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "hit_rate": round((self.hits + self.inflight_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+result_cache = ResultCache(path=(DEFAULT_DB_PATH or None) if RESULT_CACHE_ENABLED else None)
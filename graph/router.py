@@ -0,0 +1,220 @@
+import re
+import time
+import logging
+import unicodedata
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from langchain.messages import AIMessage, HumanMessage, SystemMessage
+from .tools import State
+from .context import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RouteDecision:
+    """Resultado del pre-router: una ruta, una respuesta fija, o nada (decide el LLM)"""
+    route: Optional[str] = None
+    reply: Optional[str] = None
+    reason: str = "unsure"
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas y sin tildes, para que las tablas no dependan de cómo escribe el usuario"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c)).strip()
+
+
+# ---------- Tablas de intención (es / en / pt) ----------
+GREETING = re.compile(
+    r"^(hola+|holi+s?|buen(as|os)?( dias| tardes| noches)?|que tal|hello+|hi+|hey+|good (morning|afternoon|evening)"
+    r"|oi+|ola+|bom dia|boa (tarde|noite)|e ai)[\s!.,?👋🙂😄]*$"
+)
+IMAGE_NOUN = r"(imagen|imagenes|foto|fotos|dibujo|ilustracion|image|images|picture|pic|photo|drawing|illustration|imagem|imagens|desenho)"
+# El verbo solo no alcanza ("haceme un resumen de una película"): tiene que nombrar una imagen
+GENERATE = re.compile(
+    rf"\b(genera(r|me|las?)?|crea(r|me|las?)?|dibuja(r|me)?|hace(me)?|haz(me)?|"
+    rf"generate|create|draw|make|render|paint|"
+    rf"gera(r)?|gere|cria(r)?|crie|desenha(r)?|desenhe|faca|faz)\b.*\b{IMAGE_NOUN}\b"
+)
+EDIT = re.compile(
+    r"\b(edita(r|la|lo)?|cambia(r|le|la|lo)?|modifica(r|la|lo)?|quita(r|le)?|saca(r|le)?|agrega(r|le)?|pon(e|le)?|"
+    r"pone(le)?|hace(la|lo)|hazla|hazlo|convierte(la|lo)?|"
+    r"edit|change|modify|remove|add|replace|turn it|make it|make (him|her|them)|"
+    r"editar|edite|mude|mudar|troque|tire|coloque|adicione|deixe)\b"
+)
+# Referencias a una imagen existente ("esta foto", "la anterior", "now make it darker")
+REFERENCE = re.compile(
+    r"\b(esta|este|esa|ese|la anterior|la ultima|ahora|mas|menos|this|that|it|the last|now|more|less|"
+    r"essa|esse|agora|mais|menos)\b"
+)
+
+# Con una negación ("no quiero una imagen de...") las reglas no alcanzan: decide el LLM
+NEGATION = re.compile(r"\b(no|not|don['’]?t|don t|never|nunca|nao|nem|ni)\b")
+
+CANNED_GREETINGS = {
+    "es": (
+        "¡Hola! 👋 Soy tu agente de imágenes con nanobanana🍌. Puedo:\n"
+        "🎨 Generar imágenes a partir de texto\n"
+        "🪄 Editar tus fotos con lenguaje natural\n"
+        "🖼️ Combinar varias imágenes (hasta 3 dan mejores resultados)\n"
+        "¿Qué querés hacer? 🎯"
+    ),
+    "en": (
+        "Hi! 👋 I'm your nanobanana🍌 image agent. I can:\n"
+        "🎨 Generate images from text\n"
+        "🪄 Edit your photos with natural language\n"
+        "🖼️ Combine several images (up to 3 works best)\n"
+        "What would you like to do? 🎯"
+    ),
+    "pt": (
+        "Oi! 👋 Sou seu agente de imagens com nanobanana🍌. Posso:\n"
+        "🎨 Gerar imagens a partir de texto\n"
+        "🪄 Editar suas fotos com linguagem natural\n"
+        "🖼️ Combinar várias imagens (até 3 funciona melhor)\n"
+        "O que você quer fazer? 🎯"
+    ),
+}
+_ENGLISH_GREETING = re.compile(r"^(hello|hi|hey|good )")
+_PORTUGUESE_GREETING = re.compile(r"^(oi|ola|bom dia|boa |e ai)")
+
+# Palabras frecuentes (normalizadas) que son de un solo idioma; las compartidas
+# (que, por, mas, foto...) no suman
+_LANGUAGE_WORDS = {
+    "es": frozenset(
+        "el la los las una y con del mi quiero puedes podes haz hace hacela agrega agregale cambia cambiale "
+        "imagen imagenes ahora otra esta este gracias hola dame genera generame dibuja pero".split()
+    ),
+    "en": frozenset(
+        "the and with of my it is to you can want please make add change image picture now another "
+        "this that thanks hello hi hey generate draw but".split()
+    ),
+    "pt": frozenset(
+        "o os um uma com do meu minha quero voce pode faz faca adiciona muda imagem imagens agora outra "
+        "isso obrigado obrigada oi ola gera gere desenha nao".split()
+    ),
+}
+
+
+def detect_language(text: str) -> Optional[str]:
+    """es / en / pt según las palabras del texto; None si no alcanza para decidir"""
+    words = re.findall(r"[a-z]+", _normalize(text))
+    scores = {language: sum(word in vocabulary for word in words) for language, vocabulary in _LANGUAGE_WORDS.items()}
+    best = max(scores, key=scores.get)
+    if scores[best] == 0 or list(scores.values()).count(scores[best]) > 1:
+        return None
+    return best
+
+
+def conversation_language(messages: List[Any], default: str = "es") -> str:
+    """Idioma del último mensaje del usuario que lo deja claro (las respuestas fijas lo siguen)"""
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage) and isinstance(message.content, str):
+            language = detect_language(message.content.removeprefix("Last image caption: "))
+            if language:
+                return language
+    return default
+
+
+def _pending_human_text(messages: List[Any]) -> str:
+    """Texto que el usuario mandó desde la última respuesta del asistente"""
+    parts = []
+    for message in reversed(messages):
+        if isinstance(message, AIMessage):
+            break
+        if isinstance(message, HumanMessage) and isinstance(message.content, str):
+            parts.append(message.content)
+    return " ".join(reversed(parts))
+
+
+def _images_arrived(messages: List[Any]) -> bool:
+    """True si llegaron imágenes desde la última respuesta del asistente"""
+    for message in reversed(messages):
+        if isinstance(message, AIMessage):
+            return False
+        if isinstance(message, SystemMessage) and "added to chat" in str(message.content):
+            return True
+    return False
+
+
+def fast_route(state: State) -> RouteDecision:
+    """Resuelve los casos obvios del triage con reglas, sin llamar al LLM"""
+    messages = state.get("messages", [])
+    if _images_arrived(messages):
+        return RouteDecision(route="img_to_img", reason="image_message")
+
+    text = _normalize(_pending_human_text(messages))
+    if not text:
+        return RouteDecision()
+
+    if GREETING.match(text):
+        language = "en" if _ENGLISH_GREETING.match(text) else "pt" if _PORTUGUESE_GREETING.match(text) else "es"
+        return RouteDecision(reply=CANNED_GREETINGS[language], reason=f"greeting_{language}")
+
+    if NEGATION.search(text):
+        return RouteDecision()
+
+    has_images = bool(state.get("user_images")) or bool(state.get("last_output"))
+
+    # Un pedido de edición nunca va a txt_to_img: si no hay imagen a la que se refiera, decide el LLM
+    if EDIT.search(text):
+        if has_images and not GENERATE.search(text):
+            return RouteDecision(route="img_to_img", reason="edit_keywords")
+        return RouteDecision()
+    # "genera una imagen de..." sin referirse a imágenes previas
+    if GENERATE.search(text) and not (has_images and REFERENCE.search(text)):
+        return RouteDecision(route="txt_to_img", reason="generate_keywords")
+
+    return RouteDecision()
+
+
+class RouterStats:
+    """Contadores del pre-router: cuántos turnos resolvió sin LLM y cuánto se ahorró"""
+
+    # Latencia típica de una llamada de triage a Gemini, para estimar el ahorro
+    ESTIMATED_LLM_LATENCY = 1.5
+
+    def __init__(self) -> None:
+        self.decisions: Dict[str, int] = {}
+        self.fallbacks = 0
+        self.fast_path_seconds = 0.0
+        self.estimated_tokens_saved = 0
+
+    def record(self, decision: RouteDecision, elapsed: float, state: State) -> None:
+        self.fast_path_seconds += elapsed
+        if decision.route is None and decision.reply is None:
+            self.fallbacks += 1
+            logger.info(f"router: llm fallback ({elapsed * 1000:.2f} ms)")
+            return
+        self.decisions[decision.reason] = self.decisions.get(decision.reason, 0) + 1
+        # Es lo que se hubiera mandado como prompt al triage
+        prompt_tokens = estimate_tokens(state.get("messages", []))
+        self.estimated_tokens_saved += prompt_tokens
+        logger.info(
+            f"router: {decision.route or 'canned_reply'} via {decision.reason} "
+            f"({elapsed * 1000:.2f} ms, ~{prompt_tokens} prompt tokens saved)"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        hits = sum(self.decisions.values())
+        total = hits + self.fallbacks
+        return {
+            "hits": hits,
+            "fallbacks": self.fallbacks,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "by_reason": dict(self.decisions),
+            "estimated_tokens_saved": self.estimated_tokens_saved,
+            "estimated_latency_saved_seconds": round(hits * self.ESTIMATED_LLM_LATENCY, 1),
+            "fast_path_seconds": round(self.fast_path_seconds, 4),
+        }
+
+
+router_stats = RouterStats()
+
+
+def route_message(state: State) -> RouteDecision:
+    """fast_route + registro de la decisión para medir el hit rate"""
+    started = time.perf_counter()
+    decision = fast_route(state)
+    router_stats.record(decision, time.perf_counter() - started, state)
+    return decision
@@ -0,0 +1,136 @@
+"""
+Scheduler de jobs de fal.ai: límite global de concurrencia y cola justa por usuario.
+
+Sin límite, una ráfaga de un solo usuario (o un envío a un grupo) agota el rate limit
+de fal.ai y deja esperando a todos. Cuando no hay lugar, los jobs esperan en una cola
+por número de teléfono y los lugares que se liberan se reparten round-robin entre
+usuarios: quien pide 10 imágenes no demora al que pide una.
+
+El límite es por proceso (el total es INGEST_WORKER_PROCESSES x FAL_MAX_CONCURRENT_JOBS).
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_MAX_CONCURRENT = int(os.getenv("FAL_MAX_CONCURRENT_JOBS", "8"))
+
+
+class FairScheduler:
+    """Semáforo con colas por usuario atendidas en round-robin"""
+
+    def __init__(self, max_concurrent: int = DEFAULT_MAX_CONCURRENT) -> None:
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        # Hook async (usuario, posición) para avisar "estás #N en la fila"; lo setea background_processor
+        self.on_queued: Optional[Callable[[str, int], Awaitable[None]]] = None
+        self._notices: Set[asyncio.Task] = set()
+        self.jobs = 0
+        self.queued_jobs = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _position(self, user: str) -> int:
+        """Posición estimada de un job nuevo de `user` bajo round-robin"""
+        ahead_own = len(self._queues.get(user, ()))
+        others = sum(min(len(queue), ahead_own + 1) for other, queue in self._queues.items() if other != user)
+        return ahead_own + others + 1
+
+    async def run(self, user: str, job: Callable[[], Awaitable[T]]) -> T:
+        """Ejecuta `job` cuando haya lugar, respetando el turno de cada usuario"""
+        self.jobs += 1
+        if self.running < self.max_concurrent and not self._queues:
+            self.running += 1
+        else:
+            await self._wait_turn(user)
+        try:
+            return await job()
+        finally:
+            self._release()
+
+    async def _wait_turn(self, user: str) -> None:
+        position = self._position(user)
+        # Un solo aviso por pedido: las variantes que se encolan detrás de otro job
+        # del mismo usuario ya están cubiertas por ese aviso
+        first_waiting = user not in self._queues
+        turn = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(turn)
+        self.queued_jobs += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        logger.info(f"fal job for {user} queued at #{position} ({self.running} running)")
+        if first_waiting and self.on_queued is not None:
+            self._notify(user, position)
+
+        started = time.monotonic()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # Ya se le había cedido el lugar: pasarlo al siguiente
+                self._release()
+            else:
+                queue = self._queues.get(user)
+                if queue is not None and turn in queue:
+                    queue.remove(turn)
+                    if not queue:
+                        del self._queues[user]
+            raise
+
+        waited = time.monotonic() - started
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def _notify(self, user: str, position: int) -> None:
+        """Manda el aviso en otra task: el job no espera al envío por WhatsApp para tomar su lugar"""
+
+        async def notify() -> None:
+            try:
+                await self.on_queued(user, position)
+            except Exception as e:
+                logger.warning(f"Could not notify queue position to {user}: {e}")
+
+        task = asyncio.create_task(notify())
+        self._notices.add(task)
+        task.add_done_callback(self._notices.discard)
+
+    def _release(self) -> None:
+        """Cede el lugar al próximo usuario en la rotación, o lo libera"""
+        while self._queues:
+            user, queue = next(iter(self._queues.items()))
+            turn = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "users_waiting": len(self._queues),
+            "max_queue_depth": self.max_queue_depth,
+            "jobs": self.jobs,
+            "queued_jobs": self.queued_jobs,
+            "avg_wait_seconds": round(self.total_wait / self.queued_jobs, 3) if self.queued_jobs else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3),
+        }
+
+
+fal_scheduler = FairScheduler()
@@ -1,16 +1,22 @@
 import os
+import time
+import random
+import asyncio
 import logging
-import requests
 from dotenv import load_dotenv
 load_dotenv()
 import fal_client
-from langchain.tools import tool
+import tracing
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.messages import AnyMessage
-from PIL import Image
-from typing import TypedDict, List, Optional, Literal
+from langgraph.config import get_stream_writer
+from typing import TypedDict, List, Optional, Literal, AsyncIterator
 from pydantic import BaseModel, Field
-from io import BytesIO
+from .images import ImageRef, image_store
+from .uploads import fal_upload_cache
+from .llm_cache import CachedAgent
+from .result_cache import RESULT_CACHE_ENABLED, result_cache, result_key
+from .scheduler import fal_scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -19,108 +25,207 @@ gemini = ChatGoogleGenerativeAI(
     google_api_key=os.environ.get("GOOGLE_API_KEY")
 )
 
+# Modo de entrega de resultados: "url" conserva la URL de fal.ai (sin descargar),
+# "download" baja los bytes al ImageStore apenas termina el job
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "url").lower()
+
+# Variantes: "batch" pide N imágenes en un solo job (num_images), "seeds" lanza N jobs
+# en paralelo con seeds distintas y entrega cada una apenas termina
+VARIANTS_MODE = os.getenv("VARIANTS_MODE", "seeds").lower()
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "4"))
+
+# Estados de la cola de fal.ai (en cola / generando) emitidos por el stream "custom" del graph
+PROGRESS_UPDATES = os.getenv("PROGRESS_UPDATES", "1") == "1"
+FAL_STATUS_INTERVAL = float(os.getenv("FAL_STATUS_INTERVAL", "0.5"))
+
+
+def _stream_writer():
+    """Writer del stream "custom" del graph, o None si no se está dentro de una ejecución"""
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        return None
+
+
+class EmptyResultError(RuntimeError):
+    """
+    El job de fal.ai terminó bien pero sin imágenes (por ejemplo, las filtró el safety
+    checker): no es transitorio, reintentar el lote daría lo mismo.
+    """
+
+
 # Wrapper para fal.ai usando el SDK oficial
 class FalconClient:
-    """Wrapper para fal.ai Model APIs usando el SDK oficial"""
-    
-    def generate_image(self, prompt: str, model: str = "fal-ai/nano-banana") -> Image.Image:
+    """Wrapper para fal.ai Model APIs usando el SDK oficial (async)"""
+
+    async def _result_image(self, result: dict) -> ImageRef:
+        """Primera imagen de un resultado de fal.ai"""
+        images = result.get("images") or []
+        if not images:
+            raise EmptyResultError(f"fal.ai returned no images: {result.get('description') or 'no description'}")
+        return await self._to_image_ref(images[0])
+
+    async def _to_image_ref(self, image: dict) -> ImageRef:
+        """
+        Convierte una imagen de un resultado de fal.ai en un ImageRef.
+        
+        En modo "url" no se descarga nada: se conserva la URL de fal.ai para enviarla
+        directo a WhatsApp. Los bytes se bajan recién si algún paso necesita los pixeles.
+        """
+        remote = ImageRef(
+            mime_type=image.get("content_type") or "image/png",
+            size=image.get("file_size") or 0,
+            url=image["url"],
+        )
+        if IMAGE_DELIVERY == "download":
+            return await image_store.aensure_local(remote)
+        return remote
+
+    async def _run_job(self, user: str, model: str, arguments: dict) -> dict:
+        """Envía el job a fal.ai cuando el scheduler le da lugar (límite global, turno justo por usuario)"""
+        requested = time.monotonic()
+
+        async def job() -> dict:
+            tracing.set_attributes(scheduler_wait_ms=round((time.monotonic() - requested) * 1000, 1))
+            # Usar el SDK oficial que maneja todo el polling automáticamente
+            with tracing.span("fal.submit", model=model) as submit_span:
+                handler = await fal_client.submit_async(model, arguments=arguments)
+                submit_span.set_attribute("request_id", handler.request_id)
+            with tracing.span("fal.result", model=model, request_id=handler.request_id) as result_span:
+                writer = _stream_writer() if PROGRESS_UPDATES else None
+                if writer is not None:
+                    # Reenviar los estados de la cola de fal.ai para avisar "generando..." al usuario
+                    started = False
+                    async for status in handler.iter_events(interval=FAL_STATUS_INTERVAL):
+                        if isinstance(status, fal_client.Queued):
+                            writer({"status": "queued", "position": status.position})
+                            result_span.add_event("queued", position=status.position)
+                        elif isinstance(status, fal_client.InProgress) and not started:
+                            started = True
+                            writer({"status": "in_progress"})
+                            result_span.add_event("in_progress")
+                # Obtener el resultado
+                return await handler.get()
+
+        with tracing.span("fal.job", model=model, user=user or None, images=len(arguments.get("image_urls", ()))):
+            return await fal_scheduler.run(user, job)
+
+    async def generate_image(
+        self, prompt: str, model: str = "fal-ai/nano-banana", bypass_cache: bool = False, user: str = ""
+    ) -> ImageRef:
         """
         Genera una imagen usando fal.ai
         
         Args:
             prompt: El prompt de texto para generar la imagen
             model: El modelo de fal.ai a usar (default: fal-ai/nano-banana)
+            bypass_cache: Forzar un job nuevo aunque el mismo pedido esté en la cache de resultados
+            user: Número de teléfono, para el turno en el scheduler de jobs
             
         Returns:
-            PIL.Image.Image: La imagen generada
+            ImageRef: Referencia a la imagen generada en el ImageStore
         """
-        # Usar el SDK oficial que maneja todo el polling automáticamente
-        handler = fal_client.submit(
-            model,
-            arguments={"prompt": prompt}
-        )
-        
-        # Obtener el resultado
-        result = handler.get()
-        
-        # Descargar la imagen desde la URL
-        image_url = result["images"][0]["url"]
-        image_response = requests.get(image_url)
-        image_response.raise_for_status()
+        if not RESULT_CACHE_ENABLED:
+            return await self._generate(prompt, model, user)
+        key = result_key(model, prompt, [])
+        return await result_cache.get_or_run(key, lambda: self._generate(prompt, model, user), bypass=bypass_cache)
+
+    async def _generate(self, prompt: str, model: str, user: str) -> ImageRef:
+        result = await self._run_job(user, model, {"prompt": prompt})
+        return await self._result_image(result)
+
+    async def generate_variants(
+        self, prompt: str, count: int, model: str = "fal-ai/nano-banana", user: str = ""
+    ) -> AsyncIterator[ImageRef]:
+        """
+        Genera `count` variantes del mismo prompt y las entrega a medida que terminan.
         
-        # Convertir a PIL Image
-        return Image.open(BytesIO(image_response.content))
+        En modo "seeds" cada variante es un job propio (en paralelo, pasando por el
+        scheduler): la primera llega en el tiempo de una sola imagen. En modo "batch"
+        es un único job con num_images. Las variantes que fallan se saltean; si fallan
+        todas se levanta el último error.
+        """
+        count = max(1, min(count, MAX_VARIANTS))
+        if VARIANTS_MODE == "batch":
+            result = await self._run_job(user, model, {"prompt": prompt, "num_images": count})
+            refs = await asyncio.gather(*(self._to_image_ref(image) for image in result.get("images") or []))
+            for ref in refs:
+                yield ref
+            return
+
+        seeds = random.sample(range(2 ** 31), count)
+        tasks = [
+            asyncio.create_task(self._run_job(user, model, {"prompt": prompt, "seed": seed}))
+            for seed in seeds
+        ]
+        delivered = 0
+        error: Optional[Exception] = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    ref = await self._result_image(await next_done)
+                except Exception as e:
+                    logger.error(f"Variant failed: {e}")
+                    error = e
+                    continue
+                delivered += 1
+                yield ref
+        finally:
+            # Si el consumidor corta la iteración, no dejar jobs colgados
+            for task in tasks:
+                task.cancel()
+        if delivered == 0 and error is not None:
+            raise error
     
-    def edit_image(self, prompt: str, images: List[Image.Image]) -> Image.Image:
+    async def edit_image(
+        self, prompt: str, images: List[ImageRef], bypass_cache: bool = False, user: str = ""
+    ) -> ImageRef:
         """
         Edita una imagen usando fal.ai nano-banana/edit
         
         Args:
             prompt: El prompt de edición para la imagen
-            images: Las imagenes PIL a editar
+            images: Referencias a las imagenes a editar
+            bypass_cache: Forzar un job nuevo aunque el mismo pedido esté en la cache de resultados
+            user: Número de teléfono, para el turno en el scheduler de jobs
             
         Returns:
-            PIL.Image.Image: La imagen editada
+            ImageRef: Referencia a la imagen editada en el ImageStore
         """
-        # Subir todas las imágenes una por una a fal.ai
-        # upload_image() solo acepta una imagen a la vez, no una lista
-        image_urls = []
-        for idx, img in enumerate(images):
-            # Convertir a PIL Image si es necesario (por si se corrompió al guardar/recuperar el estado)
-            if isinstance(img, BytesIO):
-                logger.warning(f"Image {idx} is BytesIO, converting to PIL")
-                img.seek(0)
-                img = Image.open(img)
-            elif not isinstance(img, Image.Image):
-                if isinstance(img, bytes):
-                    logger.warning(f"Image {idx} is bytes, converting to PIL")
-                    img = Image.open(BytesIO(img))
-                else:
-                    raise ValueError(f"Expected PIL Image, BytesIO, or bytes at index {idx}, got {type(img)}")
-            
-            if not isinstance(img, Image.Image):
-                raise ValueError(f"Failed to convert image {idx} to PIL Image")
-            
-            # Subir cada imagen a fal.ai temporalmente
-            # upload_image acepta PIL Image y retorna directamente la URL como string
-            image_url = fal_client.upload_image(img)
-            image_urls.append(image_url)
+        if not RESULT_CACHE_ENABLED:
+            return await self._edit(prompt, images, user)
+        key = result_key("fal-ai/nano-banana/edit", prompt, images)
+        return await result_cache.get_or_run(key, lambda: self._edit(prompt, images, user), bypass=bypass_cache)
+
+    async def _edit(self, prompt: str, images: List[ImageRef], user: str) -> ImageRef:
+        # Subir a fal.ai solo las imágenes que no estén ya en la cache, en paralelo
+        image_urls = await fal_upload_cache.get_urls(images)
             
-        # Usar el SDK oficial con el endpoint de edición
-        # El endpoint acepta image_urls (array) según la documentación oficial
-        handler = fal_client.submit(
-            "fal-ai/nano-banana/edit",
-            arguments={
-                "prompt": prompt,
-                "image_urls": image_urls  # Array con todas las URLs subidas
-            }
-        )
-        
-        # Obtener el resultado
-        result = handler.get()
+        # El endpoint de edición acepta image_urls (array) según la documentación oficial
+        result = await self._run_job(user, "fal-ai/nano-banana/edit", {
+            "prompt": prompt,
+            "image_urls": image_urls  # Array con todas las URLs subidas
+        })
         
-        # Descargar la imagen editada desde la URL
-        image_url = result["images"][0]["url"]
-        image_response = requests.get(image_url)
-        image_response.raise_for_status()
-        
-        # Convertir a PIL Image
-        return Image.open(BytesIO(image_response.content))
+        return await self._result_image(result)
 
 nanoclient = FalconClient()
 
-class GeneratedImage(TypedDict):
-    prompt: str
-    output: Image.Image
-
 class State(TypedDict):
     messages: List[AnyMessage]
     current_node: str
     awaiting: str
     back: bool
     user_last_prompt: str
-    generated_image: Image.Image
-    user_images: List[Image.Image]
+    # Las imágenes se guardan fuera del estado (ImageStore); aquí solo viajan referencias
+    generated_image: Optional[ImageRef]
+    user_images: List[ImageRef]
+    # Último resultado de fal.ai (con su URL), reutilizable como entrada de la próxima edición
+    last_output: Optional[ImageRef]
+    # Resumen incremental de los mensajes viejos (ver graph/context.py)
+    summary: Optional[str]
+    # Variantes del último pedido de varias imágenes, en el orden en que se enviaron
+    last_variants: List[ImageRef]
 
 
 class TriageSO(BaseModel):
@@ -135,13 +240,30 @@ class PromptSO(BaseModel):
     user_prompt: Optional[str] = Field(default=None, description="User's prompt")
     output: Optional[str] = Field(default=None, description="Text asking to user to confirm or ask the prompt")
     other_feature: Optional[bool] = Field(default=False, description="True if user manifest do something else not related with txt_to_txt")
+    completion_message: Optional[str] = Field(default=None, description="Short fun message for the user, in their language, to send together with the generated image once it is ready. Fill it out only with user_prompt")
+    regenerate: Optional[bool] = Field(default=False, description="True if the user asks for another/different version of an image they already got with the same prompt")
+    variants: Optional[int] = Field(default=1, description="How many different options of the image the user wants to choose from (1 to 4). 1 unless the user asks for options/variants")
 
 class EditImages(BaseModel):
     user_prompt: Optional[str] = Field(default=None, description="User's prompt. What to do with the image or images.")
     images_to_edit: Optional[List[int]] = Field(default=None, description="User's images's index to be used.")
+    use_last_output: Optional[bool] = Field(default=False, description="True if the user wants to keep editing the last generated or edited image")
+    variant_to_edit: Optional[int] = Field(default=None, description="Number (starting at 1) of the generated option the user wants to keep editing, if they got several options")
     output: Optional[str] = Field(default=None, description="To ask the user if they have already sent all their images or if the request is not understood, always before filling out user_prompt or images_to_edit")
     other_feature: Optional[bool] = Field(default=False, description="True if user manifest do something not related with img_to_img")
+    completion_message: Optional[str] = Field(default=None, description="Short fun message for the user, in their language, to send together with the edited image once it is ready. Fill it out only with user_prompt")
+    regenerate: Optional[bool] = Field(default=False, description="True if the user asks for another/different version of an edit they already got with the same prompt")
 
-triage_agent = gemini.with_structured_output(TriageSO)
-prompt_reader_agent = gemini.with_structured_output(PromptSO)
-edit_agent = gemini.with_structured_output(EditImages)
\ No newline at end of file
+# Las respuestas repetidas (menú, saludos, pedidos típicos) salen de la cache (graph/llm_cache.py)
+# Triage solo devuelve una ruta o el menú: puede canonicalizar el texto. Los otros dos copian
+# el pedido del usuario en user_prompt, así que su clave usa el texto tal cual
+triage_agent = CachedAgent(
+    gemini.with_structured_output(TriageSO), "triage", TriageSO, state_fields=("awaiting",), canonical=True
+)
+prompt_reader_agent = CachedAgent(
+    gemini.with_structured_output(PromptSO), "prompt_reader", PromptSO, state_fields=("awaiting", "user_last_prompt")
+)
+edit_agent = CachedAgent(
+    gemini.with_structured_output(EditImages), "edit", EditImages,
+    state_fields=("awaiting", "user_last_prompt", "user_images", "last_output", "last_variants"),
+)
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Any, Dict, List, Set, Tuple
+from urllib.parse import urlparse
+import fal_client
+import tracing
+from .images import ImageRef, image_store
+
+logger = logging.getLogger(__name__)
+
+# No debe superar la retención del storage de fal.ai: pasado ese tiempo la URL deja de servir
+DEFAULT_TTL = float(os.getenv("FAL_UPLOAD_CACHE_TTL", str(24 * 3600)))
+DEFAULT_MAX_ENTRIES = int(os.getenv("FAL_UPLOAD_CACHE_MAX_ENTRIES", "10000"))
+
+
+# Dominios donde fal.ai hospeda resultados y archivos subidos
+FAL_HOSTED_DOMAINS = ("fal.media", "fal.ai", "fal.run")
+
+
+def is_fal_hosted(url: str) -> bool:
+    host = urlparse(url).hostname or ""
+    return url.startswith("https://") and any(host == d or host.endswith("." + d) for d in FAL_HOSTED_DOMAINS)
+
+
+class FalUploadCache:
+    """
+    Cache SHA-256 del contenido -> URL de fal.ai, con TTL y desalojo LRU.
+    
+    Un usuario que itera ediciones sobre las mismas fotos las sube una sola vez.
+    Las subidas concurrentes de la misma imagen se unifican en una sola (single-flight).
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # El event loop solo guarda referencias débiles: sin este set un prefetch en vuelo
+        # puede ser recolectado antes de terminar
+        self._prefetches: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.inflight_hits = 0
+        self.misses = 0
+        self.passthrough = 0
+        self.prefetches = 0
+        self.bytes_uploaded = 0
+
+    async def get_url(self, ref: ImageRef) -> str:
+        """Devuelve una URL de fal.ai para la imagen, subiéndola solo si hace falta"""
+        # Resultados previos de fal.ai (ediciones encadenadas) o imágenes ya subidas: se pasan por URL tal cual
+        if ref.url_valid and is_fal_hosted(ref.url):
+            self.passthrough += 1
+            return ref.url
+
+        ref = await image_store.aensure_local(ref)
+        entry = self._entries.get(ref.digest)
+        if entry is not None:
+            url, uploaded_at = entry
+            if time.monotonic() - uploaded_at < self.ttl:
+                self._entries.move_to_end(ref.digest)
+                self.hits += 1
+                return url
+            del self._entries[ref.digest]
+
+        task = self._inflight.get(ref.digest)
+        if task is not None:
+            self.inflight_hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._upload(ref))
+            self._inflight[ref.digest] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ref.digest, None))
+        # shield: si un llamador se cancela, la subida sigue para los demás
+        return await asyncio.shield(task)
+
+    def prefetch(self, ref: ImageRef) -> asyncio.Task:
+        """
+        Empieza a subir una imagen apenas llega, mientras el LLM todavía decide qué hacer.
+        Cuando se confirma la edición, get_url encuentra la subida hecha o en vuelo.
+        """
+        self.prefetches += 1
+        task = asyncio.create_task(self.get_url(ref))
+        self._prefetches.add(task)
+        task.add_done_callback(self._prefetches.discard)
+        task.add_done_callback(self._log_prefetch_error)
+        return task
+
+    @staticmethod
+    def _log_prefetch_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Prefetch upload to fal.ai failed: {task.exception()}")
+
+    def with_hosted_url(self, ref: ImageRef) -> ImageRef:
+        """
+        Si la imagen ya está subida, devuelve el ref con la URL de fal.ai y su vencimiento,
+        para guardarlo en el estado: cualquier worker la reutiliza sin volver a subirla.
+        """
+        if not ref.is_local or (ref.url_valid and is_fal_hosted(ref.url)):
+            return ref
+        entry = self._entries.get(ref.digest)
+        if entry is None:
+            return ref
+        url, uploaded_at = entry
+        remaining = self.ttl - (time.monotonic() - uploaded_at)
+        if remaining <= 0:
+            return ref
+        return replace(ref, url=url, expires_at=time.time() + remaining)
+
+    async def get_urls(self, refs: List[ImageRef]) -> List[str]:
+        """Resuelve varias imágenes en paralelo, conservando el orden"""
+        return list(await asyncio.gather(*(self.get_url(ref) for ref in refs)))
+
+    async def _upload(self, ref: ImageRef) -> str:
+        # Se suben los bytes comprimidos tal como están guardados, sin decodificar
+        data = await ref.aread_bytes()
+        with tracing.span("fal.upload", bytes=len(data), mime_type=ref.mime_type):
+            url = await fal_client.upload_async(data, ref.mime_type)
+        self.bytes_uploaded += len(data)
+        self._entries[ref.digest] = (url, time.monotonic())
+        self._entries.move_to_end(ref.digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return url
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.inflight_hits + self.misses
+        return {
+            "hits": self.hits,
+            "inflight_hits": self.inflight_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.inflight_hits) / total, 4) if total else 0.0,
+            "passthrough": self.passthrough,
+            "prefetches": self.prefetches,
+            "prefetches_inflight": len(self._prefetches),
+            "size": len(self._entries),
+            "bytes_uploaded": self.bytes_uploaded,
+        }
+
+
+fal_upload_cache = FalUploadCache()
@@ -0,0 +1,173 @@
+"""
+Codificación de imágenes fuera del event loop.
+
+Las funciones de este módulo reciben y devuelven bytes (sin estado compartido), así
+pueden correr en cualquier pool. La codificación de salida va a un pool de threads
+dedicado (PIL libera el GIL al (de)codificar); la normalización de las fotos entrantes,
+más pesada (decode completo + resize + encode), va a un pool de procesos.
+
+Vive fuera del paquete graph para que los procesos del pool (spawn) no importen el
+stack de LangGraph, Gemini y fal.ai. Cada proceso spawn importa este módulo y además
+vuelve a ejecutar el nivel superior del script principal (`python webhook.py` o
+`python worker.py`, como __mp_main__): por eso esos scripts no abren recursos al
+importarse (la cola del webhook se abre en el lifespan, ver webhook.get_ingest_queue).
+"""
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import Any, Callable, Optional, Tuple
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Formato de las imágenes que subimos a WhatsApp: jpeg, png u original (sin re-codificar
+# salvo que supere el límite). WhatsApp solo acepta JPEG y PNG en mensajes de imagen.
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "jpeg").lower()
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "90"))
+# Límite de WhatsApp para imágenes
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(5 * 1024 * 1024)))
+# Vista previa de la entrega progresiva: chica y muy comprimida para que llegue al instante
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "512"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "40"))
+IMAGE_THREADS = int(os.getenv("IMAGE_THREADS", str(min(4, os.cpu_count() or 1))))
+# Normalización de fotos entrantes: lado máximo útil para el modelo y calidad del re-encode
+NORMALIZE_MAX_SIDE = int(os.getenv("NORMALIZE_MAX_SIDE", "2048"))
+NORMALIZE_QUALITY = int(os.getenv("NORMALIZE_QUALITY", "90"))
+# "process" (default) o "thread" (por ejemplo en entornos sin fork/spawn)
+NORMALIZE_POOL = os.getenv("NORMALIZE_POOL", "process").lower()
+IMAGE_PROCESSES = int(os.getenv("IMAGE_PROCESSES", str(min(2, os.cpu_count() or 1))))
+
+_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+
+_executor: Optional[Executor] = None
+_process_pool: Optional[Executor] = None
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IMAGE_THREADS, thread_name_prefix="imaging")
+    return _executor
+
+
+def get_process_pool() -> Executor:
+    """Pool de procesos para el trabajo de CPU pesado (cae al de threads con NORMALIZE_POOL=thread)"""
+    global _process_pool
+    # Un proceso daemon no puede tener hijos: ahí se normaliza en threads
+    if NORMALIZE_POOL != "process" or multiprocessing.current_process().daemon:
+        return get_executor()
+    if _process_pool is None:
+        # spawn: el proceso padre tiene threads (asyncio, SQLite) y un fork podría heredar locks tomados
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def warm_up_pools() -> None:
+    """Arranca los procesos del pool de antemano (spawn tarda en importar) sin esperar"""
+    pool = get_process_pool()
+    if isinstance(pool, ProcessPoolExecutor):
+        for _ in range(IMAGE_PROCESSES):
+            pool.submit(os.getpid)
+
+
+def shutdown_pools() -> None:
+    global _executor, _process_pool
+    for pool in (_executor, _process_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    _executor = _process_pool = None
+
+
+async def run_in_pool(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), partial(fn, *args, **kwargs))
+
+
+def _save(image: Image.Image, format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    if format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="PNG", optimize=False, compress_level=6)
+    return buffer.getvalue()
+
+
+def encode_image(
+    data: bytes,
+    format: str = "jpeg",
+    quality: int = OUTPUT_QUALITY,
+    max_side: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> Tuple[bytes, str]:
+    """
+    Re-codifica una imagen a JPEG/PNG, opcionalmente achicándola a `max_side`.
+
+    Si el resultado supera `max_bytes` baja la calidad (JPEG) y después la resolución
+    hasta entrar. Devuelve (bytes, mime_type).
+    """
+    pil_format, mime_type = _FORMATS[format]
+    image = Image.open(BytesIO(data))
+    if max_side:
+        # En JPEG, draft() decodifica directo a escala reducida (mucho más rápido)
+        image.draft("RGB", (max_side, max_side))
+    if pil_format == "JPEG":
+        image = image.convert("RGB")
+    if max_side:
+        image.thumbnail((max_side, max_side))
+
+    encoded = _save(image, pil_format, quality)
+    while max_bytes and len(encoded) > max_bytes:
+        if pil_format == "JPEG" and quality > 60:
+            quality -= 10
+        else:
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+        encoded = _save(image, pil_format, quality)
+    return encoded, mime_type
+
+
+def normalize_image(data: bytes, mime_type: Optional[str] = None) -> Tuple[bytes, str]:
+    """
+    Normaliza una foto entrante: aplica la orientación EXIF, la achica a NORMALIZE_MAX_SIDE
+    y la re-codifica (JPEG, o PNG si tiene transparencia). Si ya está derecha, en tamaño
+    y en JPEG, se devuelve tal cual para no perder calidad en otro re-encode.
+    """
+    image = Image.open(BytesIO(data))
+    orientation = image.getexif().get(0x0112, 1)
+    if orientation == 1 and max(image.size) <= NORMALIZE_MAX_SIDE and image.format == "JPEG":
+        return data, "image/jpeg"
+
+    image.draft("RGB", (NORMALIZE_MAX_SIDE, NORMALIZE_MAX_SIDE))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((NORMALIZE_MAX_SIDE, NORMALIZE_MAX_SIDE), Image.LANCZOS)
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        return _save(image, "PNG", NORMALIZE_QUALITY), "image/png"
+    return _save(image.convert("RGB"), "JPEG", NORMALIZE_QUALITY), "image/jpeg"
+
+
+async def anormalize_image(data: bytes, mime_type: Optional[str] = None) -> Tuple[bytes, str]:
+    return await asyncio.get_running_loop().run_in_executor(get_process_pool(), normalize_image, data, mime_type)
+
+
+def encode_for_whatsapp(data: bytes, mime_type: str) -> Tuple[bytes, str]:
+    """Bytes listos para subir a WhatsApp según OUTPUT_FORMAT, sin pasar el límite de tamaño"""
+    if OUTPUT_FORMAT == "original" and mime_type in ("image/jpeg", "image/png") and len(data) <= OUTPUT_MAX_BYTES:
+        return data, mime_type
+    format = OUTPUT_FORMAT if OUTPUT_FORMAT in _FORMATS else "jpeg"
+    return encode_image(data, format, OUTPUT_QUALITY, max_bytes=OUTPUT_MAX_BYTES)
+
+
+def encode_preview(data: bytes) -> Tuple[bytes, str]:
+    """Vista previa JPEG de baja resolución"""
+    return encode_image(data, "jpeg", PREVIEW_QUALITY, max_side=PREVIEW_MAX_SIDE)
+
+
+async def aencode_for_whatsapp(data: bytes, mime_type: str) -> Tuple[bytes, str]:
+    return await run_in_pool(encode_for_whatsapp, data, mime_type)
+
+
+async def aencode_preview(data: bytes) -> Tuple[bytes, str]:
+    return await run_in_pool(encode_preview, data)
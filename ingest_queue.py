@@ -0,0 +1,278 @@
+"""
+Cola de ingesta durable en SQLite (modo WAL).
+
+El webhook agrega cada mensaje con un INSERT (O(1)) antes de responder 200, y los
+workers (worker.py) lo consumen con:
+  - orden por número: nunca hay dos lotes del mismo teléfono en vuelo y un número
+    con mensajes en reintento bloquea a los más nuevos hasta que se reintenten
+  - visibility timeout: un lote tomado por un worker que muere vuelve a estar
+    disponible cuando vence su lease
+  - ack/release explícitos, con dead-letter después de `max_attempts` intentos
+  - ventana de coalescencia (debounce.py): un número se toma recién cuando pasaron
+    `debounce_quiet` segundos desde su último mensaje o `debounce_max` desde el primero
+  - append idempotente por id de WhatsApp: el id se marca como visto en la misma
+    transacción que el INSERT, así una reentrega de Meta nunca se pierde ni se duplica
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from debounce import DEBOUNCE_MAX_MS, DEBOUNCE_QUIET_MS
+from dedupe import DEFAULT_TTL as DEDUPE_TTL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.getenv("INGEST_QUEUE_PATH", "data/ingest_queue.sqlite")
+DEFAULT_VISIBILITY_TIMEOUT = float(os.getenv("INGEST_VISIBILITY_TIMEOUT", "120"))
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone TEXT NOT NULL,
+    shard_key INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_phone ON ingest_queue (phone, id);
+CREATE INDEX IF NOT EXISTS idx_ingest_queue_dead ON ingest_queue (dead, shard_key);
+CREATE TABLE IF NOT EXISTS seen_messages (message_id TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+"""
+
+# Cada cuántos appends se borran los ids vistos ya vencidos
+_PRUNE_SEEN_EVERY = 1000
+
+
+@dataclass
+class QueuedMessage:
+    id: int
+    phone: str
+    message: Dict[str, Any]
+    metadata: Dict[str, Any]
+    enqueued_at: float
+    attempts: int
+
+
+def shard_key(phone: str) -> int:
+    """Hash estable del número, para repartir teléfonos entre procesos worker"""
+    return zlib.crc32(phone.encode("utf-8"))
+
+
+class IngestQueue:
+    """Cola durable compartida entre el webhook y los procesos worker"""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        visibility_timeout: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        debounce_quiet: float = DEBOUNCE_QUIET_MS / 1000,
+        debounce_max: float = DEBOUNCE_MAX_MS / 1000,
+        dedupe_ttl: float = DEDUPE_TTL,
+    ) -> None:
+        self.path = path or DEFAULT_DB_PATH
+        self.visibility_timeout = visibility_timeout or DEFAULT_VISIBILITY_TIMEOUT
+        self.max_attempts = max_attempts or DEFAULT_MAX_ATTEMPTS
+        self.debounce_quiet = debounce_quiet
+        self.debounce_max = debounce_max
+        self.dedupe_ttl = dedupe_ttl
+        self.duplicates = 0
+        self._appends = 0
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # isolation_level=None: manejamos las transacciones a mano (BEGIN IMMEDIATE)
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    # ---------- Productor ----------
+    def append(self, phone: str, message: Dict[str, Any], metadata: Dict[str, Any]) -> Optional[int]:
+        """
+        Agrega un mensaje al final de la cola y devuelve su id.
+        
+        Devuelve None si el mismo id de WhatsApp ya se encoló dentro de `dedupe_ttl`
+        (reentrega de Meta). Marcar el id y encolar es una sola transacción: si el
+        proceso muere en el medio no queda ni lo uno ni lo otro, y la reentrega entra.
+        """
+        now = time.time()
+        message_id = message.get("id")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if message_id:
+                    # Upsert que solo pisa ids vencidos: rowcount 0 = ya visto dentro del TTL
+                    cursor = self._conn.execute(
+                        "INSERT INTO seen_messages (message_id, seen_at) VALUES (?, ?) "
+                        "ON CONFLICT(message_id) DO UPDATE SET seen_at = excluded.seen_at "
+                        "WHERE seen_messages.seen_at < ?",
+                        (message_id, now, now - self.dedupe_ttl),
+                    )
+                    if cursor.rowcount == 0:
+                        self._conn.execute("COMMIT")
+                        self.duplicates += 1
+                        return None
+                cursor = self._conn.execute(
+                    "INSERT INTO ingest_queue (phone, shard_key, message, metadata, enqueued_at, available_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (phone, shard_key(phone), json.dumps(message), json.dumps(metadata), now, now),
+                )
+                self._appends += 1
+                if self._appends % _PRUNE_SEEN_EVERY == 0:
+                    self._conn.execute("DELETE FROM seen_messages WHERE seen_at < ?", (now - self.dedupe_ttl,))
+                self._conn.execute("COMMIT")
+                return cursor.lastrowid
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ---------- Consumidor ----------
+    def claim(
+        self,
+        worker_id: str,
+        *,
+        shard: int = 0,
+        shards: int = 1,
+        max_phones: int = 8,
+    ) -> Dict[str, List[QueuedMessage]]:
+        """
+        Toma en lease todos los mensajes pendientes de hasta `max_phones` números.
+        
+        Solo se eligen números sin un lease vigente y sin mensajes esperando reintento,
+        así que el orden por número se mantiene aunque haya varios workers. Un número
+        que sigue mandando mensajes espera a que cierre su ventana de coalescencia,
+        así la ráfaga entra en un solo lote (mensajes en reintento ya la cumplieron).
+        
+        Returns:
+            Dict teléfono -> mensajes en orden de llegada
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Leases vencidos que ya agotaron sus intentos van a dead-letter
+                self._conn.execute(
+                    "UPDATE ingest_queue SET dead = 1, lease_owner = NULL, lease_expires_at = NULL "
+                    "WHERE dead = 0 AND lease_expires_at <= ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                )
+                phones = [
+                    row[0]
+                    for row in self._conn.execute(
+                        "SELECT phone FROM ingest_queue "
+                        "WHERE dead = 0 AND shard_key % ? = ? "
+                        "GROUP BY phone "
+                        "HAVING MAX(CASE WHEN lease_expires_at > ? THEN 1 ELSE 0 END) = 0 "
+                        "AND MAX(available_at) <= ? "
+                        "AND (? <= 0 OR MAX(enqueued_at) <= ? OR MIN(enqueued_at) <= ?) "
+                        "ORDER BY MIN(id) LIMIT ?",
+                        (
+                            shards, shard, now, now,
+                            self.debounce_quiet, now - self.debounce_quiet, now - self.debounce_max,
+                            max_phones,
+                        ),
+                    )
+                ]
+                claimed: Dict[str, List[QueuedMessage]] = {}
+                for phone in phones:
+                    self._conn.execute(
+                        "UPDATE ingest_queue SET lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1 "
+                        "WHERE phone = ? AND dead = 0",
+                        (worker_id, now + self.visibility_timeout, phone),
+                    )
+                    rows = self._conn.execute(
+                        "SELECT id, phone, message, metadata, enqueued_at, attempts FROM ingest_queue "
+                        "WHERE phone = ? AND dead = 0 AND lease_owner = ? ORDER BY id",
+                        (phone, worker_id),
+                    ).fetchall()
+                    claimed[phone] = [
+                        QueuedMessage(
+                            id=row[0],
+                            phone=row[1],
+                            message=json.loads(row[2]),
+                            metadata=json.loads(row[3]),
+                            enqueued_at=row[4],
+                            attempts=row[5],
+                        )
+                        for row in rows
+                    ]
+                self._conn.execute("COMMIT")
+                return claimed
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def extend(self, ids: List[int], worker_id: str) -> None:
+        """Renueva el lease de mensajes que siguen en proceso (heartbeat)"""
+        if not ids:
+            return
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE ingest_queue SET lease_expires_at = ? "
+                f"WHERE lease_owner = ? AND id IN ({placeholders})",
+                (time.time() + self.visibility_timeout, worker_id, *ids),
+            )
+
+    def ack(self, ids: List[int], worker_id: str) -> None:
+        """Confirma el procesamiento y elimina los mensajes de la cola"""
+        if not ids:
+            return
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM ingest_queue WHERE lease_owner = ? AND id IN ({placeholders})",
+                (worker_id, *ids),
+            )
+
+    def release(self, ids: List[int], worker_id: str, delay: float = 0.0) -> None:
+        """
+        Devuelve mensajes a la cola para reintentarlos después de `delay` segundos.
+        Los que ya agotaron `max_attempts` pasan a dead-letter.
+        """
+        if not ids:
+            return
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE ingest_queue SET lease_owner = NULL, lease_expires_at = NULL, available_at = ?, "
+                f"dead = CASE WHEN attempts >= ? THEN 1 ELSE 0 END "
+                f"WHERE lease_owner = ? AND id IN ({placeholders})",
+                (time.time() + delay, self.max_attempts, worker_id, *ids),
+            )
+
+    # ---------- Métricas ----------
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            depth, in_flight, dead, oldest = self._conn.execute(
+                "SELECT "
+                "SUM(CASE WHEN dead = 0 THEN 1 ELSE 0 END), "
+                "SUM(CASE WHEN dead = 0 AND lease_expires_at > ? THEN 1 ELSE 0 END), "
+                "SUM(dead), "
+                "MIN(CASE WHEN dead = 0 THEN enqueued_at END) "
+                "FROM ingest_queue",
+                (now,),
+            ).fetchone()
+        return {
+            "depth": depth or 0,
+            "in_flight": in_flight or 0,
+            "dead": dead or 0,
+            "oldest_age_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "duplicates": self.duplicates,
+        }
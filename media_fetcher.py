@@ -0,0 +1,185 @@
+"""
+Descarga concurrente de las fotos que llegan por WhatsApp.
+
+Para Cloud API bajar un media son dos pasos: resolver el media ID a una URL privada
+(GET /{MEDIA_ID}) y descargar esa URL. Antes cada foto de una ráfaga se bajaba en
+serie; ahora todas las del lote se resuelven y descargan a la vez sobre el pool de
+conexiones de AsyncWhatsapp, y la ráfaga termina en el tiempo de la más lenta.
+
+- La descarga va en streaming al ImageStore (aput_normalized_stream), con un límite
+  de tamaño: un archivo enorme se corta sin juntarlo entero en memoria.
+- La resolución media ID -> URL se cachea unos minutos (las URLs vencen a los ~5 min),
+  así un reintento no vuelve a pegarle a la Graph API.
+- Descargas del mismo media ID en curso se unifican (single-flight).
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+import requests
+import tracing
+from graph.images import ImageRef, ImageStore, image_store
+from whatsapp import AsyncWhatsapp
+
+logger = logging.getLogger(__name__)
+
+# Tope de una foto entrante (WhatsApp admite hasta 5 MB en imágenes; margen para reenvíos como documento)
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(16 * 1024 * 1024)))
+# Vigencia de la URL resuelta; menor que la expiración real de Meta (~5 minutos)
+MEDIA_URL_TTL = float(os.getenv("MEDIA_URL_TTL", "240"))
+MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_CONCURRENCY", "8"))
+MEDIA_CHUNK_BYTES = 64 * 1024
+_MAX_URL_ENTRIES = 1000
+
+
+class MediaTooLargeError(ValueError):
+    """El media supera MEDIA_MAX_BYTES"""
+
+
+class MediaFetcher:
+    """Resuelve y descarga media IDs de WhatsApp en paralelo, directo al ImageStore"""
+
+    def __init__(
+        self,
+        client: AsyncWhatsapp,
+        store: ImageStore = image_store,
+        max_bytes: int = MEDIA_MAX_BYTES,
+        url_ttl: float = MEDIA_URL_TTL,
+        concurrency: int = MEDIA_DOWNLOAD_CONCURRENCY,
+    ) -> None:
+        self.client = client
+        self.store = store
+        self.max_bytes = max_bytes
+        self.url_ttl = url_ttl
+        self.concurrency = concurrency
+        self._urls: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.downloads = 0
+        self.inflight_hits = 0
+        self.url_cache_hits = 0
+        self.stale_urls = 0
+        self.too_large = 0
+        self.failures = 0
+        self.bytes_downloaded = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.download_seconds = 0.0
+
+    def _limit(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def resolve(self, media_id: str) -> Dict[str, Any]:
+        """media ID -> {"url", "mime_type", "file_size"...}, cacheado mientras la URL siga vigente"""
+        entry = self._urls.get(media_id)
+        if entry is not None:
+            info, expires_at = entry
+            if expires_at > time.monotonic():
+                self.url_cache_hits += 1
+                return info
+            del self._urls[media_id]
+
+        info = await self.client.get_media_info(media_id)
+        if not info.get("url"):
+            error_detail = info.get("error", {}).get("message", "Unknown error")
+            raise ValueError(f"No se pudo obtener la URL del media: {error_detail}")
+        self._urls[media_id] = (info, time.monotonic() + self.url_ttl)
+        while len(self._urls) > _MAX_URL_ENTRIES:
+            self._urls.popitem(last=False)
+        return info
+
+    async def _limited(self, chunks: AsyncIterator[bytes], media_id: str) -> AsyncIterator[bytes]:
+        """Corta la descarga en cuanto supera max_bytes"""
+        total = 0
+        # aclosing: al cortar, la respuesta HTTP se cierra ya y no cuando la junte el GC
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                total += len(chunk)
+                if total > self.max_bytes:
+                    raise MediaTooLargeError(f"Media {media_id} exceeds {self.max_bytes} bytes")
+                yield chunk
+        self.bytes_downloaded += total
+
+    async def _download(self, media_id: str, mime_type: Optional[str]) -> ImageRef:
+        with tracing.span("media.download", media_id=media_id) as download_span:
+            async with self._limit():
+                started = time.perf_counter()
+                for attempt in range(2):
+                    cached = media_id in self._urls
+                    info = await self.resolve(media_id)
+                    size = int(info.get("file_size") or 0)
+                    download_span.set_attributes(url_cached=cached, file_size=size or None)
+                    if size > self.max_bytes:
+                        raise MediaTooLargeError(f"Media {media_id} is {size} bytes (max {self.max_bytes})")
+                    chunks = self._limited(self.client.stream_media(info["url"], MEDIA_CHUNK_BYTES), media_id)
+                    try:
+                        ref = await self.store.aput_normalized_stream(chunks, info.get("mime_type") or mime_type)
+                    except requests.exceptions.HTTPError:
+                        if not cached or attempt:
+                            raise
+                        # La URL cacheada venció antes de lo previsto: resolver de nuevo una vez
+                        self.stale_urls += 1
+                        self._urls.pop(media_id, None)
+                        continue
+                    break
+                self.downloads += 1
+                self.download_seconds += time.perf_counter() - started
+                download_span.set_attribute("stored_bytes", ref.size)
+                logger.info(f"Downloaded media {media_id} in {time.perf_counter() - started:.2f}s")
+                return ref
+
+    async def fetch(self, media_id: str, mime_type: Optional[str] = None) -> ImageRef:
+        """Descarga, normaliza y guarda un media; devuelve la referencia en el ImageStore"""
+        task = self._inflight.get(media_id)
+        if task is not None:
+            self.inflight_hits += 1
+            return await asyncio.shield(task)
+        task = asyncio.create_task(self._download(media_id, mime_type))
+        self._inflight[media_id] = task
+        task.add_done_callback(lambda _: self._inflight.pop(media_id, None))
+        try:
+            return await asyncio.shield(task)
+        except MediaTooLargeError:
+            self.too_large += 1
+            raise
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def fetch_many(
+        self, media: List[Tuple[str, Optional[str]]]
+    ) -> Dict[str, Union[ImageRef, Exception]]:
+        """
+        Descarga todos los (media_id, mime_type) a la vez. Devuelve media_id -> ImageRef
+        o la excepción de ese media: una foto que falla no tira abajo al resto.
+        """
+        if not media:
+            return {}
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(media))
+        results = await asyncio.gather(
+            *(self.fetch(media_id, mime_type) for media_id, mime_type in media), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+        return {media_id: result for (media_id, _), result in zip(media, results)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "downloads": self.downloads,
+            "inflight_hits": self.inflight_hits,
+            "url_cache_hits": self.url_cache_hits,
+            "stale_urls": self.stale_urls,
+            "too_large": self.too_large,
+            "failures": self.failures,
+            "bytes_downloaded": self.bytes_downloaded,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "avg_download_seconds": round(self.download_seconds / self.downloads, 3) if self.downloads else 0.0,
+        }
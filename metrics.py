@@ -0,0 +1,35 @@
+"""
+Registro mínimo de métricas del proceso.
+
+Cada componente (cola de ingesta, caches, schedulers...) registra una función que
+devuelve un dict con sus contadores; `snapshot()` las junta para el endpoint
+/metrics del webhook y para los logs periódicos de worker.py.
+"""
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+_lock = threading.Lock()
+
+
+def register(name: str, provider: Callable[[], Dict[str, Any]]) -> None:
+    """Registra (o reemplaza) un proveedor de métricas bajo `name`"""
+    with _lock:
+        _providers[name] = provider
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """Devuelve las métricas actuales de todos los proveedores registrados"""
+    with _lock:
+        providers = dict(_providers)
+    result: Dict[str, Dict[str, Any]] = {}
+    for name, provider in providers.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            logger.warning(f"Could not collect metrics for {name}: {e}")
+            result[name] = {"error": str(e)}
+    return result
@@ -0,0 +1,124 @@
+"""
+Servidor local que imita los endpoints de la Graph API de WhatsApp que usa el bot.
+
+Sirve para probar AsyncWhatsapp / Whatsapp sin tocar graph.facebook.com y para
+medir latencia de envío y reutilización de conexiones bajo carga:
+
+    uvicorn mock_graph_api:app --port 9000
+    WHATSAPP_API_BASE_URL=http://127.0.0.1:9000 uvicorn webhook:app --port 8000
+
+Variables de entorno para simular fallas:
+    MOCK_GRAPH_LATENCY_MS: latencia agregada a cada respuesta (default: 0)
+    MOCK_GRAPH_ERROR_RATE: probabilidad de responder 429/503 (default: 0)
+"""
+import os
+import uuid
+import random
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request, UploadFile, File, Form
+from fastapi.responses import JSONResponse, Response
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = FastAPI()
+
+LATENCY_MS = float(os.getenv("MOCK_GRAPH_LATENCY_MS", "0"))
+ERROR_RATE = float(os.getenv("MOCK_GRAPH_ERROR_RATE", "0"))
+
+# Estado en memoria para inspeccionar lo que "envió" el bot
+sent_messages: List[Dict[str, Any]] = []
+uploaded_media: Dict[str, Dict[str, Any]] = {}
+connections_seen: set = set()
+
+
+async def _simulate(request: Request) -> Optional[Response]:
+    """Agrega latencia, registra la conexión y opcionalmente inyecta un error"""
+    if request.client:
+        connections_seen.add((request.client.host, request.client.port))
+    if LATENCY_MS:
+        await asyncio.sleep(LATENCY_MS / 1000)
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        status = random.choice([429, 503])
+        return JSONResponse(
+            status_code=status,
+            content={"error": {"message": "Simulated failure", "code": status}},
+            headers={"Retry-After": "1"} if status == 429 else None,
+        )
+    return None
+
+
+# Antes que GET /{api_version}/{media_id}, que si no también matchea esta ruta
+@app.get("/_mock/stats")
+async def stats():
+    """Cantidad de mensajes recibidos y conexiones TCP distintas vistas"""
+    return {
+        "messages": len(sent_messages),
+        "media": len(uploaded_media),
+        "connections": len(connections_seen),
+    }
+
+
+@app.post("/{api_version}/{phone_number_id}/messages")
+async def post_message(api_version: str, phone_number_id: str, request: Request):
+    if (error := await _simulate(request)) is not None:
+        return error
+    payload = await request.json()
+    if payload.get("status") == "read":
+        return {"success": True}
+    sent_messages.append(payload)
+    return {
+        "messaging_product": "whatsapp",
+        "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+        "messages": [{"id": f"wamid.mock.{uuid.uuid4().hex}"}],
+    }
+
+
+@app.post("/{api_version}/{phone_number_id}/media")
+async def post_media(
+    api_version: str,
+    phone_number_id: str,
+    request: Request,
+    file: UploadFile = File(...),
+    messaging_product: str = Form(...),
+):
+    if (error := await _simulate(request)) is not None:
+        return error
+    media_id = uuid.uuid4().hex
+    content = await file.read()
+    uploaded_media[media_id] = {"content": content, "mime_type": file.content_type}
+    return {"id": media_id}
+
+
+@app.get("/media/{media_id}")
+async def download_media(media_id: str, request: Request):
+    if (error := await _simulate(request)) is not None:
+        return error
+    media = uploaded_media.get(media_id)
+    if not media:
+        return JSONResponse(status_code=404, content={"error": {"message": "Unknown media"}})
+    return Response(content=media["content"], media_type=media["mime_type"])
+
+
+@app.get("/{api_version}/{media_id}")
+async def get_media_info(api_version: str, media_id: str, request: Request):
+    if (error := await _simulate(request)) is not None:
+        return error
+    media = uploaded_media.get(media_id)
+    if not media:
+        return JSONResponse(status_code=404, content={"error": {"message": "Unknown media"}})
+    return {
+        "url": str(request.base_url) + f"media/{media_id}",
+        "mime_type": media["mime_type"],
+        "file_size": len(media["content"]),
+        "id": media_id,
+        "messaging_product": "whatsapp",
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("MOCK_GRAPH_PORT", 9000)))
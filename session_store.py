@@ -0,0 +1,366 @@
+"""
+Almacenamiento de sesiones (estado del graph por número de teléfono).
+
+- InMemorySessionStore: LRU en memoria con TTL por inactividad y un presupuesto
+  global de bytes; al superarlo expulsa primero las sesiones menos usadas.
+- SqliteSessionStore: igual que el anterior, pero las sesiones expulsadas se
+  guardan en SQLite y se recuperan de forma transparente en el próximo mensaje.
+- CheckpointSessionStore: usa el checkpointer de LangGraph como fuente de verdad,
+  así varios procesos worker comparten las conversaciones.
+
+Ambas reportan el uso de memoria estimado por sesión (ver estimate_state_size).
+"""
+import os
+import time
+import pickle
+import sqlite3
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = float(os.getenv("SESSION_TTL_SECONDS", str(6 * 3600)))
+DEFAULT_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024 * 1024)))
+DEFAULT_DB_PATH = os.getenv("SESSION_DB_PATH", "data/sessions.sqlite")
+# checkpoint | memory | sqlite (con memory/sqlite el graph corre sin checkpointer)
+SESSION_STORE = os.getenv("SESSION_STORE", "checkpoint").lower()
+
+# Overhead aproximado de cada objeto mensaje/dict además de su contenido
+_OBJECT_OVERHEAD = 256
+
+
+def estimate_size(value: Any) -> int:
+    """Estimación barata (sin recorrer objetos de Python a fondo) del tamaño en memoria"""
+    if value is None:
+        return 0
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return _OBJECT_OVERHEAD + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return _OBJECT_OVERHEAD + sum(estimate_size(item) for item in value.values())
+    content = getattr(value, "content", None)
+    if content is not None:
+        return _OBJECT_OVERHEAD + estimate_size(content)
+    return _OBJECT_OVERHEAD
+
+
+def estimate_state_size(state: Dict[str, Any]) -> int:
+    """Bytes estimados que ocupa una sesión (mensajes, imágenes, imagen generada)"""
+    return sum(estimate_size(value) for value in state.values())
+
+
+class SessionStore(ABC):
+    """Interfaz común de los almacenes de sesiones"""
+
+    @abstractmethod
+    async def get(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        """Devuelve la sesión o None si no existe"""
+
+    @abstractmethod
+    async def save(self, phone_number: str, state: Dict[str, Any]) -> None:
+        """Guarda (o actualiza) la sesión"""
+
+    @abstractmethod
+    async def delete(self, phone_number: str) -> None:
+        """Elimina la sesión"""
+
+    @abstractmethod
+    def memory_usage(self, phone_number: str) -> int:
+        """Bytes estimados en memoria de la sesión (0 si no está cargada)"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Métricas del almacén"""
+
+    async def get_or_create(self, phone_number: str, factory: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        state = await self.get(phone_number)
+        if state is None:
+            state = factory()
+            await self.save(phone_number, state)
+        return state
+
+
+class InMemorySessionStore(SessionStore):
+    """LRU en memoria con TTL por inactividad y presupuesto global de bytes"""
+
+    def __init__(self, ttl: Optional[float] = None, max_bytes: Optional[int] = None) -> None:
+        self.ttl = ttl or DEFAULT_TTL
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+        # phone -> (state, último acceso, bytes estimados)
+        self._sessions: "OrderedDict[str, Tuple[Dict[str, Any], float, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        await self._spill(self._expire())
+        with self._lock:
+            entry = self._sessions.get(phone_number)
+            if entry is None:
+                return None
+            state, _, size = entry
+            self._sessions[phone_number] = (state, time.monotonic(), size)
+            self._sessions.move_to_end(phone_number)
+            return state
+
+    async def save(self, phone_number: str, state: Dict[str, Any]) -> None:
+        size = estimate_state_size(state)
+        with self._lock:
+            previous = self._sessions.pop(phone_number, None)
+            if previous is not None:
+                self._total_bytes -= previous[2]
+            self._sessions[phone_number] = (state, time.monotonic(), size)
+            self._total_bytes += size
+        await self._spill(self._expire() + self._enforce_budget(keep=phone_number))
+
+    async def delete(self, phone_number: str) -> None:
+        with self._lock:
+            entry = self._sessions.pop(phone_number, None)
+            if entry is not None:
+                self._total_bytes -= entry[2]
+
+    def memory_usage(self, phone_number: str) -> int:
+        with self._lock:
+            entry = self._sessions.get(phone_number)
+            return entry[2] if entry else 0
+
+    def _expire(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Saca las sesiones inactivas por más de `ttl` segundos"""
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        with self._lock:
+            # El OrderedDict está ordenado por último acceso: basta mirar el principio
+            while self._sessions:
+                phone_number, (state, last_access, size) = next(iter(self._sessions.items()))
+                if last_access > deadline:
+                    break
+                self._sessions.popitem(last=False)
+                self._total_bytes -= size
+                self.expirations += 1
+                expired.append((phone_number, state))
+        return expired
+
+    def _enforce_budget(self, keep: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """Expulsa sesiones LRU hasta entrar en `max_bytes` (sin tocar la que se acaba de usar)"""
+        evicted = []
+        with self._lock:
+            while self._total_bytes > self.max_bytes and len(self._sessions) > 1:
+                phone_number = next(iter(self._sessions))
+                if phone_number == keep:
+                    self._sessions.move_to_end(phone_number)
+                    continue
+                state, _, size = self._sessions.pop(phone_number)
+                self._total_bytes -= size
+                self.evictions += 1
+                evicted.append((phone_number, state))
+        return evicted
+
+    async def _spill(self, sessions: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Qué hacer con las sesiones que salen de memoria (aquí: descartarlas)"""
+        for phone_number, _ in sessions:
+            logger.info(f"Session {phone_number} evicted from memory")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            largest = sorted(
+                ((phone, entry[2]) for phone, entry in self._sessions.items()),
+                key=lambda item: item[1],
+                reverse=True,
+            )[:10]
+            return {
+                "sessions": len(self._sessions),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "largest_sessions_bytes": dict(largest),
+            }
+
+
+class SqliteSessionStore(InMemorySessionStore):
+    """LRU en memoria que guarda en SQLite las sesiones frías en lugar de descartarlas"""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        super().__init__(ttl=ttl, max_bytes=max_bytes)
+        self.path = path or DEFAULT_DB_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (phone TEXT PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+        self.spilled = 0
+        self.restored = 0
+
+    async def get(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        state = await super().get(phone_number)
+        if state is not None:
+            return state
+        state = await asyncio.to_thread(self._load, phone_number)
+        if state is not None:
+            self.restored += 1
+            await super().save(phone_number, state)
+        return state
+
+    async def delete(self, phone_number: str) -> None:
+        await super().delete(phone_number)
+        await asyncio.to_thread(self._remove, phone_number)
+
+    async def _spill(self, sessions: List[Tuple[str, Dict[str, Any]]]) -> None:
+        if sessions:
+            await asyncio.to_thread(self._store, sessions)
+            self.spilled += len(sessions)
+
+    def _load(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT state FROM sessions WHERE phone = ?", (phone_number,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def _store(self, sessions: List[Tuple[str, Dict[str, Any]]]) -> None:
+        rows = [(phone, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), time.time()) for phone, state in sessions]
+        with self._db_lock:
+            self._conn.executemany("INSERT OR REPLACE INTO sessions (phone, state, updated_at) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def _remove(self, phone_number: str) -> None:
+        with self._db_lock:
+            self._conn.execute("DELETE FROM sessions WHERE phone = ?", (phone_number,))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        with self._db_lock:
+            stats["on_disk"] = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        stats["spilled"] = self.spilled
+        stats["restored"] = self.restored
+        return stats
+
+
+class CheckpointSessionStore(SessionStore):
+    """
+    Sesiones persistidas en el checkpointer del graph (thread_id = teléfono).
+    
+    No retiene estado en memoria entre mensajes: cada lote lee el último checkpoint,
+    y ejecutar el graph con la misma config ya persiste el resultado.
+    
+    Cada paso del graph y cada save agregan un checkpoint; como solo se lee el último,
+    al guardar se borran los anteriores del mismo thread (la base no crece por turno).
+    """
+
+    # Nodo en nombre del cual se registran los cambios hechos fuera del graph
+    UPDATE_AS_NODE = "triage"
+    # Teléfonos cuyo tamaño se recuerda para las métricas (LRU)
+    MAX_TRACKED_SIZES = 10_000
+
+    def __init__(self, agent_factory: Callable[[], Awaitable[Any]]) -> None:
+        self._agent_factory = agent_factory
+        self._last_sizes: "OrderedDict[str, int]" = OrderedDict()
+        self.loads = 0
+        self.saves = 0
+        self.pruned = 0
+
+    @staticmethod
+    def _config(phone_number: str) -> Dict[str, Any]:
+        return {"configurable": {"thread_id": phone_number}}
+
+    async def get(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        agent = await self._agent_factory()
+        snapshot = await agent.aget_state(self._config(phone_number))
+        self.loads += 1
+        if not snapshot.values:
+            return None
+        state = dict(snapshot.values)
+        self._track_size(phone_number, state)
+        return state
+
+    async def save(self, phone_number: str, state: Dict[str, Any]) -> None:
+        agent = await self._agent_factory()
+        await agent.aupdate_state(self._config(phone_number), state, as_node=self.UPDATE_AS_NODE)
+        self._track_size(phone_number, state)
+        self.saves += 1
+        await self._prune(agent.checkpointer, phone_number)
+
+    def _track_size(self, phone_number: str, state: Dict[str, Any]) -> None:
+        self._last_sizes[phone_number] = estimate_state_size(state)
+        self._last_sizes.move_to_end(phone_number)
+        while len(self._last_sizes) > self.MAX_TRACKED_SIZES:
+            self._last_sizes.popitem(last=False)
+
+    async def _prune(self, checkpointer: Any, phone_number: str) -> None:
+        """Deja solo el último checkpoint del thread y sus writes"""
+        # AsyncSqliteSaver no implementa aprune() y la API pública solo borra el thread entero:
+        # se usan su conexión, su lock y sus tablas, por eso la versión está fijada en
+        # requirements.txt. Los checkpoint_id son uuid6 (ordenados por tiempo también como
+        # texto): "el último" es el mismo MAX que usa el saver (ORDER BY checkpoint_id DESC)
+        async with checkpointer.lock, checkpointer.conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id < ("
+                "SELECT MAX(checkpoint_id) FROM checkpoints AS latest "
+                "WHERE latest.thread_id = checkpoints.thread_id AND latest.checkpoint_ns = checkpoints.checkpoint_ns)",
+                (phone_number,),
+            )
+            deleted = cur.rowcount
+            await cur.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND NOT EXISTS ("
+                "SELECT 1 FROM checkpoints AS kept WHERE kept.thread_id = writes.thread_id "
+                "AND kept.checkpoint_ns = writes.checkpoint_ns AND kept.checkpoint_id = writes.checkpoint_id)",
+                (phone_number,),
+            )
+            await checkpointer.conn.commit()
+        self.pruned += max(deleted, 0)
+
+    async def delete(self, phone_number: str) -> None:
+        agent = await self._agent_factory()
+        await agent.checkpointer.adelete_thread(phone_number)
+        self._last_sizes.pop(phone_number, None)
+
+    def memory_usage(self, phone_number: str) -> int:
+        # Tamaño del estado la última vez que este proceso lo cargó o guardó
+        return self._last_sizes.get(phone_number, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        largest = sorted(self._last_sizes.items(), key=lambda item: item[1], reverse=True)[:10]
+        return {
+            "backend": "checkpoint",
+            "loads": self.loads,
+            "saves": self.saves,
+            "pruned_checkpoints": self.pruned,
+            "largest_sessions_bytes": dict(largest),
+        }
+
+
+def create_session_store(agent_factory: Optional[Callable[[], Awaitable[Any]]] = None) -> SessionStore:
+    """Crea el almacén configurado en SESSION_STORE (checkpoint | memory | sqlite)"""
+    kind = SESSION_STORE
+    if kind == "checkpoint":
+        if agent_factory is None:
+            raise ValueError("SESSION_STORE=checkpoint requires an agent factory")
+        return CheckpointSessionStore(agent_factory)
+    if kind == "sqlite":
+        return SqliteSessionStore()
+    if kind == "memory":
+        return InMemorySessionStore()
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
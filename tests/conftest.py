@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Los módulos del bot viven en la raíz del repo (sin paquete instalable)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# graph.tools y background_processor crean los clientes de Gemini y WhatsApp al
+# importarse; los tests nunca los llaman
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("WHATSAPP_TOKEN", "test-token")
+os.environ.setdefault("WHATSAPP_PHONE_NUMBER_ID", "1234567890")
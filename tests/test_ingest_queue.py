@@ -0,0 +1,213 @@
+import threading
+
+import pytest
+
+import ingest_queue
+from ingest_queue import IngestQueue
+
+
+class FakeClock:
+    """Reemplaza time.time() dentro de ingest_queue para controlar leases y ventanas"""
+
+    def __init__(self, now: float = 1_000_000.0) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(ingest_queue, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "ingest_queue.sqlite")
+
+
+def make_queue(path, **kwargs):
+    options = {"visibility_timeout": 30, "max_attempts": 3, "debounce_quiet": 0, "debounce_max": 0}
+    options.update(kwargs)
+    return IngestQueue(path, **options)
+
+
+def text(message_id, body="hola"):
+    return {"id": message_id, "from": "5491", "type": "text", "text": {"body": body}}
+
+
+def claimed_ids(claimed):
+    return sorted(item.message["id"] for items in claimed.values() for item in items)
+
+
+def test_claim_returns_messages_in_order_and_hides_them(clock, db_path):
+    queue = make_queue(db_path)
+    queue.append("5491", text("a"), {})
+    queue.append("5491", text("b"), {})
+    queue.append("5492", text("c"), {})
+
+    claimed = queue.claim("w1")
+
+    assert [item.message["id"] for item in claimed["5491"]] == ["a", "b"]
+    assert [item.message["id"] for item in claimed["5492"]] == ["c"]
+    assert all(item.attempts == 1 for items in claimed.values() for item in items)
+    assert queue.claim("w2") == {}
+    assert queue.stats()["in_flight"] == 3
+
+
+def test_claim_race_between_two_connections(clock, db_path):
+    first, second = make_queue(db_path), make_queue(db_path)
+    for i in range(50):
+        first.append(f"54{i % 10}", text(f"m{i}"), {})
+
+    barrier = threading.Barrier(2)
+    results = {}
+
+    def worker(name, queue):
+        barrier.wait()
+        results[name] = queue.claim(name, max_phones=10)
+
+    threads = [threading.Thread(target=worker, args=(name, queue)) for name, queue in (("w1", first), ("w2", second))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids_w1, ids_w2 = claimed_ids(results["w1"]), claimed_ids(results["w2"])
+    assert not set(ids_w1) & set(ids_w2)
+    assert sorted(ids_w1 + ids_w2) == sorted(f"m{i}" for i in range(50))
+    # Un mismo teléfono nunca queda repartido entre dos workers
+    assert not set(results["w1"]) & set(results["w2"])
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(clock, db_path):
+    queue = make_queue(db_path, visibility_timeout=10)
+    queue.append("5491", text("a"), {})
+    [item] = queue.claim("w1")["5491"]
+
+    clock.advance(5)
+    assert queue.claim("w2") == {}
+
+    clock.advance(6)
+    [reclaimed] = queue.claim("w2")["5491"]
+    assert reclaimed.id == item.id
+    assert reclaimed.attempts == 2
+
+    # El worker que perdió el lease ya no puede confirmarlo ni liberarlo
+    queue.ack([item.id], "w1")
+    queue.release([item.id], "w1")
+    assert queue.stats()["in_flight"] == 1
+
+    queue.ack([reclaimed.id], "w2")
+    assert queue.stats()["depth"] == 0
+
+
+def test_extend_keeps_the_lease_alive(clock, db_path):
+    queue = make_queue(db_path, visibility_timeout=10)
+    queue.append("5491", text("a"), {})
+    [item] = queue.claim("w1")["5491"]
+
+    clock.advance(8)
+    queue.extend([item.id], "w1")
+    clock.advance(8)
+
+    assert queue.claim("w2") == {}
+
+
+def test_release_backs_off_then_dead_letters(clock, db_path):
+    queue = make_queue(db_path, max_attempts=2)
+    queue.append("5491", text("a"), {})
+
+    [item] = queue.claim("w1")["5491"]
+    queue.release([item.id], "w1", delay=4)
+    assert queue.claim("w1") == {}
+
+    clock.advance(4)
+    [retry] = queue.claim("w1")["5491"]
+    assert retry.attempts == 2
+
+    queue.release([retry.id], "w1", delay=4)
+    clock.advance(10)
+    assert queue.claim("w1") == {}
+    assert queue.stats() == {**queue.stats(), "depth": 0, "in_flight": 0, "dead": 1}
+
+
+def test_expired_lease_after_last_attempt_goes_to_dead_letter(clock, db_path):
+    queue = make_queue(db_path, visibility_timeout=10, max_attempts=1)
+    queue.append("5491", text("a"), {})
+    queue.claim("w1")
+
+    clock.advance(11)
+
+    assert queue.claim("w2") == {}
+    assert queue.stats()["dead"] == 1
+
+
+def test_retrying_phone_blocks_its_newer_messages(clock, db_path):
+    queue = make_queue(db_path)
+    queue.append("5491", text("a"), {})
+    [item] = queue.claim("w1")["5491"]
+    queue.release([item.id], "w1", delay=5)
+
+    queue.append("5491", text("b"), {})
+    assert queue.claim("w1") == {}
+
+    clock.advance(5)
+    assert claimed_ids(queue.claim("w1")) == ["a", "b"]
+
+
+def test_ack_is_idempotent(clock, db_path):
+    queue = make_queue(db_path)
+    queue.append("5491", text("a"), {})
+    [item] = queue.claim("w1")["5491"]
+
+    queue.ack([item.id], "w1")
+    queue.ack([item.id], "w1")
+    queue.ack([], "w1")
+
+    assert queue.stats()["depth"] == 0
+    assert queue.claim("w1") == {}
+
+
+def test_debounce_waits_for_quiet_window(clock, db_path):
+    queue = make_queue(db_path, debounce_quiet=1.0, debounce_max=5.0)
+    queue.append("5491", text("a"), {})
+    clock.advance(0.5)
+    queue.append("5491", text("b"), {})
+
+    clock.advance(0.9)
+    assert queue.claim("w1") == {}
+
+    clock.advance(0.2)
+    assert claimed_ids(queue.claim("w1")) == ["a", "b"]
+
+
+def test_debounce_cap_claims_a_phone_that_keeps_writing(clock, db_path):
+    queue = make_queue(db_path, debounce_quiet=1.0, debounce_max=3.0)
+    for i in range(6):
+        queue.append("5491", text(f"m{i}"), {})
+        clock.advance(0.6)
+        if clock.now - 1_000_000.0 < 3.0:
+            assert queue.claim("w1") == {}
+
+    assert claimed_ids(queue.claim("w1")) == [f"m{i}" for i in range(6)]
+
+
+def test_append_drops_redeliveries_of_the_same_message_id(clock, db_path):
+    queue = make_queue(db_path, dedupe_ttl=60)
+    assert queue.append("5491", text("a"), {}) is not None
+    assert make_queue(db_path).append("5491", text("a"), {}) is None
+
+    [item] = queue.claim("w1")["5491"]
+    queue.ack([item.id], "w1")
+    # Ya procesado y borrado de la cola: sigue siendo una reentrega dentro del TTL
+    assert queue.append("5491", text("a"), {}) is None
+
+    clock.advance(61)
+    assert queue.append("5491", text("a"), {}) is not None
+    assert queue.stats()["duplicates"] == 1
@@ -0,0 +1,77 @@
+import asyncio
+
+from langchain.messages import AIMessage, HumanMessage, SystemMessage
+
+from graph.llm_cache import CachedAgent, ResponseCache
+from graph.tools import PromptSO, TriageSO
+
+SYSTEM = SystemMessage("You are an image agent")
+
+
+class FakeRunnable:
+    """Devuelve las respuestas en orden y cuenta las llamadas al "LLM" """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def invoke(agent, messages, **state):
+    return asyncio.run(agent.ainvoke([SYSTEM, *messages], state={"messages": messages, **state}))
+
+
+def test_a_later_turn_hits_across_different_histories():
+    runnable = FakeRunnable(TriageSO(interpreted_feature="txt_to_img"))
+    agent = CachedAgent(runnable, "triage", TriageSO, state_fields=("awaiting",), canonical=True, cache=ResponseCache())
+    menu = AIMessage("¿Qué querés hacer?")
+
+    invoke(agent, [HumanMessage("hola"), menu, HumanMessage("generar imágenes")], awaiting="feature")
+    response = invoke(agent, [HumanMessage("buenas!"), menu, HumanMessage("Generar IMAGENES")], awaiting="feature")
+
+    assert response.interpreted_feature == "txt_to_img"
+    assert runnable.calls == 1
+
+
+def test_prompt_reader_keys_on_the_raw_text():
+    runnable = FakeRunnable(PromptSO(user_prompt="Un gato en São Paulo"), PromptSO(user_prompt="un gato en sao paulo"))
+    agent = CachedAgent(runnable, "prompt_reader", PromptSO, state_fields=("awaiting",), cache=ResponseCache())
+
+    invoke(agent, [HumanMessage("Un gato en São Paulo")])
+    response = invoke(agent, [HumanMessage("un gato en sao paulo")])
+
+    assert response.user_prompt == "un gato en sao paulo"
+    assert runnable.calls == 2
+
+
+def test_a_confirmation_never_reuses_another_conversation():
+    runnable = FakeRunnable(PromptSO(user_prompt="a red fox"), PromptSO(user_prompt="a lighthouse"))
+    agent = CachedAgent(runnable, "prompt_reader", PromptSO, cache=ResponseCache())
+
+    invoke(agent, [HumanMessage("a red fox"), AIMessage("Generate 'a red fox'?"), HumanMessage("yes")])
+    response = invoke(agent, [HumanMessage("a lighthouse"), AIMessage("Generate 'a lighthouse'?"), HumanMessage("yes")])
+
+    assert response.user_prompt == "a lighthouse"
+
+
+def test_node_state_fields_are_part_of_the_key():
+    runnable = FakeRunnable(PromptSO(user_prompt="a"), PromptSO(user_prompt="b"))
+    agent = CachedAgent(runnable, "prompt_reader", PromptSO, state_fields=("user_last_prompt",), cache=ResponseCache())
+
+    invoke(agent, [HumanMessage("otra")], user_last_prompt="un gato")
+    invoke(agent, [HumanMessage("otra")], user_last_prompt="un perro")
+
+    assert runnable.calls == 2
+
+
+def test_without_state_the_call_is_not_cached():
+    runnable = FakeRunnable(TriageSO(), TriageSO())
+    agent = CachedAgent(runnable, "triage", TriageSO, cache=ResponseCache())
+
+    for _ in range(2):
+        asyncio.run(agent.ainvoke([SYSTEM, HumanMessage("hola")]))
+
+    assert runnable.calls == 2
@@ -0,0 +1,89 @@
+import pytest
+from langchain.messages import AIMessage, HumanMessage, SystemMessage
+
+from graph.router import detect_language, fast_route
+
+
+def route(text, **state):
+    return fast_route({"messages": [HumanMessage(text)], **state})
+
+
+@pytest.mark.parametrize("text", [
+    "generame una imagen de un gato astronauta",
+    "creá una ilustración de una ciudad futurista",
+    "haceme un dibujo de un perro",
+    "dibujame una foto de la playa al atardecer",
+    "generate an image of a red fox in the snow",
+    "make me a picture of a lighthouse",
+    "draw an illustration of a castle",
+    "gere uma imagem de um cachorro",
+    "cria uma foto de uma praia",
+    "faça um desenho de um gato",
+])
+def test_generate_requests_go_to_txt_to_img(text):
+    decision = route(text)
+    assert (decision.route, decision.reason) == ("txt_to_img", "generate_keywords")
+
+
+@pytest.mark.parametrize("text", [
+    "haceme un resumen de una película",
+    "creá una lista de una semana de comidas",
+    "generá un texto de un párrafo",
+    "make a summary of an article",
+    "create a list of a few ideas",
+    "write a poem of a sunset",
+    "faz um resumo de um livro",
+    "cria uma lista de uma semana",
+    "no quiero una imagen de un gato",
+    "don't generate an image of a dog",
+    "não gere uma imagem de um cachorro",
+    "¿qué modelo usás?",
+])
+def test_non_image_requests_fall_back_to_the_llm(text):
+    decision = route(text)
+    assert decision.route is None and decision.reply is None
+
+
+@pytest.mark.parametrize("text, language", [
+    ("hola!", "es"),
+    ("buenas tardes", "es"),
+    ("hello", "en"),
+    ("good morning!", "en"),
+    ("oi", "pt"),
+    ("bom dia", "pt"),
+])
+def test_greetings_get_a_canned_reply_in_their_language(text, language):
+    decision = route(text)
+    assert decision.route is None
+    assert decision.reason == f"greeting_{language}"
+
+
+@pytest.mark.parametrize("text", [
+    "cambiale el fondo a azul",
+    "make it darker",
+    "mude a cor do carro",
+])
+def test_edits_with_a_previous_image_go_to_img_to_img(text):
+    assert route(text, last_output="https://fal.media/out.png").route == "img_to_img"
+    # Sin imagen previa la edición no tiene a qué aplicarse: decide el LLM
+    assert route(text).route is None
+
+
+def test_generate_referring_to_a_previous_image_falls_back_to_the_llm():
+    assert route("generá otra imagen como esta", last_output="https://fal.media/out.png").route is None
+
+
+def test_images_in_the_turn_go_to_img_to_img():
+    messages = [AIMessage("listo"), SystemMessage("1 image(s) added to chat"), HumanMessage("hola")]
+    decision = fast_route({"messages": messages})
+    assert (decision.route, decision.reason) == ("img_to_img", "image_message")
+
+
+@pytest.mark.parametrize("text, language", [
+    ("quiero una imagen con el mar", "es"),
+    ("I want a picture of the sea", "en"),
+    ("quero uma imagem com o mar", "pt"),
+    ("ok", None),
+])
+def test_detect_language(text, language):
+    assert detect_language(text) == language
@@ -0,0 +1,55 @@
+import asyncio
+import operator
+from typing import Annotated, List, TypedDict
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph import START, END, StateGraph
+
+from session_store import CheckpointSessionStore
+
+
+class CounterState(TypedDict):
+    turns: Annotated[List[int], operator.add]
+    current_node: str
+
+
+def make_agent(path):
+    graph = StateGraph(CounterState)
+    graph.add_node("triage", lambda state: {"current_node": "triage"})
+    graph.add_edge(START, "triage")
+    graph.add_edge("triage", END)
+    return graph.compile(checkpointer=AsyncSqliteSaver(aiosqlite.connect(path)))
+
+
+def test_save_keeps_only_the_latest_checkpoint(tmp_path):
+    """_prune usa el esquema interno de AsyncSqliteSaver: este test avisa si cambia al actualizarlo"""
+
+    async def run():
+        agent = make_agent(str(tmp_path / "checkpoints.sqlite"))
+
+        async def factory():
+            return agent
+
+        store = CheckpointSessionStore(factory)
+        try:
+            await agent.ainvoke({"turns": [0]}, store._config("5491"))
+            await agent.ainvoke({"turns": [0]}, store._config("5492"))
+            for turn in range(1, 4):
+                await store.save("5491", {"turns": [turn]})
+
+            async with agent.checkpointer.conn.execute(
+                "SELECT thread_id, COUNT(*) FROM checkpoints GROUP BY thread_id ORDER BY thread_id"
+            ) as cursor:
+                counts = dict(await cursor.fetchall())
+            return counts, await store.get("5491"), store.pruned
+        finally:
+            await agent.checkpointer.conn.close()
+
+    counts, state, pruned = asyncio.run(run())
+
+    assert counts["5491"] == 1
+    # Los demás threads no se tocan
+    assert counts["5492"] > 1
+    assert state["turns"] == [0, 1, 2, 3]
+    assert pruned > 0
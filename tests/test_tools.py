@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+from graph.tools import EmptyResultError, nanoclient
+
+
+@pytest.mark.parametrize("result", [{"images": []}, {"description": "blocked"}])
+def test_a_result_without_images_raises_a_clear_error(result):
+    with pytest.raises(EmptyResultError, match="returned no images"):
+        asyncio.run(nanoclient._result_image(result))
+
+
+def test_a_result_keeps_the_fal_url_without_downloading():
+    image = {"url": "https://v3.fal.media/files/out.png", "content_type": "image/png", "file_size": 123}
+
+    ref = asyncio.run(nanoclient._result_image({"images": [image]}))
+
+    assert (ref.url, ref.size, ref.is_local) == (image["url"], 123, False)
+
+
+def test_an_empty_result_is_not_retried():
+    from background_processor import _is_transient
+
+    assert not _is_transient(EmptyResultError("fal.ai returned no images"))
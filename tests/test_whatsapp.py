@@ -0,0 +1,74 @@
+import asyncio
+
+import httpx
+import pytest
+
+pytest.importorskip("multipart", reason="mock_graph_api recibe uploads multipart")
+
+import mock_graph_api
+from whatsapp import AsyncWhatsapp, WhatsappAPIError
+
+MOCK_HOST = "http://graph.test"
+
+
+@pytest.fixture
+def mock_graph(monkeypatch):
+    """AsyncWhatsapp apuntando a mock_graph_api en proceso, sin abrir sockets"""
+    monkeypatch.setenv("WHATSAPP_API_BASE_URL", MOCK_HOST)
+    monkeypatch.setattr(mock_graph_api, "sent_messages", [])
+    monkeypatch.setattr(mock_graph_api, "uploaded_media", {})
+    monkeypatch.setattr(
+        AsyncWhatsapp, "_client",
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=mock_graph_api.app), base_url=MOCK_HOST),
+    )
+    yield mock_graph_api
+    asyncio.run(AsyncWhatsapp.aclose())
+
+
+def make_client(**kwargs):
+    client = AsyncWhatsapp("test-token", "1234567890", **kwargs)
+    client.send_rate = 0
+    return client
+
+
+def test_send_text_reaches_the_graph_api(mock_graph):
+    response = asyncio.run(make_client().send_text("+54 9 11 0000-0000", "hola"))
+
+    assert response["messages"][0]["id"].startswith("wamid.mock.")
+    [payload] = mock_graph.sent_messages
+    assert payload["type"] == "text"
+    assert payload["text"]["body"] == "hola"
+
+
+def test_uploaded_media_can_be_resolved_and_downloaded(mock_graph):
+    async def roundtrip():
+        client = make_client()
+        media_id = await client.upload_media(b"\x89PNG fake", mime_type="image/png")
+        info = await client.get_media_info(media_id)
+        content = await client.download_media(info["url"])
+        chunks = [chunk async for chunk in client.stream_media(info["url"], chunk_size=4)]
+        return info, content, b"".join(chunks)
+
+    info, content, streamed = asyncio.run(roundtrip())
+
+    assert info["mime_type"] == "image/png"
+    assert content == streamed == b"\x89PNG fake"
+
+
+def test_graph_errors_carry_the_status_code(mock_graph):
+    with pytest.raises(WhatsappAPIError) as error:
+        asyncio.run(make_client().get_media_info("does-not-exist"))
+
+    assert error.value.status_code == 404
+
+
+def test_post_retries_on_503_then_raises_with_the_status(mock_graph, monkeypatch):
+    monkeypatch.setattr(mock_graph, "ERROR_RATE", 1.0)
+    monkeypatch.setattr(mock_graph.random, "choice", lambda statuses: 503)
+    client = make_client(max_retries=2, backoff_base=0, backoff_cap=0)
+
+    with pytest.raises(WhatsappAPIError) as error:
+        asyncio.run(client.send_text("5491100000000", "hola"))
+
+    assert error.value.status_code == 503
+    assert mock_graph.sent_messages == []
@@ -0,0 +1,403 @@
+"""
+Tracing de latencia del pipeline con spans al estilo OpenTelemetry.
+
+Cada etapa (recepción en el webhook, espera en la cola, descarga de media, nodos del
+graph, llamadas a Gemini, jobs y subidas de fal.ai, envíos de WhatsApp) abre un span
+con `span(...)`; los spans anidados heredan el trace del span actual (contextvars, así
+que también cruzan asyncio.create_task).
+
+Los spans de un mensaje se correlacionan por su id de WhatsApp: el trace_id y el span
+raíz (la recepción en el webhook) se derivan del id, así el webhook y el worker (otro
+proceso) llegan al mismo trace sin propagar contexto por la cola. Un lote de varios
+mensajes se traza en el trace del primero, con links a los demás.
+
+Exportación (TRACE_EXPORTER), en un thread aparte y en lotes:
+  - "file": un span por línea en JSONL (TRACE_FILE)
+  - "otlp": POST a un collector OTLP/HTTP en JSON (TRACE_OTLP_ENDPOINT)
+  - "" (default): no exporta; la métrica "tracing" igual resume p50/p95/p99 por span
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "data/traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "nanolang")
+# Spans que se mandan juntos y cada cuánto se vacía la cola del exportador
+TRACE_EXPORT_BATCH = 256
+TRACE_EXPORT_INTERVAL = 2.0
+_EXPORT_QUEUE_SIZE = 10000
+# Duraciones recientes que se guardan por nombre de span para los percentiles
+_LATENCY_SAMPLES = 1000
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def message_root(message_id: str) -> Tuple[str, str]:
+    """(trace_id, span_id) del span raíz de un mensaje, estables entre procesos"""
+    digest = hashlib.sha256(message_id.encode("utf-8")).hexdigest()
+    return digest[:32], digest[32:48]
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    end: Optional[float] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    links: List[Tuple[str, str]] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or time.time()) - self.start)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes: Any) -> None:
+        self.events.append({"name": name, "time": time.time(), "attributes": attributes})
+
+    def record_exception(self, exc: BaseException) -> None:
+        self.error = f"{type(exc).__name__}: {exc}"
+        self.add_event("exception", type=type(exc).__name__, message=str(exc))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "events": self.events,
+            "links": [{"trace_id": trace_id, "span_id": span_id} for trace_id, span_id in self.links],
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "service": TRACE_SERVICE_NAME,
+            "pid": os.getpid(),
+        }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _nanos(seconds: float) -> str:
+    return str(int(seconds * 1_000_000_000))
+
+
+def to_otlp(spans: Sequence[Span]) -> Dict[str, Any]:
+    """Lote de spans en el encoding JSON de OTLP (ExportTraceServiceRequest)"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME, "process.pid": os.getpid()})},
+            "scopeSpans": [{
+                "scope": {"name": "nanolang.tracing"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        "parentSpanId": span.parent_id or "",
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": _nanos(span.start),
+                        "endTimeUnixNano": _nanos(span.end or span.start),
+                        "attributes": _otlp_attributes(span.attributes),
+                        "events": [
+                            {"timeUnixNano": _nanos(event["time"]), "name": event["name"], "attributes": _otlp_attributes(event["attributes"])}
+                            for event in span.events
+                        ],
+                        "links": [{"traceId": trace_id, "spanId": span_id} for trace_id, span_id in span.links],
+                        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+
+class SpanExporter:
+    """Exporta spans terminados desde un thread, en lotes, sin bloquear el event loop"""
+
+    def __init__(self, kind: str = TRACE_EXPORTER, path: str = TRACE_FILE, endpoint: str = TRACE_OTLP_ENDPOINT) -> None:
+        self.kind = kind
+        self.path = path
+        self.endpoint = endpoint
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=_EXPORT_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.kind in ("file", "otlp")
+
+    def export(self, span: Span) -> None:
+        if not self.enabled:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Mejor perder spans que frenar el pipeline
+            self.dropped += 1
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Span] = []
+            stop = False
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+            while len(batch) < TRACE_EXPORT_BATCH:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch: List[Span]) -> None:
+        try:
+            if self.kind == "file":
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in batch)
+                # Una sola escritura por lote en modo append: varios procesos pueden compartir el archivo
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            else:
+                if self._client is None:
+                    self._client = httpx.Client(timeout=10.0)
+                response = self._client.post(self.endpoint, json=to_otlp(batch))
+                response.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.failures += 1
+            self.dropped += len(batch)
+            logger.warning(f"Could not export {len(batch)} spans to {self.kind}: {e}")
+
+    def shutdown(self) -> None:
+        """Vacía lo pendiente y detiene el thread"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout=5.0)
+        self._thread = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+class Tracer:
+    """Registra spans terminados: percentiles en memoria por nombre y exportación"""
+
+    def __init__(self, exporter: Optional[SpanExporter] = None) -> None:
+        self.exporter = exporter or SpanExporter()
+        self._durations: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def finish(self, span: Span) -> None:
+        if span.end is None:
+            span.end = time.time()
+        with self._lock:
+            self._durations.setdefault(span.name, deque(maxlen=_LATENCY_SAMPLES)).append(span.duration)
+            self._counts[span.name] = self._counts.get(span.name, 0) + 1
+            if span.error:
+                self._errors[span.name] = self._errors.get(span.name, 0) + 1
+        self.exporter.export(span)
+
+    @staticmethod
+    def _percentile(ordered: List[float], q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            durations = {name: sorted(samples) for name, samples in self._durations.items()}
+            counts = dict(self._counts)
+            errors = dict(self._errors)
+        latency = {}
+        for name, ordered in sorted(durations.items()):
+            latency[name] = {
+                "count": counts[name],
+                "errors": errors.get(name, 0),
+                "p50_ms": round(self._percentile(ordered, 0.50) * 1000, 1),
+                "p95_ms": round(self._percentile(ordered, 0.95) * 1000, 1),
+                "p99_ms": round(self._percentile(ordered, 0.99) * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        return {
+            "enabled": TRACING_ENABLED,
+            "exporter": self.exporter.kind or None,
+            "exported": self.exporter.exported,
+            "dropped": self.exporter.dropped,
+            "export_failures": self.exporter.failures,
+            "latency": latency,
+        }
+
+
+tracer = Tracer()
+atexit.register(tracer.exporter.shutdown)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def set_attributes(**attributes: Any) -> None:
+    """Agrega atributos al span actual, si hay uno"""
+    span = _current.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+@contextmanager
+def span(
+    name: str,
+    *,
+    trace_id: Optional[str] = None,
+    parent_id: Optional[str] = None,
+    span_id: Optional[str] = None,
+    links: Sequence[Tuple[str, str]] = (),
+    **attributes: Any,
+) -> Iterator[Span]:
+    """
+    Abre un span hijo del actual (o un trace nuevo). `trace_id`/`parent_id` permiten
+    colgarlo de un trace conocido, por ejemplo el de un mensaje (message_root).
+    """
+    parent = _current.get()
+    if trace_id is None and parent is not None:
+        trace_id, parent_id = parent.trace_id, parent_id or parent.span_id
+    current = Span(
+        name=name,
+        trace_id=trace_id or _new_id(16),
+        span_id=span_id or _new_id(8),
+        parent_id=parent_id,
+        attributes={key: value for key, value in attributes.items() if value is not None},
+        links=list(links),
+    )
+    if not TRACING_ENABLED:
+        yield current
+        return
+    token = _current.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.set_attribute("cancelled", True)
+        raise
+    except BaseException as e:
+        current.record_exception(e)
+        raise
+    finally:
+        _current.reset(token)
+        tracer.finish(current)
+
+
+def message_span(name: str, message_ids: Sequence[str], **attributes: Any):
+    """Span colgado del trace del primer mensaje, con links a los demás"""
+    if not message_ids:
+        return span(name, **attributes)
+    trace_id, root_id = message_root(message_ids[0])
+    return span(
+        name,
+        trace_id=trace_id,
+        parent_id=root_id,
+        links=[message_root(message_id) for message_id in message_ids[1:]],
+        message_ids=list(message_ids),
+        **attributes,
+    )
+
+
+def record_span(name: str, start: float, end: float, *, trace_id: str, parent_id: Optional[str] = None, **attributes: Any) -> None:
+    """Registra un span que ya pasó (ej. la espera en la cola, medida desde enqueued_at)"""
+    if not TRACING_ENABLED:
+        return
+    tracer.finish(Span(
+        name=name,
+        trace_id=trace_id,
+        span_id=_new_id(8),
+        parent_id=parent_id,
+        start=start,
+        end=end,
+        attributes={key: value for key, value in attributes.items() if value is not None},
+    ))
+
+
+def traced(name: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """Decorador para funciones async: todo el llamado queda en un span `name`"""
+    def decorator(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def shutdown() -> None:
+    tracer.exporter.shutdown()
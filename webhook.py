@@ -1,20 +1,69 @@
 import os
+import asyncio
 import logging
-from fastapi import FastAPI, Request, Query, HTTPException, BackgroundTasks
+import sqlite3
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
+from fastapi import FastAPI, Request, Query, HTTPException
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
-from whatsapp import Whatsapp
-from background_processor import process_message_background
+load_dotenv()
+import metrics
+import tracing
+from whatsapp import Whatsapp, AsyncWhatsapp
+from ingest_queue import IngestQueue
+from dedupe import message_dedupe
 
 wp = Whatsapp()
 
-load_dotenv()
-
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+metrics.register("dedupe", message_dedupe.stats)
+metrics.register("tracing", tracing.tracer.stats)
+
+# Worker embebido para correr todo en un solo proceso (desactivar si se usa worker.py)
+EMBEDDED_WORKER = os.getenv("INGEST_EMBEDDED_WORKER", "1") == "1"
+
+# Cola durable: el webhook solo agrega mensajes, los workers los procesan
+_ingest_queue: Optional[IngestQueue] = None
+
+def get_ingest_queue() -> IngestQueue:
+    """
+    Abre la cola en el primer uso (el lifespan), no al importar el módulo: con
+    `python webhook.py` los procesos spawn del pool de imaging.py vuelven a ejecutar
+    el nivel superior de este archivo, y no deben abrir la base de la cola.
+    """
+    global _ingest_queue
+    if _ingest_queue is None:
+        _ingest_queue = IngestQueue()
+        metrics.register("ingest_queue", _ingest_queue.stats)
+    return _ingest_queue
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    queue = get_ingest_queue()
+    worker_task = None
+    if EMBEDDED_WORKER:
+        # Import diferido: el graph y los clientes de LLM solo se cargan si hay worker
+        from worker import run_worker
+        worker_task = asyncio.create_task(run_worker(queue))
+    yield
+    if worker_task:
+        worker_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await worker_task
+        # Clientes compartidos del proceso (idempotente: run_worker también los cierra al cancelarse)
+        from graph.graph import close_agent
+        from graph.images import close_http_client
+        await close_agent()
+        await close_http_client()
+    # Cerrar el pool de conexiones compartido con la Graph API
+    await AsyncWhatsapp.aclose()
+    tracing.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Verificación del webhook (GET request de Facebook)
 @app.get("/webhook")
@@ -35,12 +84,13 @@ async def verify_webhook(
 
 # Recibir mensajes del webhook (POST request de Facebook)
 @app.post("/webhook")
-async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
+async def receive_webhook(request: Request):
     """
     Recibe mensajes de WhatsApp a través del webhook.
     
-    Este endpoint responde rápidamente a Facebook y encola el procesamiento
-    en background para evitar timeouts y bloqueos.
+    Este endpoint responde rápidamente a Facebook: cada mensaje se persiste en la
+    cola de ingesta durable y lo procesa un worker, así un reinicio no pierde
+    mensajes y la latencia no depende de la generación de imágenes.
     """
     try:
         body = await request.json()
@@ -56,19 +106,36 @@ async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
                 for change in changes:
                     value = change.get("value", {})
                     
-                    # Manejar mensajes - encolar para procesamiento en background
+                    # Manejar mensajes - persistir en la cola durable
                     if "messages" in value:
                         messages = value.get("messages", [])
                         metadata = value.get("metadata", {})
                         
                         for message in messages:
-                            # Encolar el procesamiento en background
-                            # Esto permite que el webhook responda inmediatamente
-                            background_tasks.add_task(
-                                process_message_background,
-                                message,
-                                metadata
-                            )
+                            from_number = message.get("from")
+                            if not from_number:
+                                logger.warning("Message without from number, skipping")
+                                continue
+                            message_id = message.get("id")
+                            # Span raíz del mensaje: el resto del pipeline (otro proceso) se cuelga de su id
+                            trace_id, root_id = tracing.message_root(message_id) if message_id else (None, None)
+                            with tracing.span(
+                                "webhook.receive", trace_id=trace_id, span_id=root_id,
+                                message_id=message_id, message_type=message.get("type"), phone=from_number,
+                            ) as receive_span:
+                                # Ignorar reentregas de Meta del mismo mensaje (atajo en memoria)
+                                if message_id and message_dedupe.seen(message_id):
+                                    logger.info(f"Duplicate delivery of message {message_id}, skipping")
+                                    receive_span.set_attribute("duplicate", True)
+                                    continue
+                                # Un INSERT en SQLite que también marca el id como visto, en la misma
+                                # transacción; se hace en un thread para no bloquear el loop
+                                queued = await asyncio.to_thread(get_ingest_queue().append, from_number, message, metadata)
+                                if queued is None:
+                                    logger.info(f"Duplicate delivery of message {message_id}, skipping")
+                                    receive_span.set_attribute("duplicate", True)
+                                if message_id:
+                                    message_dedupe.mark(message_id)
                     
                     # Manejar status updates (opcional, procesamiento rápido)
                     # Comentado porque genera mucho ruido en los logs
@@ -79,6 +146,11 @@ async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
         # Responder inmediatamente a Facebook
         return JSONResponse(status_code=200, content={"status": "ok"})
     
+    except sqlite3.Error as e:
+        # No se pudo persistir: responder error para que Facebook reintente la entrega
+        logger.error(f"Error persisting webhook messages: {str(e)}", exc_info=True)
+        return JSONResponse(status_code=503, content={"status": "unavailable"})
+    
     except Exception as e:
         logger.error(f"Error receiving webhook: {str(e)}", exc_info=True)
         # Aún así responder 200 para evitar reintentos de Facebook
@@ -94,6 +166,11 @@ async def health_check():
     """Endpoint de health check"""
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas de los componentes registrados en este proceso"""
+    return await asyncio.to_thread(metrics.snapshot)
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
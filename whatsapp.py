@@ -1,17 +1,47 @@
 import os
+import time
+import asyncio
+import random
+import itertools
 import mimetypes
-from typing import Any, Dict, Optional
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, Optional, Set, Tuple, Union
 
+import httpx
 import requests
 
+import tracing
 
-class Whatsapp:
-    """Lightweight wrapper for the WhatsApp Business Cloud API.
+try:  # HTTP/2 es opcional: httpx solo lo habilita si el paquete h2 está instalado
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+class WhatsappAPIError(requests.HTTPError):
+    """Error response from the Graph API, with its HTTP status in ``status_code``.
+
+    Subclasses ``requests.HTTPError`` so existing ``except requests.HTTPError``
+    handlers keep working for both clients.
+    """
+
+    def __init__(self, status_code: int, details: Any) -> None:
+        super().__init__(f"WhatsApp API error ({status_code}): {details}")
+        self.status_code = status_code
+        self.details = details
+
+
+class _BaseWhatsapp:
+    """Configuration and payload builders shared by the sync and async clients.
 
     Environment variables used by default:
       - WHATSAPP_TOKEN: Meta Graph API access token
       - WHATSAPP_PHONE_NUMBER_ID: Phone number ID from WhatsApp Business
       - WHATSAPP_API_VERSION: Graph API version (default: v20.0)
+      - WHATSAPP_API_BASE_URL: Graph API host (default: https://graph.facebook.com),
+        point it to mock_graph_api.py for local tests
     """
 
     def __init__(
@@ -31,7 +61,8 @@ class Whatsapp:
         if not self.phone_number_id:
             raise ValueError("Missing WHATSAPP_PHONE_NUMBER_ID")
 
-        self.base_url = f"https://graph.facebook.com/{self.api_version}"
+        api_host = os.getenv("WHATSAPP_API_BASE_URL") or "https://graph.facebook.com"
+        self.base_url = f"{api_host.rstrip('/')}/{self.api_version}"
 
     # ---------- Internal helpers ----------
     def _headers(self) -> Dict[str, str]:
@@ -42,6 +73,27 @@ class Whatsapp:
 
     def _messages_endpoint(self) -> str:
         return f"{self.base_url}/{self.phone_number_id}/messages"
+
+    @staticmethod
+    def _guess_mime_type(name: Optional[str], mime_type: Optional[str]) -> str:
+        return mime_type or (name and mimetypes.guess_type(name)[0]) or "application/octet-stream"
+
+    @staticmethod
+    def _default_filename(mime_type: str) -> str:
+        return "upload" + (mimetypes.guess_extension(mime_type) or "")
+
+    def _media_endpoint(self) -> str:
+        return f"{self.base_url}/{self.phone_number_id}/media"
+
+    def _subscriptions_endpoint(self, app_id: Optional[str]) -> str:
+        if not app_id:
+            app_id = os.getenv("FACEBOOK_APP_ID")
+            if not app_id:
+                raise ValueError(
+                    "app_id is required. Set FACEBOOK_APP_ID environment variable "
+                    "or pass it as parameter."
+                )
+        return f"{self.base_url}/{app_id}/subscriptions"
     
     def _normalize_phone(self, phone: str) -> str:
         """
@@ -55,30 +107,25 @@ class Whatsapp:
             return "54" + phone[3:]
         return phone
 
-    # ---------- Public API ----------
-    def send_text(self, to: str, body: str) -> Dict[str, Any]:
-        to = self._normalize_phone(to)
-        payload = {
+    # ---------- Payload builders ----------
+    def _text_payload(self, to: str, body: str) -> Dict[str, Any]:
+        return {
             "messaging_product": "whatsapp",
-            "to": to,
+            "to": self._normalize_phone(to),
             "type": "text",
             "text": {"body": body},
         }
-        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
-        self._raise_for_error(response)
-        return response.json()
 
-    def send_template(
+    def _template_payload(
         self,
         to: str,
         template_name: str,
-        language_code: str = "en_US",
-        components: Optional[list] = None,
+        language_code: str,
+        components: Optional[list],
     ) -> Dict[str, Any]:
-        to = self._normalize_phone(to)
         payload: Dict[str, Any] = {
             "messaging_product": "whatsapp",
-            "to": to,
+            "to": self._normalize_phone(to),
             "type": "template",
             "template": {
                 "name": template_name,
@@ -87,35 +134,15 @@ class Whatsapp:
         }
         if components:
             payload["template"]["components"] = components
-        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
-        self._raise_for_error(response)
-        return response.json()
-
-    def upload_media(self, file_path: str, mime_type: Optional[str] = None) -> str:
-        """Upload media and return media ID."""
-        url = f"{self.base_url}/{self.phone_number_id}/media"
-        headers = {"Authorization": f"Bearer {self.token}"}
+        return payload
 
-        guessed = mime_type or mimetypes.guess_type(file_path)[0] or "application/octet-stream"
-        with open(file_path, "rb") as f:
-            files = {"file": (os.path.basename(file_path), f, guessed)}
-            data = {"messaging_product": "whatsapp"}
-            response = requests.post(url, headers=headers, data=data, files=files)
-        self._raise_for_error(response)
-        media_id = response.json().get("id")
-        if not media_id:
-            raise RuntimeError("Failed to obtain media ID from upload response")
-        return media_id
-
-    def send_image(
+    def _image_payload(
         self,
         to: str,
-        *,
-        image_url: Optional[str] = None,
-        media_id: Optional[str] = None,
-        caption: Optional[str] = None,
+        image_url: Optional[str],
+        media_id: Optional[str],
+        caption: Optional[str],
     ) -> Dict[str, Any]:
-        to = self._normalize_phone(to)
         image_payload: Dict[str, Any] = {}
         if image_url:
             image_payload["link"] = image_url
@@ -126,26 +153,21 @@ class Whatsapp:
         if caption:
             image_payload["caption"] = caption
 
-        payload = {
+        return {
             "messaging_product": "whatsapp",
-            "to": to,
+            "to": self._normalize_phone(to),
             "type": "image",
             "image": image_payload,
         }
-        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
-        self._raise_for_error(response)
-        return response.json()
 
-    def send_document(
+    def _document_payload(
         self,
         to: str,
-        *,
-        document_url: Optional[str] = None,
-        media_id: Optional[str] = None,
-        filename: Optional[str] = None,
-        caption: Optional[str] = None,
+        document_url: Optional[str],
+        media_id: Optional[str],
+        filename: Optional[str],
+        caption: Optional[str],
     ) -> Dict[str, Any]:
-        to = self._normalize_phone(to)
         doc_payload: Dict[str, Any] = {}
         if document_url:
             doc_payload["link"] = document_url
@@ -158,22 +180,118 @@ class Whatsapp:
         if caption:
             doc_payload["caption"] = caption
 
-        payload = {
+        return {
             "messaging_product": "whatsapp",
-            "to": to,
+            "to": self._normalize_phone(to),
             "type": "document",
             "document": doc_payload,
         }
-        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
-        self._raise_for_error(response)
-        return response.json()
 
-    def mark_read(self, message_id: str) -> Dict[str, Any]:
-        payload = {
+    @staticmethod
+    def _read_receipt_payload(message_id: str) -> Dict[str, Any]:
+        return {
             "messaging_product": "whatsapp",
             "status": "read",
             "message_id": message_id,
         }
+
+    @staticmethod
+    def _subscription_payload(webhook_url: str, verify_token: str) -> Dict[str, Any]:
+        # Campos a suscribir (mensajes de WhatsApp)
+        # Puedes agregar más campos según necesites
+        fields = [
+            "messages",
+            "messaging_handovers",
+        ]
+        return {
+            "object": "whatsapp_business_account",
+            "callback_url": webhook_url,
+            "verify_token": verify_token,
+            "fields": fields,
+        }
+
+
+class Whatsapp(_BaseWhatsapp):
+    """Lightweight wrapper for the WhatsApp Business Cloud API.
+
+    Blocking client built on ``requests``; see ``AsyncWhatsapp`` for the
+    non-blocking sibling used by the bot.
+    """
+
+    # ---------- Public API ----------
+    def send_text(self, to: str, body: str) -> Dict[str, Any]:
+        payload = self._text_payload(to, body)
+        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
+        self._raise_for_error(response)
+        return response.json()
+
+    def send_template(
+        self,
+        to: str,
+        template_name: str,
+        language_code: str = "en_US",
+        components: Optional[list] = None,
+    ) -> Dict[str, Any]:
+        payload = self._template_payload(to, template_name, language_code, components)
+        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
+        self._raise_for_error(response)
+        return response.json()
+
+    def upload_media(
+        self,
+        file: Union[str, bytes, BinaryIO],
+        mime_type: Optional[str] = None,
+        filename: Optional[str] = None,
+    ) -> str:
+        """Upload media from a path, bytes or a binary buffer and return media ID."""
+        url = self._media_endpoint()
+        headers = {"Authorization": f"Bearer {self.token}"}
+        data = {"messaging_product": "whatsapp"}
+
+        if isinstance(file, str):
+            guessed = self._guess_mime_type(file, mime_type)
+            with open(file, "rb") as f:
+                files = {"file": (filename or os.path.basename(file), f, guessed)}
+                response = requests.post(url, headers=headers, data=data, files=files)
+        else:
+            guessed = self._guess_mime_type(filename, mime_type)
+            files = {"file": (filename or self._default_filename(guessed), file, guessed)}
+            response = requests.post(url, headers=headers, data=data, files=files)
+        self._raise_for_error(response)
+        media_id = response.json().get("id")
+        if not media_id:
+            raise RuntimeError("Failed to obtain media ID from upload response")
+        return media_id
+
+    def send_image(
+        self,
+        to: str,
+        *,
+        image_url: Optional[str] = None,
+        media_id: Optional[str] = None,
+        caption: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        payload = self._image_payload(to, image_url, media_id, caption)
+        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
+        self._raise_for_error(response)
+        return response.json()
+
+    def send_document(
+        self,
+        to: str,
+        *,
+        document_url: Optional[str] = None,
+        media_id: Optional[str] = None,
+        filename: Optional[str] = None,
+        caption: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        payload = self._document_payload(to, document_url, media_id, filename, caption)
+        response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
+        self._raise_for_error(response)
+        return response.json()
+
+    def mark_read(self, message_id: str) -> Dict[str, Any]:
+        payload = self._read_receipt_payload(message_id)
         response = requests.post(self._messages_endpoint(), headers=self._headers(), json=payload)
         self._raise_for_error(response)
         return response.json()
@@ -220,32 +338,9 @@ class Whatsapp:
             
             O usar la API de Subscriptions para suscribirte a los campos necesarios.
         """
-        # Si no se proporciona app_id, intentar obtenerlo del token o del phone_number_id
-        if not app_id:
-            # Intentar obtener el app_id del entorno o del contexto
-            app_id = os.getenv("FACEBOOK_APP_ID")
-            if not app_id:
-                raise ValueError(
-                    "app_id is required. Set FACEBOOK_APP_ID environment variable "
-                    "or pass it as parameter."
-                )
-        
-        # URL para configurar el webhook
-        url = f"{self.base_url}/{app_id}/subscriptions"
-        
-        # Campos a suscribir (mensajes de WhatsApp)
-        # Puedes agregar más campos según necesites
-        fields = [
-            "messages",
-            "messaging_handovers",
-        ]
-        
-        payload = {
-            "object": "whatsapp_business_account",
-            "callback_url": webhook_url,
-            "verify_token": verify_token,
-            "fields": fields,
-        }
+        # URL para configurar el webhook (app_id se toma de FACEBOOK_APP_ID si no se pasa)
+        url = self._subscriptions_endpoint(app_id)
+        payload = self._subscription_payload(webhook_url, verify_token)
         
         response = requests.post(url, headers=self._headers(), json=payload)
         self._raise_for_error(response)
@@ -262,15 +357,7 @@ class Whatsapp:
         Returns:
             Dict con la información del webhook
         """
-        if not app_id:
-            app_id = os.getenv("FACEBOOK_APP_ID")
-            if not app_id:
-                raise ValueError(
-                    "app_id is required. Set FACEBOOK_APP_ID environment variable "
-                    "or pass it as parameter."
-                )
-        
-        url = f"{self.base_url}/{app_id}/subscriptions"
+        url = self._subscriptions_endpoint(app_id)
         response = requests.get(url, headers=self._headers())
         self._raise_for_error(response)
         
@@ -286,15 +373,7 @@ class Whatsapp:
         Returns:
             Dict con la respuesta de la API
         """
-        if not app_id:
-            app_id = os.getenv("FACEBOOK_APP_ID")
-            if not app_id:
-                raise ValueError(
-                    "app_id is required. Set FACEBOOK_APP_ID environment variable "
-                    "or pass it as parameter."
-                )
-        
-        url = f"{self.base_url}/{app_id}/subscriptions"
+        url = self._subscriptions_endpoint(app_id)
         response = requests.delete(url, headers=self._headers())
         self._raise_for_error(response)
         
@@ -311,4 +390,476 @@ class Whatsapp:
                 details = response.json()
             except Exception:
                 details = {"raw": response.text}
-            raise requests.HTTPError(f"WhatsApp API error: {details}") from exc
\ No newline at end of file
+            raise WhatsappAPIError(response.status_code, details) from exc
+
+class _RetryBudget:
+    """Token bucket that caps retries to a fraction of the successful traffic.
+
+    Every request deposits ``ratio`` tokens and every retry withdraws one, so a
+    Graph API outage cannot multiply our outbound load by ``max_retries``.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10.0) -> None:
+        self.ratio = ratio
+        self.max_tokens = min_tokens
+        self.tokens = min_tokens
+
+    def deposit(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+# Send priorities: lower goes first among recipients ready to send
+PRIORITY_FINAL = 0
+PRIORITY_PROGRESS = 1
+
+
+@dataclass(order=True)
+class _QueuedSend:
+    priority: int
+    seq: int
+    enqueued_at: float = field(compare=False)
+    send: Callable[[], Awaitable[Dict[str, Any]]] = field(compare=False)
+    future: "asyncio.Future[Dict[str, Any]]" = field(compare=False)
+
+
+class _SendScheduler:
+    """Token-bucket pacing for outbound messages of one business phone number.
+
+    Each recipient has a FIFO and at most one message in flight, so a user always
+    receives messages in the order they were sent. Among recipients that are ready,
+    final answers (``PRIORITY_FINAL``) go before progress chatter
+    (``PRIORITY_PROGRESS``), then the oldest message wins. A 429 from Meta pauses
+    the whole bucket for the backoff delay instead of retrying at full speed.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.loop = asyncio.get_running_loop()
+        self._queues: Dict[str, Deque[_QueuedSend]] = {}
+        self._in_flight: Set[str] = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Strong references: the loop only keeps weak ones to running tasks
+        self._deliveries: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def submit(self, to: str, priority: int, send: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        item = _QueuedSend(priority, next(self._seq), time.monotonic(), send, self.loop.create_future())
+        self._queues.setdefault(to, deque()).append(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = self.loop.create_task(self._dispatch())
+        self._wakeup.set()
+        return await item.future
+
+    def pause(self, seconds: float) -> None:
+        """Stop dispatching for ``seconds`` (Meta answered 429)."""
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for delivery in list(self._deliveries):
+            delivery.cancel()
+
+    def _next_ready(self) -> Optional[Tuple[str, _QueuedSend]]:
+        best: Optional[Tuple[str, _QueuedSend]] = None
+        for to, queue in list(self._queues.items()):
+            # Callers that gave up (cancelled) leave their messages behind: drop them
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                del self._queues[to]
+                continue
+            if to in self._in_flight:
+                continue
+            if best is None or queue[0] < best[1]:
+                best = (to, queue[0])
+        return best
+
+    def _token_delay(self) -> float:
+        """Take a token and return 0, or return how long until one is available."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    async def _dispatch(self) -> None:
+        while True:
+            ready = self._next_ready()
+            if ready is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._token_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            to, item = ready
+            self._queues[to].popleft()
+            self._in_flight.add(to)
+            delivery = self.loop.create_task(self._deliver(to, item))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, to: str, item: _QueuedSend) -> None:
+        waited = time.monotonic() - item.enqueued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            result = await item.send()
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._in_flight.discard(to)
+            self._wakeup.set()
+
+    def stats(self) -> Dict[str, Any]:
+        dispatched = self.sent + self.failed
+        return {
+            "rate_per_second": self.rate,
+            "queue_depth": self.queue_depth,
+            "recipients_waiting": len(self._queues),
+            "in_flight": len(self._in_flight),
+            "max_queue_depth": self.max_queue_depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "avg_wait_seconds": round(self.total_wait / dispatched, 3) if dispatched else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3),
+        }
+
+
+class AsyncWhatsapp(_BaseWhatsapp):
+    """Non-blocking sibling of ``Whatsapp`` with the same public surface.
+
+    All instances share one pooled ``httpx.AsyncClient`` (HTTP/2 when ``h2`` is
+    installed, keep-alive otherwise), so graph.facebook.com is handshaked once
+    per connection instead of once per call. Every call has a timeout, and
+    failed calls are retried with full-jitter exponential backoff, bounded per
+    call by ``max_retries`` and globally by a retry budget. Reads retry on
+    429/5xx; POSTs (sends, uploads) only when Meta did not take the request.
+
+    Outbound messages go through a per-business-number send scheduler that paces
+    them to the Graph API throughput limit (see ``_SendScheduler``).
+
+    Extra environment variables:
+      - WHATSAPP_TIMEOUT: per-call timeout in seconds (default: 15)
+      - WHATSAPP_MAX_RETRIES: retries per failed call (default: 3)
+      - WHATSAPP_SEND_RATE: messages per second per business number, 0 disables pacing (default: 20)
+      - WHATSAPP_SEND_BURST: bucket size for short bursts (default: WHATSAPP_SEND_RATE)
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    # A 500/502/504 may come after Meta already accepted a POST; 429/503 are rejections
+    POST_RETRY_STATUSES = frozenset({429, 503})
+
+    _client: Optional[httpx.AsyncClient] = None
+    _retry_budget = _RetryBudget()
+    _schedulers: Dict[str, _SendScheduler] = {}
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        phone_number_id: Optional[str] = None,
+        api_version: Optional[str] = None,
+        *,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 8.0,
+    ) -> None:
+        super().__init__(token, phone_number_id, api_version)
+        self.timeout = timeout or float(os.getenv("WHATSAPP_TIMEOUT") or 15)
+        self.max_retries = (
+            max_retries if max_retries is not None else int(os.getenv("WHATSAPP_MAX_RETRIES") or 3)
+        )
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.send_rate = float(os.getenv("WHATSAPP_SEND_RATE") or 20)
+        self.send_burst = float(os.getenv("WHATSAPP_SEND_BURST") or self.send_rate or 1)
+
+    # ---------- Connection pool ----------
+    @classmethod
+    def _get_client(cls) -> httpx.AsyncClient:
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient(
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60.0,
+                ),
+            )
+        return cls._client
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """Close the shared connection pool (call on application shutdown)."""
+        for scheduler in cls._schedulers.values():
+            scheduler.close()
+        cls._schedulers.clear()
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+
+    # ---------- Send scheduling ----------
+    def _scheduler(self) -> _SendScheduler:
+        scheduler = self._schedulers.get(self.phone_number_id)
+        # Un scheduler pertenece a un event loop (asyncio.run crea uno nuevo)
+        if scheduler is None or scheduler.loop is not asyncio.get_running_loop():
+            scheduler = _SendScheduler(self.send_rate, self.send_burst)
+            self._schedulers[self.phone_number_id] = scheduler
+        return scheduler
+
+    async def _send_message(self, to: str, payload: Dict[str, Any], priority: int) -> Dict[str, Any]:
+        """POST to /messages through the send scheduler (ordered per recipient)."""
+        with tracing.span("whatsapp.send", message_type=payload.get("type"), priority=priority):
+            if self.send_rate <= 0:
+                return await self._post_json(self._messages_endpoint(), payload)
+            return await self._scheduler().submit(
+                to, priority, lambda: self._post_json(self._messages_endpoint(), payload)
+            )
+
+    def send_stats(self) -> Dict[str, Any]:
+        scheduler = self._schedulers.get(self.phone_number_id)
+        return scheduler.stats() if scheduler is not None else {"rate_per_second": self.send_rate, "sent": 0}
+
+    # ---------- Internal helpers ----------
+    def _backoff_delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    async def _request(self, method: str, url: str, *, timeout: Optional[float] = None, **kwargs: Any) -> httpx.Response:
+        """Send a request through the shared pool, retrying connect errors and transient statuses.
+
+        GET/DELETE are idempotent and retry on any of ``RETRY_STATUSES``. A POST
+        is not: it is only retried on ``POST_RETRY_STATUSES`` and on errors raised
+        before the request went out, so a retried ``POST /messages`` does not
+        deliver the same message twice.
+        """
+        client = self._get_client()
+        retry_statuses = self.POST_RETRY_STATUSES if method.upper() == "POST" else self.RETRY_STATUSES
+        self._retry_budget.deposit()
+        attempt = 0
+        while True:
+            response: Optional[httpx.Response] = None
+            try:
+                response = await client.request(method, url, timeout=timeout or self.timeout, **kwargs)
+                if response.status_code not in retry_statuses:
+                    return response
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                if attempt >= self.max_retries or not self._retry_budget.withdraw():
+                    raise
+            else:
+                if attempt >= self.max_retries or not self._retry_budget.withdraw():
+                    return response
+            delay = self._backoff_delay(attempt, response)
+            if response is not None and response.status_code == 429:
+                # Rate limit de Meta: frenar todos los envíos del número, no solo este
+                scheduler = self._schedulers.get(self.phone_number_id)
+                if scheduler is not None:
+                    scheduler.pause(delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _post_json(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = await self._request("POST", url, headers=self._headers(), json=payload)
+        self._raise_for_error(response)
+        return response.json()
+
+    # ---------- Public API ----------
+    async def send_text(self, to: str, body: str, *, priority: int = PRIORITY_FINAL) -> Dict[str, Any]:
+        return await self._send_message(to, self._text_payload(to, body), priority)
+
+    async def send_template(
+        self,
+        to: str,
+        template_name: str,
+        language_code: str = "en_US",
+        components: Optional[list] = None,
+        *,
+        priority: int = PRIORITY_FINAL,
+    ) -> Dict[str, Any]:
+        payload = self._template_payload(to, template_name, language_code, components)
+        return await self._send_message(to, payload, priority)
+
+    async def upload_media(
+        self,
+        file: Union[str, bytes, BinaryIO],
+        mime_type: Optional[str] = None,
+        filename: Optional[str] = None,
+    ) -> str:
+        """Upload media from a path, bytes or a binary buffer and return media ID.
+
+        In-memory content is sent as is, without touching the disk.
+        """
+        headers = {"Authorization": f"Bearer {self.token}"}
+        if isinstance(file, str):
+            guessed = self._guess_mime_type(file, mime_type)
+            filename = filename or os.path.basename(file)
+
+            def _read() -> bytes:
+                with open(file, "rb") as f:
+                    return f.read()
+
+            content = await asyncio.to_thread(_read)
+        else:
+            guessed = self._guess_mime_type(filename, mime_type)
+            filename = filename or self._default_filename(guessed)
+            content = file if isinstance(file, bytes) else file.read()
+        files = {"file": (filename, content, guessed)}
+        data = {"messaging_product": "whatsapp"}
+        with tracing.span("whatsapp.upload_media", bytes=len(content), mime_type=guessed):
+            response = await self._request(
+                "POST", self._media_endpoint(), headers=headers, data=data, files=files,
+                timeout=max(self.timeout, 60.0),
+            )
+        self._raise_for_error(response)
+        media_id = response.json().get("id")
+        if not media_id:
+            raise RuntimeError("Failed to obtain media ID from upload response")
+        return media_id
+
+    async def send_image(
+        self,
+        to: str,
+        *,
+        image_url: Optional[str] = None,
+        media_id: Optional[str] = None,
+        caption: Optional[str] = None,
+        priority: int = PRIORITY_FINAL,
+    ) -> Dict[str, Any]:
+        payload = self._image_payload(to, image_url, media_id, caption)
+        return await self._send_message(to, payload, priority)
+
+    async def send_document(
+        self,
+        to: str,
+        *,
+        document_url: Optional[str] = None,
+        media_id: Optional[str] = None,
+        filename: Optional[str] = None,
+        caption: Optional[str] = None,
+        priority: int = PRIORITY_FINAL,
+    ) -> Dict[str, Any]:
+        payload = self._document_payload(to, document_url, media_id, filename, caption)
+        return await self._send_message(to, payload, priority)
+
+    async def mark_read(self, message_id: str) -> Dict[str, Any]:
+        return await self._post_json(self._messages_endpoint(), self._read_receipt_payload(message_id))
+
+    # ---------- Media download ----------
+    async def get_media_info(self, media_id: str) -> Dict[str, Any]:
+        """Resolve a media ID to its (short-lived) download URL and mime type."""
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = await self._request("GET", f"{self.base_url}/{media_id}", headers=headers)
+        self._raise_for_error(response)
+        return response.json()
+
+    async def download_media(self, media_url: str) -> bytes:
+        """Download the binary behind a URL returned by ``get_media_info``."""
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = await self._request("GET", media_url, headers=headers, timeout=max(self.timeout, 30.0))
+        self._raise_for_error(response)
+        return response.content
+
+    async def stream_media(self, media_url: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """Stream the binary behind a URL returned by ``get_media_info`` in chunks.
+
+        At most one chunk is held in memory, so callers can enforce a size limit
+        or write straight to disk. HTTP errors are raised before the first chunk.
+        """
+        headers = {"Authorization": f"Bearer {self.token}"}
+        client = self._get_client()
+        async with client.stream("GET", media_url, headers=headers, timeout=max(self.timeout, 30.0)) as response:
+            if response.is_error:
+                await response.aread()
+                self._raise_for_error(response)
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+
+    # ---------- Backward-compatible convenience ----------
+    async def send_message(self, phone: str, content: str, file: Optional[str] = None) -> Dict[str, Any]:
+        """Async version of ``Whatsapp.send_message``."""
+        if not file:
+            return await self.send_text(phone, content)
+
+        is_url = file.startswith("http://") or file.startswith("https://")
+        if is_url:
+            return await self.send_document(phone, document_url=file, caption=content)
+
+        media_id = await self.upload_media(file)
+        return await self.send_document(phone, media_id=media_id, caption=content)
+
+    # ---------- Webhook configuration ----------
+    async def configure_webhook(
+        self,
+        webhook_url: str,
+        verify_token: str,
+        app_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Async version of ``Whatsapp.configure_webhook``."""
+        url = self._subscriptions_endpoint(app_id)
+        return await self._post_json(url, self._subscription_payload(webhook_url, verify_token))
+
+    async def get_webhook_info(self, app_id: Optional[str] = None) -> Dict[str, Any]:
+        """Async version of ``Whatsapp.get_webhook_info``."""
+        response = await self._request("GET", self._subscriptions_endpoint(app_id), headers=self._headers())
+        self._raise_for_error(response)
+        return response.json()
+
+    async def delete_webhook(self, app_id: Optional[str] = None) -> Dict[str, Any]:
+        """Async version of ``Whatsapp.delete_webhook``."""
+        response = await self._request("DELETE", self._subscriptions_endpoint(app_id), headers=self._headers())
+        self._raise_for_error(response)
+        return response.json()
+
+    # ---------- Error handling ----------
+    @staticmethod
+    def _raise_for_error(response: httpx.Response) -> None:
+        # Mismo contrato que Whatsapp: WhatsappAPIError (un requests.HTTPError con status_code)
+        if response.is_error:
+            try:
+                details = response.json()
+            except Exception:
+                details = {"raw": response.text}
+            raise WhatsappAPIError(response.status_code, details)
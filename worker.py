@@ -0,0 +1,156 @@
+"""
+Workers que consumen la cola de ingesta durable (ingest_queue.py).
+
+Uso:
+    python worker.py --processes 4 --concurrency 32
+
+Cada proceso toma solo los teléfonos de su shard (hash del número % procesos), así
+la sesión de un usuario siempre vive en el mismo proceso. Dentro de un proceso se
+procesan hasta `--concurrency` números en paralelo sobre un único event loop.
+
+El webhook también puede correr un worker embebido (INGEST_EMBEDDED_WORKER=1, por
+defecto); desactivarlo cuando se levantan workers aparte.
+"""
+import os
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from typing import List, Optional, Set
+
+import metrics
+import tracing
+from ingest_queue import IngestQueue, QueuedMessage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "0.2"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+RETRY_BASE_DELAY = 2.0
+
+
+async def _heartbeat(queue: IngestQueue, ids: List[int], worker_id: str) -> None:
+    """Renueva el lease mientras el lote se sigue procesando"""
+    while True:
+        await asyncio.sleep(queue.visibility_timeout / 3)
+        await asyncio.to_thread(queue.extend, ids, worker_id)
+
+
+async def _handle_batch(queue: IngestQueue, worker_id: str, phone: str, items: List[QueuedMessage]) -> None:
+    from background_processor import process_message_batch
+
+    ids = [item.id for item in items]
+    attempts = max(item.attempts for item in items)
+    heartbeat = asyncio.create_task(_heartbeat(queue, ids, worker_id))
+    try:
+        claimed_at = time.time()
+        wait = claimed_at - min(item.enqueued_at for item in items)
+        logger.info(f"Claimed {len(items)} message(s) for {phone} after {wait:.3f}s in queue")
+        for item in items:
+            message_id = item.message.get("id")
+            if message_id:
+                trace_id, root_id = tracing.message_root(message_id)
+                tracing.record_span(
+                    "queue.wait", item.enqueued_at, claimed_at, trace_id=trace_id, parent_id=root_id,
+                    message_id=message_id, attempts=item.attempts, batch_size=len(items),
+                )
+        await process_message_batch(
+            phone, [(item.message, item.metadata) for item in items],
+            attempt=attempts, last_attempt=attempts >= queue.max_attempts,
+        )
+        await asyncio.to_thread(queue.ack, ids, worker_id)
+    except Exception as e:
+        delay = RETRY_BASE_DELAY * (2 ** (attempts - 1))
+        logger.error(f"Batch for {phone} failed (attempt {attempts}), retrying in {delay}s: {e}", exc_info=True)
+        await asyncio.to_thread(queue.release, ids, worker_id, delay)
+    finally:
+        heartbeat.cancel()
+
+
+async def run_worker(
+    queue: Optional[IngestQueue] = None,
+    *,
+    shard: int = 0,
+    shards: int = 1,
+    concurrency: int = 32,
+) -> None:
+    """Loop principal: toma lotes por número y los procesa concurrentemente"""
+    queue = queue or IngestQueue()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{shard}"
+    metrics.register("ingest_queue", queue.stats)
+    active: Set[asyncio.Task] = set()
+    last_metrics_log = time.monotonic()
+    logger.info(f"Worker {worker_id} started (shard {shard}/{shards}, concurrency {concurrency})")
+    from imaging import warm_up_pools
+    warm_up_pools()
+
+    try:
+        while True:
+            if time.monotonic() - last_metrics_log >= METRICS_LOG_INTERVAL:
+                logger.info(f"Metrics: {metrics.snapshot()}")
+                last_metrics_log = time.monotonic()
+
+            free = concurrency - len(active)
+            if free <= 0:
+                await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            batches = await asyncio.to_thread(queue.claim, worker_id, shard=shard, shards=shards, max_phones=free)
+            if not batches:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            for phone, items in batches.items():
+                task = asyncio.create_task(_handle_batch(queue, worker_id, phone, items))
+                active.add(task)
+                task.add_done_callback(active.discard)
+    finally:
+        # Los lotes en vuelo vuelven a la cola cuando vence su lease
+        for task in active:
+            task.cancel()
+        from graph.graph import close_agent
+        from graph.images import close_http_client
+        from imaging import shutdown_pools
+        await close_agent()
+        await close_http_client()
+        shutdown_pools()
+        tracing.shutdown()
+
+
+def _run_process(shard: int, shards: int, concurrency: int) -> None:
+    asyncio.run(run_worker(shard=shard, shards=shards, concurrency=concurrency))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Consume la cola de ingesta de NanoLang")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("INGEST_WORKER_PROCESSES", "1")))
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("INGEST_WORKER_CONCURRENCY", "32")))
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        _run_process(0, 1, args.concurrency)
+        return
+
+    # No daemon: cada shard puede tener su propio pool de procesos (imaging.py)
+    processes = [
+        multiprocessing.Process(target=_run_process, args=(shard, args.processes, args.concurrency))
+        for shard in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout=5.0)
+
+
+if __name__ == "__main__":
+    main()